@@ -0,0 +1,537 @@
+import io
+import os
+import json
+import stat
+import shutil
+import zipfile
+import hashlib
+from curried import curried
+from common import Struct
+from instrumentation import metrics
+from rate_controller import controller, get_error_code
+from aws_clients import registry
+from worker_pool import shared_pool
+from s3_updater import MULTIPART_THRESHOLD, get_s3_client, get_bucket, get_transfer_config, put_object
+from file_set_loader import walk, read_bytes
+from sync_ignore import SYNC_IGNORE_FILE, load_sync_ignore, ignore_walk_template
+
+
+# The prefix of the bucket that packaged artifacts are uploaded under, each keyed by the hash of its content
+ARTIFACTS_PREFIX = "artifacts"
+
+# Bump whenever build_zip changes the bytes it builds from the same files, so that older zips aren't reused
+ARTIFACT_FORMAT_VERSION = 1
+
+# Every zip entry gets this timestamp (the earliest a zip can hold), so that zips of the same files are identical
+ZIP_TIMESTAMP = (1980, 1, 1, 0, 0, 0)
+
+# The extensions of the templates that are searched for local artifact paths
+TEMPLATE_EXTENSIONS = (".yaml", ".yml", ".json", ".template")
+
+# Artifact files with these extensions are uploaded as they are, rather than zipped
+ARCHIVE_EXTENSIONS = (".zip", ".jar")
+
+# The property of each resource type that can name a local artifact, and whether it takes an S3 URI or an object
+ARTIFACT_PROPERTIES = \
+{
+    "AWS::Serverless::Function": ("CodeUri", "uri"),
+    "AWS::Serverless::LayerVersion": ("ContentUri", "uri"),
+    "AWS::Lambda::Function": ("Code", "object"),
+    "AWS::Lambda::LayerVersion": ("Content", "object")
+}
+
+
+def is_local_path(value):
+
+    """
+    Checks whether a property value is a local path to package, rather than an S3 or HTTP location
+
+    :param value: The property value
+    :return: Whether the value is a local path
+    """
+
+    return isinstance(value, str) and value.strip() != "" and "://" not in value
+
+
+def mapping_value(node, key):
+
+    """
+    Looks up the value of a key in a composed YAML mapping
+
+    :param node: The composed YAML node, or None
+    :param key: The key to look up
+    :return: The value node, or None if the node isn't a mapping or doesn't hold the key
+    """
+
+    import yaml
+
+    if not isinstance(node, yaml.MappingNode):
+
+        return None
+
+    for key_node, value_node in node.value:
+
+        if isinstance(key_node, yaml.ScalarNode) and key_node.value == key:
+
+            return value_node
+
+    return None
+
+
+def find_artifact_values(text):
+
+    """
+    Finds the properties of a template that name local artifacts, along with where their values are in the text. The
+    template is composed rather than loaded, so the positions are exact and intrinsic function tags don't matter.
+
+    :param text: The text of a YAML or JSON template
+    :return: The list of Structs of the start and end index, local path and form ("uri" or "object") of each value
+    """
+
+    import yaml
+
+    root = yaml.compose(text, Loader = yaml.SafeLoader)
+    candidates = [(mapping_value(mapping_value(mapping_value(root, "Globals"), "Function"), "CodeUri"), "uri")]
+    resources = mapping_value(root, "Resources")
+
+    for logical_id, resource in resources.value if isinstance(resources, yaml.MappingNode) else []:
+
+        resource_type = mapping_value(resource, "Type")
+
+        if isinstance(resource_type, yaml.ScalarNode) and resource_type.value in ARTIFACT_PROPERTIES:
+
+            name, form = ARTIFACT_PROPERTIES[resource_type.value]
+            candidates.append((mapping_value(mapping_value(resource, "Properties"), name), form))
+
+    return \
+    [
+        Struct(start = node.start_mark.index, end = node.end_mark.index, path = node.value, form = form)
+        for node, form in candidates
+        if isinstance(node, yaml.ScalarNode) and node.tag == "tag:yaml.org,2002:str" and is_local_path(node.value)
+    ]
+
+
+def list_artifact_files(path):
+
+    """
+    Lists the files that make up an artifact, in a stable order
+
+    :param path: The artifact's directory or file
+    :return: The list of (name in the zip, local path) tuples
+    """
+
+    if not os.path.isdir(path):
+
+        return [(os.path.basename(path), path)]
+
+    return sorted \
+    (
+        (os.path.relpath(os.path.join(root, file), path).replace(os.sep, "/"), os.path.join(root, file))
+        for root, dir_names, files in os.walk(path)
+        for file in files
+    )
+
+
+def is_executable(file):
+
+    """Returns whether a local file is executable by its owner"""
+
+    return bool(os.stat(file).st_mode & stat.S_IXUSR)
+
+
+def hash_artifact(path):
+
+    """
+    Hashes an artifact from the files it is built from, so that an unchanged artifact is recognized without zipping it
+
+    :param path: The artifact's directory or file
+    :return: The SHA-256 of the artifact's content, as hex
+    """
+
+    if path.lower().endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path):
+
+        return hashlib.sha256(read_bytes(path)).hexdigest()
+
+    digest = hashlib.sha256(f"zip.v{ARTIFACT_FORMAT_VERSION}".encode("utf-8"))
+
+    for name, file in list_artifact_files(path):
+
+        data_bytes = read_bytes(file)
+        digest.update(f"\0{name}\0{is_executable(file):d}\0{len(data_bytes)}\0".encode("utf-8"))
+        digest.update(data_bytes)
+
+    return digest.hexdigest()
+
+
+def build_zip(path):
+
+    """
+    Zips an artifact reproducibly: entries are sorted, and every entry has the same timestamp and a permission that
+    only depends on whether the file is executable
+
+    :param path: The artifact's directory or file
+    :return: The bytes of the zip
+    """
+
+    if path.lower().endswith(ARCHIVE_EXTENSIONS) and os.path.isfile(path):
+
+        return read_bytes(path)
+
+    buffer = io.BytesIO()
+
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+
+        for name, file in list_artifact_files(path):
+
+            info = zipfile.ZipInfo(name, ZIP_TIMESTAMP)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = (0o100755 if is_executable(file) else 0o100644) << 16
+            archive.writestr(info, read_bytes(file))
+
+    return buffer.getvalue()
+
+
+def get_artifact_key(path, content_hash):
+
+    """
+    Gets the key an artifact is uploaded to
+
+    :param path: The artifact's directory or file
+    :param content_hash: The hash of the artifact (see hash_artifact)
+    :return: The key, under ARTIFACTS_PREFIX
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+
+    if not (extension in ARCHIVE_EXTENSIONS and os.path.isfile(path)):
+
+        extension = ".zip"
+
+    return f"{ARTIFACTS_PREFIX}/{content_hash}{extension}"
+
+
+def artifact_exists(s3_bucket, key):
+
+    """
+    Checks whether an artifact has already been uploaded
+
+    :param s3_bucket: The name of the S3 bucket
+    :param key: The key of the artifact
+    :return: Whether the key exists
+    """
+
+    s3 = registry.get_client("s3")
+
+    try:
+
+        with metrics.span("s3.head_object", key = key):
+
+            controller.call("HeadObject", s3.head_object, Bucket = s3_bucket, Key = key)
+
+        return True
+
+    except Exception as error:
+
+        if get_error_code(error) in ("NoSuchKey", "404"):
+
+            return False
+
+        raise
+
+
+def upload_artifact(s3_bucket, data_bytes, key):
+
+    """
+    Uploads an artifact, with a single request if it is small or in parts if it is large
+
+    :param s3_bucket: The name of the S3 bucket
+    :param data_bytes: The bytes of the artifact
+    :param key: The key to upload it to
+    :return: Nothing
+    """
+
+    bucket = get_bucket(get_s3_client(), s3_bucket)
+
+    if len(data_bytes) < MULTIPART_THRESHOLD:
+
+        put_object(bucket, data_bytes, key, {})
+        return
+
+    with metrics.span("s3.upload_file", file = key):
+
+        controller.call \
+        (
+            "upload_file",
+            bucket.upload_fileobj,
+            io.BytesIO(data_bytes),
+            key,
+            Config = get_transfer_config()
+        )
+
+
+@curried
+def package_artifact_template(artifact_exists_func, upload_artifact_func, s3_bucket, path):
+
+    """
+    Curried template function for packaging an artifact: it is only zipped and uploaded if no artifact with the same
+    content has been uploaded before
+
+    :param artifact_exists_func: A function that checks whether a key exists in a bucket
+    :param upload_artifact_func: A function that uploads bytes to a key in a bucket
+    :param s3_bucket: The name of the S3 bucket to upload to
+    :param path: The artifact's directory or file
+    :return: The key of the artifact
+    """
+
+    with metrics.span("package.hash_artifact", path = path):
+
+        key = get_artifact_key(path, hash_artifact(path))
+
+    if artifact_exists_func(s3_bucket, key):
+
+        metrics.count("artifacts_reused")
+        return key
+
+    with metrics.span("package.build_zip", path = path):
+
+        data_bytes = build_zip(path)
+
+    upload_artifact_func(s3_bucket, data_bytes, key)
+    metrics.count("artifacts_uploaded")
+    print(f"Packaged {path} => s3://{s3_bucket}/{key}")
+
+    return key
+
+
+# Curry the artifact_exists and upload_artifact functions into the package_artifact_template function
+package_artifact = package_artifact_template(artifact_exists)(upload_artifact)
+
+# Computes the same keys as package_artifact without uploading anything, to see the templates a sync would publish
+plan_artifact = package_artifact_template(lambda s3_bucket, key: True)(None)
+
+
+def rewrite_template(text, values, keys, s3_bucket):
+
+    """
+    Replaces the local artifact paths in a template with the S3 locations of their packaged artifacts, leaving the rest
+    of the text as it is
+
+    :param text: The text of the template
+    :param values: The artifact values found in the text (see find_artifact_values)
+    :param keys: A dictionary of the key of each of the values' artifacts, by value
+    :param s3_bucket: The name of the S3 bucket the artifacts are in
+    :return: The rewritten text
+    """
+
+    for value in sorted(values, key = lambda value: value.start, reverse = True):
+
+        key = keys[id(value)]
+        location = f"s3://{s3_bucket}/{key}" if value.form == "uri" else { "S3Bucket": s3_bucket, "S3Key": key }
+
+        # JSON scalars and flow mappings are valid in both YAML and JSON templates
+        text = text[:value.start] + json.dumps(location) + text[value.end:]
+
+    return text
+
+
+def package_templates(local_path, output_path, s3_bucket, package_artifact_func = package_artifact):
+
+    """
+    Packages the local artifacts (e.g. a CodeUri directory) that the templates in a directory refer to, and writes a
+    copy of the directory to publish instead: every template that refers to a local artifact points at its S3 location
+    and the artifacts' own files are left out. Artifacts are keyed by content, and packaged concurrently on the shared
+    worker pool, so unchanged artifacts are never zipped or uploaded again and the copy only changes when they do.
+
+    :param local_path: The local templates directory
+    :param output_path: The directory to write the copy to, replacing anything already there
+    :param s3_bucket: The name of the S3 bucket to upload the artifacts to
+    :param package_artifact_func: A function that packages an artifact and returns its key (see package_artifact)
+    :return: The output path
+    """
+
+    sync_ignore = load_sync_ignore(local_path)
+    property_names = set(name for name, form in ARTIFACT_PROPERTIES.values())
+
+    with metrics.span("package.find_artifacts"):
+
+        files = \
+        [
+            os.path.relpath(os.path.join(root, file), local_path)
+            for root, dir_names, file_names in ignore_walk_template(walk)(sync_ignore)(local_path)
+            for file in file_names
+        ]
+        templates = {}
+
+        for file in files:
+
+            if not file.lower().endswith(TEMPLATE_EXTENSIONS):
+
+                continue
+
+            text = read_bytes(os.path.join(local_path, file)).decode("utf-8")
+
+            # Only templates that mention an artifact property need composing
+            if not any(name in text for name in property_names):
+
+                continue
+
+            try:
+
+                values = find_artifact_values(text)
+
+            except Exception as error:
+
+                # Reporting broken templates is the validator's job, so publish them as they are
+                print(f"Looking for artifacts in {file} failed => {error}")
+                continue
+
+            for value in values:
+
+                value.artifact = os.path.normpath(os.path.join(local_path, os.path.dirname(file), value.path))
+
+                if not os.path.exists(value.artifact):
+
+                    raise ValueError(f"{file}: the artifact {value.path!r} doesn't exist")
+
+                if os.path.abspath(os.path.join(local_path, file)).startswith(os.path.abspath(value.artifact) + os.sep):
+
+                    raise ValueError(f"{file}: the artifact {value.path!r} can't contain its own template")
+
+            if len(values) > 0:
+
+                templates[file] = (text, values)
+
+    artifacts = sorted(set(value.artifact for text, values in templates.values() for value in values))
+    metrics.count("templates_packaged", len(templates))
+
+    with metrics.span("package.artifacts", artifacts = len(artifacts)):
+
+        artifact_keys = dict(zip(artifacts, shared_pool.map(package_artifact_func(s3_bucket), artifacts)))
+
+    artifact_dirs = tuple(os.path.abspath(artifact) + os.sep for artifact in artifacts if os.path.isdir(artifact))
+
+    with metrics.span("package.write"):
+
+        if os.path.isdir(output_path):
+
+            shutil.rmtree(output_path)
+
+        os.makedirs(output_path)
+
+        if os.path.isfile(os.path.join(local_path, SYNC_IGNORE_FILE)):
+
+            shutil.copyfile(os.path.join(local_path, SYNC_IGNORE_FILE), os.path.join(output_path, SYNC_IGNORE_FILE))
+
+        for file in files:
+
+            if os.path.abspath(os.path.join(local_path, file)).startswith(artifact_dirs):
+
+                continue
+
+            output_file = os.path.join(output_path, file)
+            os.makedirs(os.path.dirname(output_file), exist_ok = True)
+
+            if file in templates:
+
+                text, values = templates[file]
+                keys = { id(value): artifact_keys[value.artifact] for value in values }
+
+                with open(output_file, "wb") as output:
+
+                    output.write(rewrite_template(text, values, keys, s3_bucket).encode("utf-8"))
+
+            else:
+
+                shutil.copyfile(os.path.join(local_path, file), output_file)
+
+    return output_path
+
+
+class PyTests:
+
+    @staticmethod
+    def test_find_artifact_values_finds_local_paths_only():
+
+        text = \
+            "Transform: AWS::Serverless-2016-10-31\n" + \
+            "Globals:\n  Function:\n    CodeUri: shared/\n" + \
+            "Resources:\n" + \
+            "  Fn:\n    Type: AWS::Serverless::Function\n    Properties:\n      CodeUri: ./src # code\n" + \
+            "  Remote:\n    Type: AWS::Serverless::Function\n    Properties:\n      CodeUri: s3://b/k.zip\n" + \
+            "  Tagged:\n    Type: AWS::Serverless::Function\n    Properties:\n      CodeUri: !Sub '${A}'\n" + \
+            "  Raw:\n    Type: AWS::Lambda::Function\n    Properties:\n      Code: \"lib.jar\"\n"
+
+        values = find_artifact_values(text)
+
+        assert [(value.path, value.form) for value in values] == \
+               [("shared/", "uri"), ("./src", "uri"), ("lib.jar", "object")]
+        assert [text[value.start:value.end] for value in values] == ["shared/", "./src", "\"lib.jar\""]
+
+    @staticmethod
+    def test_build_zip_is_reproducible_and_matches_the_hash(tmp_path):
+
+        src = tmp_path / "src"
+        (src / "pkg").mkdir(parents = True)
+        (src / "app.py").write_text("print(1)")
+        (src / "pkg" / "run.sh").write_text("#!/bin/sh")
+        os.chmod(str(src / "pkg" / "run.sh"), 0o755)
+
+        first_hash, first_zip = hash_artifact(str(src)), build_zip(str(src))
+        os.utime(str(src / "app.py"), (1, 1))
+
+        assert (hash_artifact(str(src)), build_zip(str(src))) == (first_hash, first_zip)
+
+        with zipfile.ZipFile(io.BytesIO(first_zip)) as archive:
+
+            assert archive.namelist() == ["app.py", "pkg/run.sh"]
+            assert archive.getinfo("pkg/run.sh").external_attr >> 16 == 0o100755
+
+        (src / "app.py").write_text("print(2)")
+
+        assert hash_artifact(str(src)) != first_hash
+
+    @staticmethod
+    def test_package_templates_uploads_new_artifacts_and_rewrites_templates(tmp_path):
+
+        templates = tmp_path / "templates"
+        (templates / "app" / "src").mkdir(parents = True)
+        (templates / "app" / "src" / "handler.py").write_text("def handler(event, context): pass")
+        (templates / "app" / "function.yaml").write_text \
+        (
+            "Resources:\n  Fn:\n    Type: AWS::Serverless::Function\n    Properties:\n" +
+            "      CodeUri: src   # packaged\n      Handler: handler.handler\n"
+        )
+        (templates / "app" / "raw.json").write_text \
+        (
+            '{"Resources": {"Fn": {"Type": "AWS::Lambda::Function", "Properties": {"Code": "./src"}}}}'
+        )
+        (templates / "plain.yaml").write_text("Resources: {}\n")
+
+        uploaded = {}
+        package = package_artifact_template(lambda s3_bucket, key: key in uploaded) \
+                                           (lambda s3_bucket, data_bytes, key: uploaded.update({ key: data_bytes }))
+        output = tmp_path / "templates-packaged"
+
+        metrics.reset()
+        package_templates(str(templates), str(output), "bucket", package)
+
+        key = get_artifact_key(str(templates / "app" / "src"), hash_artifact(str(templates / "app" / "src")))
+
+        assert list(uploaded) == [key]
+        assert metrics.summary()["counters"]["artifacts_uploaded"] == 1
+        assert sorted(os.listdir(str(output / "app"))) == ["function.yaml", "raw.json"]
+        assert (output / "app" / "function.yaml").read_text() == \
+            "Resources:\n  Fn:\n    Type: AWS::Serverless::Function\n    Properties:\n" + \
+            f"      CodeUri: \"s3://bucket/{key}\"   # packaged\n      Handler: handler.handler\n"
+        assert json.loads((output / "app" / "raw.json").read_text())["Resources"]["Fn"]["Properties"]["Code"] == \
+            { "S3Bucket": "bucket", "S3Key": key }
+        assert (output / "plain.yaml").read_text() == "Resources: {}\n"
+
+        # Unchanged code isn't zipped or uploaded again, and the packaged templates come out the same
+        first = (output / "app" / "function.yaml").read_text()
+        metrics.reset()
+        package_templates(str(templates), str(output), "bucket", package)
+
+        assert metrics.summary()["counters"]["artifacts_reused"] == 1
+        assert "artifacts_uploaded" not in metrics.summary()["counters"]
+        assert (output / "app" / "function.yaml").read_text() == first
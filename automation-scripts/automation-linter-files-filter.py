@@ -5,13 +5,32 @@ This script compares what is in the S3 bucket to what came over from the git rep
 being changed so that they can be linted and tested prior to launch without re-testing / re-linting the entire repo.
 """
 import os
-import boto3
+import shlex
 import shutil
 import argparse
-from botocore.exceptions import ClientError
-
-
-def get_changed_files(local_path, s3_bucket, s3_path):
+from common import Struct
+from instrumentation import metrics
+from worker_pool import configure_concurrency
+from template_validator import validate_templates
+from git_index import get_blob_hash_cache_location
+from checksums import parse_checksum
+from s3_inventory import open_inventory_source
+from cfn_nag_runner import scan_templates, has_failures, format_report
+from artifact_packager import package_templates, plan_artifact
+from stack_linter import list_template_files
+from template_graph import build_template_graph, plan_template_levels
+
+
+def get_changed_files \
+(
+    local_path,
+    s3_bucket,
+    s3_path,
+    blob_hash_cache = None,
+    checksum = None,
+    semantic = False,
+    inventory = None
+):
 
     """
     Gets the list of local files that have changed in relation to the specified path into the S3 bucket
@@ -19,6 +38,10 @@ def get_changed_files(local_path, s3_bucket, s3_path):
     @:param local_path: The path to the local directory to compare with the files on S3
     @:param s3_bucket: The bucket on S3 to use for comparision
     @:param s3_path: The path to the s3 "directory" to compare with the local files
+    @:param blob_hash_cache: The location of the git blob hash cache to use, or None to hash files without git
+    @:param checksum: The checksum algorithm (see checksums.CHECKSUMS) to detect changes with, or None for MD5 ETags
+    @:param semantic: Whether to leave out files whose only changes are formatting, comments or key order
+    @:param inventory: The location of an S3 Inventory (see s3_inventory.open_inventory) to list the bucket from
 
     @:return: The list of changed files
     """
@@ -26,9 +49,25 @@ def get_changed_files(local_path, s3_bucket, s3_path):
     from s3_diff import S3Diff
     from file_set_loader import FileSetLoader
 
-    (local_set, s3_set) = FileSetLoader.get_file_sets(local_path, s3_bucket, s3_path)
+    (local_set, s3_set) = FileSetLoader.get_file_sets \
+    (
+        local_path,
+        s3_bucket,
+        s3_path,
+        blob_hash_cache = blob_hash_cache,
+        checksum = checksum,
+        inventory = None if inventory is None else open_inventory_source(s3_bucket, s3_path, inventory)
+    )
+
+    changed_files = S3Diff.get_local_files_changed(local_set, s3_set)
+
+    if semantic:
+
+        from semantic_hash import filter_semantic_changes
+
+        changed_files = filter_semantic_changes(local_path)(s3_bucket)(s3_path)(changed_files)(s3_set)
 
-    return S3Diff.get_local_files_changed(local_set, s3_set)
+    return changed_files
 
 
 def copy_files_to_dir(source_dir, dest_dir, file_list):
@@ -55,48 +94,65 @@ def copy_files_to_dir(source_dir, dest_dir, file_list):
         shutil.copy(source_file, dest_file)
 
 
-def validate_templates(file_list):
+def validate_changed_templates \
+(
+    local_path,
+    s3_bucket,
+    s3_path,
+    blob_hash_cache = None,
+    checksum = None,
+    semantic = False,
+    inventory = None,
+    cfn_nag = None,
+    package = False,
+    nested = False
+):
 
     """
-    Validates the files in file_list as AWS CloudFormation templates
+    Gets the list of changed local files in relation to a path into an S3 bucket and validates them as CloudFormation templates.
 
-    :param file_list: The list of files to validate
+    :param local_path: The path to the local directory to compare with the files on S3
+    :param s3_bucket: The bucket on S3 to use for comparision
+    :param s3_path: The path to the s3 "directory" to compare with the local files
+    :param blob_hash_cache: The location of the git blob hash cache to use, or None to hash files without git
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to detect changes with, or None for MD5 ETags
+    :param semantic: Whether to leave out files whose only changes are formatting, comments or key order
+    :param inventory: The location of an S3 Inventory (see s3_inventory.open_inventory) to list the bucket from
+    :param cfn_nag: The cache, processes and args to scan valid templates with cfn_nag, or None not to run cfn_nag
+    :param package: Whether to check the templates as a sync with --package would publish them (without uploading any
+                    artifacts), rather than as they are
+    :param nested: Whether to check that every nested stack template that templates point at exists, without cycles
     :return: Whether all files are valid templates or not
     """
 
-    valid = True
+    changed_path = local_path + "-changed"
 
-    client = boto3.client("cloudformation")
+    if package:
 
-    for file in file_list:
-
-        with open(file, "r") as file_data:
+        local_path = package_templates(local_path, local_path.rstrip("/") + "-packaged", s3_bucket, plan_artifact)
 
-            try:
+    if nested:
 
-                client.validate_template(TemplateBody = file_data.read())
-                print(f"{file} => Valid")
+        files = list_template_files(local_path)
+        graph = plan_template_levels(build_template_graph(local_path, files, [s3_bucket], s3_path), files)
 
-            except ClientError as error:
+        for error in graph.errors:
 
-                print(f"{file} => {error}")
-                valid = False
+            print(error)
 
-    return valid
+        if len(graph.errors) > 0:
 
+            return False
 
-def validate_changed_templates(local_path, s3_bucket, s3_path):
+    changed_files = get_changed_files(local_path, s3_bucket, s3_path, blob_hash_cache, checksum, semantic, inventory)
 
-    """
-    Gets the list of changed local files in relation to a path into an S3 bucket and validates them as CloudFormation templates.
+    if len(changed_files) == 0:
 
-    :param local_path: The path to the local directory to compare with the files on S3
-    :param s3_bucket: The bucket on S3 to use for comparision
-    :param s3_path: The path to the s3 "directory" to compare with the local files
-    :return: Whether all files are valid templates or not
-    """
+        # Nothing to validate, so skip creating a CloudFormation client but still leave an (empty) changed directory
+        print("No changed templates to validate")
+        copy_files_to_dir(local_path, changed_path, changed_files)
 
-    changed_files = get_changed_files(local_path, s3_bucket, s3_path)
+        return True
 
     valid = validate_templates  \
     (
@@ -111,13 +167,30 @@ def validate_changed_templates(local_path, s3_bucket, s3_path):
 
         try:
 
-            copy_files_to_dir(local_path, local_path + "-changed", changed_files)
+            copy_files_to_dir(local_path, changed_path, changed_files)
 
         except Exception as error:
 
             print(f"Copying files to temp directory failed => {error}")
             valid = False
 
+    if valid and cfn_nag is not None:
+
+        report = scan_templates \
+        (
+            local_path,
+            [item.file for item in changed_files],
+            cfn_nag.cache,
+            cfn_nag.processes,
+            args = cfn_nag.args
+        )
+
+        for line in format_report(report):
+
+            print(line)
+
+        valid = not has_failures(report)
+
     return valid
 
 
@@ -129,9 +202,101 @@ if __name__ == "__main__":
     parser.add_argument("local_path", help = "The path to the local directory to validate")
     parser.add_argument("s3_bucket", help = "The name of the s3 bucket to use to determine changed files")
     parser.add_argument("s3_path", help = "The path into the s3 bucket corresponding to local_path")
+    parser.add_argument("--trace-file", help = "Write a Chrome trace of the run's timings to this file")
+    parser.add_argument("--concurrency", type = int, default = 16, help = "The maximum number of AWS calls in flight")
+    parser.add_argument \
+    (
+        "--max-rate",
+        type = float,
+        help = "The maximum number of AWS calls started per second (default 10000), lowered further while AWS throttles"
+    )
+    parser.add_argument("--git-index", action = "store_true", help = "Look up file hashes by git blob SHA")
+    parser.add_argument("--blob-hash-cache", help = "The s3://bucket/key or local path of the git blob hash cache")
+    parser.add_argument \
+    (
+        "--checksum",
+        type = parse_checksum,
+        default = "md5",
+        help = "The checksum to detect changes with (md5, crc32c or sha256); must match the sync's --checksum"
+    )
+    parser.add_argument \
+    (
+        "--semantic-hash",
+        action = "store_true",
+        help = "Leave out templates whose only changes are formatting, comments or key order; must match the sync's"
+    )
+    parser.add_argument \
+    (
+        "--inventory",
+        help = "List the bucket from an S3 Inventory (s3://bucket/prefix or local path) instead of listing every key"
+    )
+    parser.add_argument \
+    (
+        "--cfn-nag",
+        action = "store_true",
+        help = "Scan the changed templates with cfn_nag, failing on any FAIL violation"
+    )
+    parser.add_argument("--cfn-nag-cache", help = "The s3://bucket/key or local path of the cfn_nag result cache")
+    parser.add_argument \
+    (
+        "--cfn-nag-args",
+        default = "",
+        help = "Extra arguments for every cfn_nag_scan invocation (e.g. \"--deny-list-path deny.yml\")"
+    )
+    parser.add_argument \
+    (
+        "--processes",
+        type = int,
+        help = "The maximum number of cfn_nag invocations to run at once (default: one per CPU)"
+    )
+    parser.add_argument \
+    (
+        "--package",
+        action = "store_true",
+        help = "Check the templates as automation-stack-sync.py --package would publish them, with local artifacts " +
+               "pointing at their content-hashed keys (nothing is uploaded); must match the sync's"
+    )
+    parser.add_argument \
+    (
+        "--nested-stacks",
+        action = "store_true",
+        help = "Fail if a nested stack TemplateURL points at a template that doesn't exist, or nesting is circular"
+    )
     args = parser.parse_args()
 
-    if validate_changed_templates(args.local_path, args.s3_bucket, args.s3_path):
+    configure_concurrency(args.concurrency, args.max_rate)
+
+    cfn_nag = None
+
+    if args.cfn_nag:
+
+        cfn_nag = Struct(cache = args.cfn_nag_cache, processes = args.processes, args = shlex.split(args.cfn_nag_args))
+
+    blob_hash_cache = get_blob_hash_cache_location(args.s3_bucket, args.blob_hash_cache) if args.git_index else None
+
+    valid = False
+
+    try:
+
+        valid = validate_changed_templates \
+        (
+            args.local_path,
+            args.s3_bucket,
+            args.s3_path,
+            blob_hash_cache,
+            args.checksum,
+            args.semantic_hash,
+            args.inventory,
+            cfn_nag,
+            args.package,
+            args.nested_stacks
+        )
+
+    finally:
+
+        metrics.report(args.trace_file)
+
+    if valid:
         exit(0)
     else:
         exit(1)
\ No newline at end of file
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""automation-stack-linter.py:
+This script lints the stack files under the stacks directory before they are synced, so that a broken stack file fails
+the build instead of its downstream deployment. Each stack file must be in a valid "<account>/<region>/" directory,
+reference a template that exists in the templates directory and have well-formed Parameters and Tags; optionally, the
+SSM parameters its SSM-typed parameters read must exist. Results are cached by file content, so only stack files that
+changed since an earlier run are parsed.
+"""
+import argparse
+from instrumentation import metrics
+from stack_linter import lint_stacks
+from worker_pool import configure_concurrency
+from ssm_checker import DEFAULT_SSM_CACHE_TTL, find_missing_parameters_template, get_ssm_client
+from ssm_checker import load_local_parameter_store, open_ssm_name_cache
+
+
+def get_changed_stack_files(stacks_path, s3_bucket, s3_path):
+
+    """
+    Gets the stack files that differ from their copies in the S3 bucket, as automation-linter-files-filter.py does for
+    templates
+
+    :param stacks_path: The path to the local stacks directory
+    :param s3_bucket: The bucket on S3 to compare with
+    :param s3_path: The path into the S3 bucket corresponding to stacks_path
+    :return: The set of changed stack file paths relative to stacks_path
+    """
+
+    from s3_diff import S3Diff
+    from file_set_loader import FileSetLoader
+
+    (local_set, s3_set) = FileSetLoader.get_file_sets(stacks_path, s3_bucket, s3_path)
+
+    return set(item.file for item in S3Diff.get_local_files_changed(local_set, s3_set))
+
+
+if __name__ == "__main__":
+
+    """Parses command-line parameters and returns 0 if every stack file is valid else 1"""
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("stacks_path", help = "The path to the local stacks directory to lint")
+    parser.add_argument("templates_path", help = "The path to the local templates directory stacks reference")
+    parser.add_argument("--trace-file", help = "Write a Chrome trace of the run's timings to this file")
+    parser.add_argument("--cache", help = "The s3://bucket/key or local path of the lint result cache")
+    parser.add_argument \
+    (
+        "--processes",
+        type = int,
+        help = "The number of worker processes to parse stack files with (default: one per CPU)"
+    )
+    parser.add_argument \
+    (
+        "--check-ssm",
+        action = "store_true",
+        help = "Check that the SSM parameters that SSM-typed stack parameters name exist"
+    )
+    parser.add_argument("--ssm-cache", help = "The s3://bucket/key or local path of the cache of SSM names that exist")
+    parser.add_argument \
+    (
+        "--ssm-cache-ttl",
+        type = float,
+        default = DEFAULT_SSM_CACHE_TTL,
+        help = "How long an SSM parameter that was seen to exist is trusted to still exist, in seconds"
+    )
+    parser.add_argument \
+    (
+        "--ssm-store",
+        help = "Check SSM names against a local JSON list of names instead of SSM (implies --check-ssm)"
+    )
+    parser.add_argument \
+    (
+        "--s3-bucket",
+        help = "Only check the SSM names of stack files that differ from their copies in this bucket"
+    )
+    parser.add_argument("--s3-path", default = "stacks", help = "The path into --s3-bucket corresponding to stacks_path")
+    parser.add_argument("--concurrency", type = int, default = 16, help = "The maximum number of AWS calls in flight")
+    parser.add_argument \
+    (
+        "--max-rate",
+        type = float,
+        help = "The maximum number of AWS calls started per second (default 10000), lowered further while AWS throttles"
+    )
+    args = parser.parse_args()
+
+    configure_concurrency(args.concurrency, args.max_rate)
+
+    errors = {}
+    ssm_cache = None
+    find_missing_parameters = None
+    changed_files = None
+
+    try:
+
+        if args.check_ssm or args.ssm_store is not None:
+
+            ssm_cache = None if args.ssm_cache is None else open_ssm_name_cache(args.ssm_cache, args.ssm_cache_ttl)
+            get_client_func = get_ssm_client
+
+            if args.ssm_store is not None:
+
+                store = load_local_parameter_store(args.ssm_store)
+                get_client_func = lambda: store
+
+            find_missing_parameters = find_missing_parameters_template(get_client_func)(ssm_cache)
+
+            if args.s3_bucket is not None:
+
+                changed_files = get_changed_stack_files(args.stacks_path, args.s3_bucket, args.s3_path)
+
+        errors = lint_stacks \
+        (
+            args.stacks_path,
+            args.templates_path,
+            args.cache,
+            args.processes,
+            find_missing_parameters,
+            changed_files
+        )
+
+        if ssm_cache is not None:
+
+            ssm_cache.save()
+
+    finally:
+
+        metrics.report(args.trace_file)
+
+    for file, file_errors in sorted(errors.items()):
+
+        for error in file_errors:
+
+            print(f"{file} => {error}")
+
+    if len(errors) == 0:
+        print("All stack files are valid")
+        exit(0)
+    else:
+        exit(1)
@@ -1,47 +1,793 @@
 #!/usr/bin/env python
 
 """automation-stack-sync.py:
-This script syncs the local directory to a given s3 bucket based on file hash alone. Any
-files missing locally but present on the S3 bucket will be removed from the s3 bucket.
+This script syncs the local directory to one or more s3 buckets based on file hash alone. Any
+files missing locally but present on the S3 bucket will be removed from the s3 bucket. Files whose content already
+exists elsewhere in the s3 path (e.g. moved files) are copied within S3 instead of being uploaded again.
 
 The purpose of this script is to ensure that whatever was in a given git repo, is what is in the s3 bucket.
 """
 
+import os
 import argparse
+from common import Struct
+from future import Future
 from s3_diff import S3Diff
-from s3_updater import S3Updater
+from s3_updater import S3Updater, MAX_COPY_OBJECT_SIZE
 from file_set_loader import FileSetLoader
+from instrumentation import metrics
+from worker_pool import configure_concurrency
+from git_index import get_blob_hash_cache_location
+from sharding import parse_shard
+from checksums import parse_checksum
+from semantic_hash import filter_semantic_changes, canonical_hasher
+from template_validator import ValidationGate, validate_template_file
+from publish_scheduler import PublishPacer, interleave_by_group
+from s3_inventory import parse_inventory, open_inventory_source, open_journal, journal_writer, touched_prefix
+from artifact_packager import package_templates
+from stack_index import INDEX_FILE, index_directory, is_index_file, group_stack_files, plan_indexes
+from stack_index import build_index, publish_indexes
+from template_graph import build_template_graph, plan_template_levels
 
 
-def sync_changes(local_path, s3_bucket, s3_path):
+def plan_changes(local_path, s3_bucket, s3_path, local_set, s3_set, semantic = False):
 
     """
-    Determines which files have changed and been deleted locally and syncs those changes to S3
+    Determines which files have to be deleted from, copied within and uploaded to one destination
 
     :param local_path: The path to the local directory to compare with the files on S3
     :param s3_bucket: The bucket on S3 to use for comparision
     :param s3_path: The path to the s3 "directory" to compare with the local files
-    :return: Nothing
+    :param local_set: The set of local files
+    :param s3_set: The set of files in the destination
+    :param semantic: Whether to skip uploading files whose only changes are formatting, comments or key order
+    :return: A Struct with the files to remove, update, copy (a dictionary of S3 sources) and upload
     """
 
-    (local_set, s3_set) = FileSetLoader.get_file_sets(local_path, s3_bucket, s3_path)
-
     files_to_update = S3Diff.get_local_files_changed(local_set, s3_set)
+
+    if semantic:
+
+        files_to_update = filter_semantic_changes(local_path)(s3_bucket)(s3_path)(files_to_update)(s3_set)
+
     files_to_remove = S3Diff.get_local_files_removed(local_set, s3_set)
+    files_to_copy = \
+    {
+        item: source
+        for item, source in S3Diff.get_local_files_copyable(files_to_update, s3_set).items()
+        if source.file_size is None or source.file_size <= MAX_COPY_OBJECT_SIZE
+    }
+
+    return Struct \
+    (
+        files_to_remove = files_to_remove,
+        files_to_update = files_to_update,
+        files_to_copy = files_to_copy,
+        files_to_upload = files_to_update.difference(files_to_copy)
+    )
+
+
+def apply_changes \
+(
+    local_path,
+    s3_bucket,
+    s3_path,
+    plan,
+    checksum = None,
+    semantic = False,
+    gate = None,
+    publish_rate = None,
+    journal = None,
+    indexes = None,
+    levels = None,
+    updater = S3Updater,
+    publish_indexes_func = publish_indexes
+):
+
+    """
+    Copies, deletes and uploads the planned changes to one destination. Copies and uploads are published round-robin
+    across "<account>/<region>" directories, optionally paced per directory. With a validation gate, each file is
+    uploaded as soon as it validates, and files are only deleted once every upload validated. With a journal, the
+    prefixes about to change are recorded first, so that the next listing from an S3 Inventory reconciles them. Any
+    indexes are published last, once the stack files they list are in place. With levels, files are uploaded one level
+    at a time (all of a level at once), and files above level 0 are uploaded in their level rather than copied first.
+
+    :param local_path: The path to the local directory to upload files from
+    :param s3_bucket: The bucket on S3 to sync
+    :param s3_path: The path to the s3 "directory" to sync
+    :param plan: The changes to make (see plan_changes)
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to upload with, or None
+    :param semantic: Whether to store canonical hashes on the uploaded files
+    :param gate: The template_validator.ValidationGate to pass each file through before uploading it, or None
+    :param publish_rate: The most files per second to publish to each "<account>/<region>" directory, or None
+    :param journal: The s3_inventory.TouchedPrefixJournal to record the changed prefixes in, or None
+    :param indexes: A dictionary of the bytes of each "<account>/<region>" index to write (None to delete it), or None
+    :param levels: A dictionary of the level of each file (see template_graph.plan_template_levels), or None
+    :param updater: The object whose copy_files, delete_files and upload_files make the changes (see S3Updater)
+    :param publish_indexes_func: The function that writes and deletes the indexes (see stack_index.publish_indexes)
+    :return: A Struct with the number of files copied, deleted and uploaded, any errors deleting and the number of
+             indexes published
+    """
+
+    files_to_copy = plan.files_to_copy
+    files_to_upload = set(plan.files_to_upload)
+    indexes = indexes or {}
+
+    def level_of(item):
+
+        return 0 if levels is None else levels.get(item.file.replace(os.path.sep, "/"), 0)
+
+    if levels is not None:
+
+        # Copies go before any upload, so a parent template is uploaded in its level instead, after its children
+        files_to_upload.update(item for item in files_to_copy if level_of(item) > 0)
+        files_to_copy = { item: source for item, source in files_to_copy.items() if level_of(item) == 0 }
+
+    if journal is not None:
+
+        journal.record \
+        (
+            [
+                touched_prefix(s3_path, item.file)
+                for item in plan.files_to_remove.union(plan.files_to_update)
+            ] +
+            [touched_prefix(s3_path, directory + "/" + INDEX_FILE) for directory in indexes]
+        )
+    sources = { item.file: source.file for item, source in files_to_copy.items() }
+
+    pacer = None if publish_rate is None else PublishPacer(publish_rate)
+
+    # Copies go first, as their sources may be files that are about to be deleted (never overwritten, see S3Diff)
+    not_copied = updater.copy_files \
+    (
+        [(s3_path + "/" + sources[file], s3_path + "/" + file) for file in interleave_by_group(sources)],
+        s3_bucket,
+        checksum,
+        None if pacer is None else lambda copy_list: pacer.paced(copy_list, lambda keys: keys[1][len(s3_path) + 1:])
+    )
+
+    # Upload anything whose copy source was deleted in the meantime (e.g. by a concurrent sync of the same path)
+    not_copied_keys = set(key for source_key, key in not_copied)
+    files_to_upload.update(item for item in files_to_copy if s3_path + "/" + item.file in not_copied_keys)
+
+    def delete_files():
+
+        return updater.delete_files(map(lambda item: s3_path + "/" + item.file, plan.files_to_remove), s3_bucket)
+
+    def upload_files():
+
+        uploads_by_level = {}
+
+        for item in files_to_upload:
+
+            uploads_by_level.setdefault(level_of(item), []).append(item.file)
+
+        # Each level is uploaded all at once, but only once every level below it has landed
+        for level in sorted(uploads_by_level):
+
+            updater.upload_files \
+            (
+                interleave_by_group(uploads_by_level[level]),
+                local_path,
+                s3_bucket,
+                s3_path,
+                checksum,
+                canonical_hasher.hash_bytes if semantic else None,
+                gate,
+                None if pacer is None else pacer.paced
+            )
+
+    if gate is None:
+
+        deleted = delete_files()
+        upload_files()
+
+    else:
+
+        # Copied content is already published elsewhere in the path, so only uploads need validating
+        upload_files()
+
+        if not gate.passed():
+
+            print(f"Templates failed validation, so nothing was deleted from s3://{s3_bucket}/{s3_path}")
+            raise ValueError(f"invalid templates: {', '.join(sorted(gate.invalid))}")
+
+        deleted = delete_files()
+
+    return Struct \
+    (
+        copied = len(files_to_copy) - len(not_copied),
+        deleted = len(deleted.deleted),
+        uploaded = len(files_to_upload),
+        errors = deleted.errors,
+        indexed = 0 if len(indexes) == 0 else publish_indexes_func(s3_bucket, s3_path, indexes)
+    )
+
+
+def sync_changes \
+(
+    local_path,
+    s3_buckets,
+    s3_path,
+    blob_hash_cache = None,
+    shard = None,
+    checksum = None,
+    semantic = False,
+    validate = False,
+    publish_rate = None,
+    inventories = None,
+    index = False,
+    nested = False,
+    get_bucket_file_sets_func = FileSetLoader.get_bucket_file_sets,
+    updater = S3Updater,
+    validate_func = validate_template_file,
+    publish_indexes_func = publish_indexes,
+    open_journal_func = open_journal
+):
+
+    """
+    Determines which files have changed and been deleted locally and syncs those changes to one or more S3 buckets.
+    The local directory is walked and hashed once; the buckets are listed concurrently, and each bucket's changes are
+    applied concurrently on the shared worker pool.
+
+    :param local_path: The path to the local directory to compare with the files on S3
+    :param s3_buckets: The bucket on S3 to use for comparision, or a list (or comma-separated string) of buckets
+    :param s3_path: The path to the s3 "directory" to compare with the local files
+    :param blob_hash_cache: The location of the git blob hash cache to use, or None to hash files without git
+    :param shard: The shard (see sharding.parse_shard) of top-level directories to sync, or None to sync them all
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to detect changes with, or None for MD5 ETags
+    :param semantic: Whether to skip uploading files whose only changes are formatting, comments or key order
+    :param validate: Whether to validate each file as a CloudFormation template just before uploading it, failing
+                     (without deleting anything) if any file is invalid
+    :param publish_rate: The most files per second to publish to each "<account>/<region>" directory, or None
+    :param inventories: A dictionary of the S3 Inventory location (see s3_inventory.open_inventory) to list each bucket
+                        from, with a None key for the location to use when only one bucket is synced. Every bucket
+                        journals the prefixes it changes whether or not it has one, so that later inventory listings
+                        see every sync's changes.
+    :param index: Whether to keep an "<account>/<region>/_index.json" object listing the stack files in each directory,
+                  rewriting only the indexes that differ from the ones built from the local files (or are missing)
+    :param nested: Whether to publish templates in levels, so that nested stack templates land before the templates
+                   whose TemplateURLs point at them; missing nested templates and cycles fail before anything changes
+    :param get_bucket_file_sets_func: The function that lists the local and S3 files (see FileSetLoader)
+    :param updater: The object whose copy_files, delete_files and upload_files make the changes (see S3Updater)
+    :param validate_func: The function that validates a template file (see template_validator)
+    :param publish_indexes_func: The function that writes and deletes the indexes (see stack_index.publish_indexes)
+    :param open_journal_func: The function that opens the journal of a bucket's path (see s3_inventory.open_journal)
+    :return: A dictionary of the results (see apply_changes) for each bucket that changed
+    """
+
+    if isinstance(s3_buckets, str):
+
+        s3_buckets = [s3_bucket.strip() for s3_bucket in s3_buckets.split(",") if s3_bucket.strip() != ""]
+
+    inventories = dict(inventories or {})
+
+    if None in inventories:
+
+        if len(s3_buckets) > 1:
+
+            raise ValueError("each inventory must name its bucket (bucket=location) when syncing several buckets")
+
+        inventories.setdefault(s3_buckets[0], inventories.pop(None))
+
+    sources = \
+    {
+        s3_bucket: open_inventory_source(s3_bucket, s3_path, location, shard)
+        for s3_bucket, location in inventories.items()
+    }
+
+    (local_set, s3_sets) = get_bucket_file_sets_func \
+    (
+        local_path,
+        s3_buckets,
+        s3_path,
+        blob_hash_cache = blob_hash_cache,
+        shard = shard,
+        checksum = checksum,
+        inventories = sources
+    )
+
+    levels = None
+
+    if nested:
+
+        if shard is not None:
+
+            raise ValueError("nested stack templates can be in any shard, so nested ordering can't sync a shard")
+
+        files = [item.file for item in local_set]
+        graph = plan_template_levels(build_template_graph(local_path, files, s3_buckets, s3_path), files)
+
+        for error in graph.errors:
+
+            print(error)
+
+        if len(graph.errors) > 0:
+
+            raise ValueError(f"{len(graph.errors)} nested stack errors, so nothing was published")
+
+        levels = graph.levels
+
+    index_contents = {}
+    indexed_directories = {}
+
+    if index:
+
+        reserved = sorted(item.file for item in local_set if is_index_file(item.file))
+
+        if len(reserved) > 0:
+
+            raise ValueError(f"{', '.join(reserved)}: {INDEX_FILE} is reserved for the stack indexes")
+
+        # Each index only depends on the local files, so it is built once however many buckets it is written to
+        index_contents = \
+        {
+            directory: build_index(local_path, files)
+            for directory, files in group_stack_files(local_set).items()
+        }
+
+        # Indexes aren't local files, so they're left out of the comparison instead of being deleted
+        for s3_bucket, s3_set in s3_sets.items():
+
+            indexed_directories[s3_bucket] = \
+                { index_directory(item.file): item.file_hash for item in s3_set if is_index_file(item.file) }
+            s3_sets[s3_bucket] = set(item for item in s3_set if not is_index_file(item.file))
+
+    plans = {}
+    index_plans = {}
+
+    for s3_bucket in s3_buckets:
+
+        plan = plan_changes(local_path, s3_bucket, s3_path, local_set, s3_sets[s3_bucket], semantic)
+
+        if index:
+
+            index_plans[s3_bucket] = plan_indexes(index_contents, indexed_directories[s3_bucket], checksum)
+
+        if len(s3_buckets) > 1:
+
+            print(f"Destination s3://{s3_bucket}/{s3_path}")
+
+        print ("Stacks to Delete: ", set(map(lambda i: i.file, plan.files_to_remove)))
+        print ("Stacks to Update: ", set(map(lambda i: i.file, plan.files_to_update)))
+        print ("Stacks to Copy:   ", { item.file: source.file for item, source in plan.files_to_copy.items() })
+
+        if index:
+
+            print ("Indexes to Write: ", index_plans[s3_bucket].write)
+            print ("Indexes to Delete:", index_plans[s3_bucket].delete)
+
+        # Buckets where nothing changed don't need the clients for deleting and uploading
+        if len(plan.files_to_remove) > 0 or len(plan.files_to_update) > 0 or \
+           (index and len(index_plans[s3_bucket].write) + len(index_plans[s3_bucket].delete) > 0):
+
+            plans[s3_bucket] = plan
+
+    # Every bucket shares one gate, so each file is validated once however many buckets it is uploaded to
+    gate = ValidationGate(validate_func) if validate else None
 
-    print ("Stacks to Delete: ", set(map(lambda i: i.file, files_to_remove)))
-    print ("Stacks to Update: ", set(map(lambda i: i.file, files_to_update)))
+    # Applies every bucket's changes at once; their copies, deletes and uploads all share the worker pool
+    futures = \
+    {
+        s3_bucket: Future
+        (
+            apply_changes,
+            (
+                local_path,
+                s3_bucket,
+                s3_path,
+                plan,
+                checksum,
+                semantic,
+                gate,
+                publish_rate,
+                sources[s3_bucket].journal if s3_bucket in sources else \
+                    open_journal_func(s3_bucket, s3_path, journal_writer(shard)),
+                None if s3_bucket not in index_plans else dict
+                (
+                    [(directory, index_contents[directory]) for directory in index_plans[s3_bucket].write] +
+                    [(directory, None) for directory in index_plans[s3_bucket].delete]
+                ),
+                levels,
+                updater,
+                publish_indexes_func
+            )
+        )
+        for s3_bucket, plan in plans.items()
+    }
 
-    S3Updater.delete_files(map(lambda item: s3_path + "/" + item.file, files_to_remove), s3_bucket)
-    S3Updater.upload_files(map(lambda item: item.file, files_to_update), local_path, s3_bucket, s3_path)
+    Future.wait_all(*futures.values())
+
+    for s3_bucket, future in futures.items():
+
+        if future.has_failed():
+
+            print(f"Syncing s3://{s3_bucket}/{s3_path} failed => {future.error}")
+
+        else:
+
+            result = future.result
+            print(f"Synced s3://{s3_bucket}/{s3_path}: {result.copied} copied, {result.deleted} deleted, " +
+                  f"{result.uploaded} uploaded, {len(result.errors)} delete errors, {result.indexed} indexes published")
+
+            metrics.count(f"destinations.{s3_bucket}.uploaded", result.uploaded)
+            metrics.count(f"destinations.{s3_bucket}.copied", result.copied)
+            metrics.count(f"destinations.{s3_bucket}.deleted", result.deleted)
+
+    # Every destination has been reported, so raise the first failure (if any)
+    for future in futures.values():
+
+        if future.has_failed():
+
+            raise future.error
+
+    return { s3_bucket: future.result for s3_bucket, future in futures.items() }
+
+
+class PyTests:
+
+    @staticmethod
+    def make_buckets(failing_buckets = ()):
+
+        """
+        Builds in-memory buckets and the sync_changes arguments that read and write them, recording each call to them
+        in order
+        """
+
+        from file_set_loader import Item, hash_file
+
+        buckets = {}
+        events = []
+        journals = {}
+
+        def my_get_bucket_file_sets(local_path, s3_buckets, s3_path, **kwargs):
+
+            local_set = set \
+            (
+                Item("", os.path.relpath(os.path.join(root, name), local_path).replace(os.sep, "/"),
+                     hash_file(os.path.join(root, name)), os.path.getsize(os.path.join(root, name)))
+                for root, dir_names, file_names in os.walk(local_path)
+                for name in file_names
+            )
+            s3_sets = \
+            {
+                s3_bucket: set \
+                (
+                    Item("", key[len(s3_path) + 1:], value[0], value[1])
+                    for key, value in buckets.setdefault(s3_bucket, {}).items()
+                    if key.startswith(s3_path + "/")
+                )
+                for s3_bucket in s3_buckets
+            }
+
+            return local_set, s3_sets
+
+        def my_upload_files(files, local_path, s3_bucket, s3_path, checksum, canonical_hash_func, gate_func, pace_func):
+
+            files = list(files if pace_func is None else pace_func(files))
+            events.append(("upload", s3_bucket, sorted(files)))
+
+            if s3_bucket in failing_buckets:
+
+                raise RuntimeError(f"{s3_bucket} is unavailable")
+
+            for file in files:
+
+                if gate_func is None or gate_func(os.path.join(local_path, file)):
+
+                    buckets[s3_bucket][s3_path + "/" + file] = \
+                        (hash_file(os.path.join(local_path, file)), os.path.getsize(os.path.join(local_path, file)))
+
+        def my_copy_files(copy_list, s3_bucket, checksum, pace_func):
+
+            copy_list = list(copy_list if pace_func is None else pace_func(copy_list))
+            events.append(("copy", s3_bucket, sorted(copy_list)))
+
+            for source_key, key in copy_list:
+
+                buckets[s3_bucket][key] = buckets[s3_bucket][source_key]
+
+            return []
+
+        def my_delete_files(keys, s3_bucket):
+
+            keys = sorted(keys)
+            events.append(("delete", s3_bucket, keys))
+
+            for key in keys:
+
+                del buckets[s3_bucket][key]
+
+            return Struct(deleted = [{ "Key": key } for key in keys], errors = [])
+
+        def my_publish_indexes(s3_bucket, s3_path, indexes):
+
+            for directory in sorted(indexes):
+
+                key = f"{s3_path}/{directory}/{INDEX_FILE}"
+                events.append(("index", s3_bucket, key))
+                buckets[s3_bucket][key] = ("index", len(indexes[directory]))
+
+            return len(indexes)
+
+        arguments = \
+        {
+            "get_bucket_file_sets_func": my_get_bucket_file_sets,
+            "updater": Struct \
+            (
+                upload_files = my_upload_files,
+                copy_files = my_copy_files,
+                delete_files = my_delete_files
+            ),
+            "publish_indexes_func": my_publish_indexes,
+            "open_journal_func": lambda s3_bucket, s3_path, writer: journals.setdefault \
+            (
+                s3_bucket,
+                Struct(touched = [], record = lambda prefixes: journals[s3_bucket].touched.extend(sorted(prefixes)))
+            )
+        }
+
+        return buckets, events, arguments, journals
+
+    @staticmethod
+    def test_sync_changes_applies_each_buckets_own_changes(tmp_path):
+
+        from file_set_loader import hash_file
+
+        buckets, events, arguments, journals = PyTests.make_buckets()
+        (tmp_path / "a.yaml").write_text("a")
+        (tmp_path / "b.yaml").write_text("b")
+        (tmp_path / "c.yaml").write_text("c")
+        buckets["dr"] = \
+        {
+            "stacks/a.yaml": (hash_file(str(tmp_path / "a.yaml")), 1),
+            "stacks/old-b.yaml": (hash_file(str(tmp_path / "b.yaml")), 1),
+            "stacks/stale.yaml": ("x", 1)
+        }
+
+        results = sync_changes(str(tmp_path), "main,dr", "stacks", **arguments)
+
+        assert sorted(buckets["main"]) == sorted(buckets["dr"]) == ["stacks/a.yaml", "stacks/b.yaml", "stacks/c.yaml"]
+        assert [event for event in events if event[1] == "main"] == \
+            [("copy", "main", []), ("delete", "main", []), ("upload", "main", ["a.yaml", "b.yaml", "c.yaml"])]
+        assert [event for event in events if event[1] == "dr"] == \
+        [
+            ("copy", "dr", [("stacks/old-b.yaml", "stacks/b.yaml")]),
+            ("delete", "dr", ["stacks/old-b.yaml", "stacks/stale.yaml"]),
+            ("upload", "dr", ["c.yaml"])
+        ]
+        assert (results["dr"].copied, results["dr"].deleted, results["dr"].uploaded) == (1, 2, 1)
+
+        # Every bucket journals what it changes, even without an inventory, so later inventory listings see it
+        assert journals["main"].touched == ["stacks/a.yaml", "stacks/b.yaml", "stacks/c.yaml"]
+        assert journals["dr"].touched == ["stacks/b.yaml", "stacks/c.yaml", "stacks/old-b.yaml", "stacks/stale.yaml"]
+
+        # Buckets that are already in sync aren't touched
+        events.clear()
+
+        assert sync_changes(str(tmp_path), "main,dr", "stacks", **arguments) == {}
+        assert events == []
+
+    @staticmethod
+    def test_sync_changes_validates_once_for_every_bucket_and_reports_every_failure(tmp_path):
+
+        buckets, events, arguments, journals = PyTests.make_buckets(failing_buckets = ["dr"])
+        (tmp_path / "t.yaml").write_text("Resources: {}")
+        validated = []
+
+        def my_validate(file):
+            validated.append(os.path.basename(file))
+            return True
+
+        try:
+            sync_changes(str(tmp_path), "main,dr,dr2", "templates", validate = True, validate_func = my_validate,
+                         **arguments)
+            assert False
+        except RuntimeError as error:
+            assert str(error) == "dr is unavailable"
+
+        # The other buckets were still synced, and the shared gate validated the template once for both
+        assert sorted(buckets["main"]) == sorted(buckets["dr2"]) == ["templates/t.yaml"]
+        assert buckets["dr"] == {}
+        assert validated == ["t.yaml"]
+
+    @staticmethod
+    def test_sync_changes_publishes_indexes_after_the_stack_files(tmp_path):
+
+        import hashlib
+
+        buckets, events, arguments, journals = PyTests.make_buckets()
+        (tmp_path / "123456789012" / "us-east-1").mkdir(parents = True)
+        (tmp_path / "123456789012" / "us-east-1" / "s.yaml").write_text("Template: t.yaml\n")
+
+        results = sync_changes(str(tmp_path), "main", "stacks", index = True, **arguments)
+
+        assert [event[0] for event in events] == ["copy", "delete", "upload", "index"]
+        assert events[-1] == ("index", "main", "stacks/123456789012/us-east-1/" + INDEX_FILE)
+        assert results["main"].indexed == 1
+
+        # The index isn't a local file, so the next sync neither deletes nor rewrites it
+        events.clear()
+        index_key = "stacks/123456789012/us-east-1/" + INDEX_FILE
+        index_bytes = build_index(str(tmp_path), ["123456789012/us-east-1/s.yaml"])
+        buckets["main"][index_key] = (hashlib.md5(index_bytes).hexdigest(), len(index_bytes))
+
+        assert sync_changes(str(tmp_path), "main", "stacks", index = True, **arguments) == {}
+        assert events == []
+
+        # An index left stale (e.g. by a sync that failed before publishing it) is rewritten though no file changed
+        buckets["main"][index_key] = ("stale", len(index_bytes))
+        results = sync_changes(str(tmp_path), "main", "stacks", index = True, **arguments)
+
+        assert [event[0] for event in events] == ["copy", "delete", "index"]
+        assert (results["main"].uploaded, results["main"].indexed) == (0, 1)
+
+    @staticmethod
+    def test_sync_changes_uploads_nested_templates_children_first(tmp_path):
+
+        buckets, events, arguments, journals = PyTests.make_buckets()
+        url = "https://${Bucket}.s3.${AWS::Region}.amazonaws.com/templates/"
+
+        def nested(*children):
+            return "Resources:\n" + "".join \
+            (
+                f"  S{index}:\n    Type: AWS::CloudFormation::Stack\n    Properties:\n" +
+                f"      TemplateURL: !Sub {url}{child}\n"
+                for index, child in enumerate(children)
+            )
+
+        (tmp_path / "leaf.yaml").write_text("Resources: {}\n")
+        (tmp_path / "mid.yaml").write_text(nested("leaf.yaml"))
+        (tmp_path / "top.yaml").write_text(nested("mid.yaml", "leaf.yaml"))
+
+        sync_changes(str(tmp_path), "main", "templates", nested = True, **arguments)
+
+        assert [event for event in events if event[0] == "upload"] == \
+        [
+            ("upload", "main", ["leaf.yaml"]),
+            ("upload", "main", ["mid.yaml"]),
+            ("upload", "main", ["top.yaml"])
+        ]
+
+        # A parent whose content is already in the bucket is uploaded in its level rather than copied before its child
+        events.clear()
+        (tmp_path / "leaf.yaml").write_text("Resources: { A: 1 }\n")
+        (tmp_path / "top2.yaml").write_text(nested("mid.yaml", "leaf.yaml"))
+
+        sync_changes(str(tmp_path), "main", "templates", nested = True, **arguments)
+
+        assert [event for event in events if event[0] in ("copy", "upload")] == \
+            [("copy", "main", []), ("upload", "main", ["leaf.yaml"]), ("upload", "main", ["top2.yaml"])]
+
+        (tmp_path / "leaf.yaml").write_text(nested("top.yaml"))
+
+        try:
+            sync_changes(str(tmp_path), "main", "templates", nested = True, **arguments)
+            assert False
+        except ValueError as error:
+            assert str(error) == "4 nested stack errors, so nothing was published"
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("local_path", help = "The path to the local directory to validate")
-    parser.add_argument("s3_bucket", help = "The name of the s3 bucket to use to determine changed files")
+    parser.add_argument \
+    (
+        "s3_bucket",
+        help = "The name of the s3 bucket to sync, or a comma-separated list of buckets to sync from one enumeration"
+    )
     parser.add_argument("s3_path", help = "The path into the s3 bucket corresponding to local_path")
+    parser.add_argument("--trace-file", help = "Write a Chrome trace of the run's timings to this file")
+    parser.add_argument("--concurrency", type = int, default = 16, help = "The maximum number of AWS calls in flight")
+    parser.add_argument \
+    (
+        "--max-rate",
+        type = float,
+        help = "The maximum number of AWS calls started per second (default 10000), lowered further while AWS throttles"
+    )
+    parser.add_argument("--git-index", action = "store_true", help = "Look up file hashes by git blob SHA")
+    parser.add_argument("--blob-hash-cache", help = "The s3://bucket/key or local path of the git blob hash cache")
+    parser.add_argument \
+    (
+        "--shard",
+        type = parse_shard,
+        help = "Only sync shard i/N of the top-level directories (e.g. 0/4), for splitting a sync across workers"
+    )
+    parser.add_argument \
+    (
+        "--checksum",
+        type = parse_checksum,
+        default = "md5",
+        help = "The checksum to detect changes with: md5 (ETags), or crc32c or sha256 (S3 additional checksums, " +
+               "which also work for multipart uploads and SSE-KMS buckets)"
+    )
+    parser.add_argument \
+    (
+        "--semantic-hash",
+        action = "store_true",
+        help = "Skip uploading YAML/JSON files whose only changes are formatting, comments or key order"
+    )
+    parser.add_argument \
+    (
+        "--validate",
+        action = "store_true",
+        help = "Validate each changed template just before uploading it, and fail without deleting anything if any " +
+               "template is invalid (replaces running automation-linter-files-filter.py first)"
+    )
+    parser.add_argument \
+    (
+        "--publish-rate",
+        type = float,
+        help = "The most files per second to copy or upload to each <account>/<region> directory, to pace the " +
+               "deployments they trigger"
+    )
+    parser.add_argument \
+    (
+        "--inventory",
+        type = parse_inventory,
+        action = "append",
+        help = "List the bucket from an S3 Inventory ([bucket=]s3://bucket/prefix or local path of the inventory " +
+               "configuration, or of one run's manifest.json) instead of listing every key; repeat for each bucket"
+    )
+    parser.add_argument \
+    (
+        "--package",
+        action = "store_true",
+        help = "Zip and upload the local artifacts (e.g. a CodeUri directory) templates refer to under artifacts/ by " +
+               "content hash, and sync a copy of local_path (local_path-packaged) that points at them instead"
+    )
+    parser.add_argument \
+    (
+        "--index",
+        action = "store_true",
+        help = "Keep an <account>/<region>/_index.json object listing the path, template and MD5 (of the local " +
+               "file) of each stack file there, rewriting only the indexes that are missing or out of date"
+    )
+    parser.add_argument \
+    (
+        "--nested-stacks",
+        action = "store_true",
+        help = "Upload templates in levels, nested stack templates before the templates whose TemplateURLs point at " +
+               "them, and fail before publishing anything if a nested template is missing or nesting is circular"
+    )
     args = parser.parse_args()
 
-    sync_changes(args.local_path, args.s3_bucket, args.s3_path)
\ No newline at end of file
+    if args.package and "," in args.s3_bucket:
+
+        # Lambda code must be in the stack's region, so one set of packaged templates can't serve every bucket
+        parser.error("--package can only sync one bucket")
+
+    configure_concurrency(args.concurrency, args.max_rate)
+
+    # The blob hash cache lives in the first bucket unless it is placed elsewhere
+    cache_bucket = args.s3_bucket.split(",")[0].strip()
+    blob_hash_cache = get_blob_hash_cache_location(cache_bucket, args.blob_hash_cache) if args.git_index else None
+
+    try:
+
+        local_path = args.local_path
+
+        if args.package:
+
+            local_path = package_templates(local_path, local_path.rstrip("/") + "-packaged", cache_bucket)
+
+        sync_changes \
+        (
+            local_path,
+            args.s3_bucket,
+            args.s3_path,
+            blob_hash_cache,
+            args.shard,
+            args.checksum,
+            args.semantic_hash,
+            args.validate,
+            args.publish_rate,
+            dict(args.inventory or []),
+            args.index,
+            args.nested_stacks
+        )
+
+    finally:
+
+        metrics.report(args.trace_file)
\ No newline at end of file
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""automation-sync-daemon.py:
+This script keeps local directories synced to an s3 bucket for as long as it runs, for environments (e.g. staging)
+that would otherwise re-run automation-stack-sync.py on a timer. The local directories and the bucket are indexed in
+memory once; after that, the directories are watched (with inotify where available), and each burst of changes only
+uploads or deletes the paths that changed. The bucket is listed again at an interval to pick up any other changes.
+Like the sync's --validate and --index, chosen trees can have their uploads validated as templates first, and keep the
+"<account>/<region>/_index.json" stack indexes up to date.
+"""
+
+import signal
+import argparse
+from worker_pool import configure_concurrency
+from sync_daemon import SyncTree, SyncDaemon, open_watcher
+
+
+def parse_tree(value):
+
+    """
+    Parses a tree of the form "local_path[:s3_path]"
+
+    :param value: The tree
+    :return: A (local path, s3 path) tuple; the s3 path defaults to the local path
+    """
+
+    local_path, _, s3_path = value.partition(":")
+
+    return local_path, (s3_path or local_path).strip("/")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("s3_bucket", help = "The name of the s3 bucket to sync")
+    parser.add_argument \
+    (
+        "trees",
+        nargs = "+",
+        type = parse_tree,
+        help = "The local_path[:s3_path] directories to sync, in the order to push them (e.g. templates stacks)"
+    )
+    parser.add_argument("--concurrency", type = int, default = 16, help = "The maximum number of AWS calls in flight")
+    parser.add_argument \
+    (
+        "--max-rate",
+        type = float,
+        help = "The maximum number of AWS calls started per second (default 10000), lowered further while AWS throttles"
+    )
+    parser.add_argument \
+    (
+        "--debounce",
+        type = float,
+        default = 0.5,
+        help = "Push once no change has arrived for this many seconds"
+    )
+    parser.add_argument \
+    (
+        "--max-delay",
+        type = float,
+        default = 5.0,
+        help = "Push a continuous stream of changes at least this often, in seconds"
+    )
+    parser.add_argument \
+    (
+        "--refresh-interval",
+        type = float,
+        default = 300.0,
+        help = "List the bucket again and reconcile everything this often, in seconds"
+    )
+    parser.add_argument \
+    (
+        "--poll-interval",
+        type = float,
+        help = "Poll for changes at this interval, in seconds, instead of using inotify"
+    )
+    parser.add_argument \
+    (
+        "--validate",
+        action = "append",
+        default = [],
+        metavar = "S3_PATH",
+        help = "Validate the files the tree synced to this path uploads as templates first (e.g. templates)"
+    )
+    parser.add_argument \
+    (
+        "--index",
+        action = "append",
+        default = [],
+        metavar = "S3_PATH",
+        help = "Keep an <account>/<region>/_index.json object in the tree synced to this path (e.g. stacks)"
+    )
+    args = parser.parse_args()
+
+    s3_paths = [s3_path for local_path, s3_path in args.trees]
+
+    for s3_path in args.validate + args.index:
+
+        if s3_path.strip("/") not in s3_paths:
+
+            parser.error(f"{s3_path} is not the s3 path of any of the trees ({', '.join(s3_paths)})")
+
+    configure_concurrency(args.concurrency, args.max_rate)
+
+    trees = \
+    [
+        SyncTree \
+        (
+            local_path,
+            s3_path,
+            validate = s3_path in [path.strip("/") for path in args.validate],
+            index = s3_path in [path.strip("/") for path in args.index]
+        )
+        for local_path, s3_path in args.trees
+    ]
+    daemon = SyncDaemon \
+    (
+        args.s3_bucket,
+        trees,
+        open_watcher([tree.local_path for tree in trees], args.poll_interval),
+        args.debounce,
+        args.max_delay,
+        args.refresh_interval
+    )
+
+    stopping = []
+
+    # Stop between bursts, so that a push is never cut off part way through
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+
+    try:
+
+        daemon.run(lambda: len(stopping) > 0)
+
+    except KeyboardInterrupt:
+
+        pass
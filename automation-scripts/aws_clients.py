@@ -0,0 +1,228 @@
+import threading
+from instrumentation import instrument_client
+from rate_controller import controller
+
+
+# Services whose shared client is the client behind their shared resource, so both use one connection pool
+RESOURCE_BACKED_SERVICES = { "s3" }
+
+# Connections kept on top of the configured concurrency for calls made outside the worker pool (e.g. listing)
+POOL_HEADROOM = 4
+
+
+class ClientRegistry:
+
+    """
+    Lazily creates the boto3 clients and resources used by the automation scripts and shares them between modules.
+    boto3 is only imported when the first client is actually needed, so runs and tests that never call AWS don't pay
+    for importing it. Every client comes from a single boto3 session, so credentials are resolved once, and each
+    client's connection pool is sized for the configured concurrency.
+    """
+
+    def __init__(self, max_pool_connections = controller.max_concurrency + POOL_HEADROOM):
+
+        self.lock = threading.Lock()
+        self.max_pool_connections = max_pool_connections
+        self.session = None
+        self.clients = {}
+        self.resources = {}
+
+    def configure(self, concurrency):
+
+        """
+        Sizes the connection pools for a number of concurrent calls, replacing any clients created so far
+
+        :param concurrency: The maximum number of AWS calls in flight at once
+        :return: Nothing
+        """
+
+        with self.lock:
+
+            self.max_pool_connections = concurrency + POOL_HEADROOM
+            self.clients = {}
+            self.resources = {}
+
+    def get_session(self):
+
+        """Returns the shared boto3 session, creating it on first use"""
+
+        if self.session is None:
+
+            import boto3.session
+
+            self.session = boto3.session.Session()
+
+        return self.session
+
+    def get_config(self):
+
+        """Returns the botocore configuration shared by every client"""
+
+        from botocore.config import Config
+
+        return controller.botocore_config().merge(Config(max_pool_connections = self.max_pool_connections))
+
+    def build_client(self, service):
+
+        """Builds an instrumented client from the shared session; the caller must hold the lock"""
+
+        return instrument_client(self.get_session().client(service, config = self.get_config()))
+
+    def build_resource(self, service):
+
+        """Builds a resource with an instrumented client from the shared session; the caller must hold the lock"""
+
+        resource = self.get_session().resource(service, config = self.get_config())
+        instrument_client(resource.meta.client)
+
+        return resource
+
+    def create_client(self, service):
+
+        """
+        Creates a new, unshared client for an AWS service
+
+        :param service: The name of the AWS service (e.g. "s3")
+        :return: A boto3 client
+        """
+
+        with self.lock:
+
+            return self.build_client(service)
+
+    def create_resource(self, service):
+
+        """
+        Creates a new, unshared resource for an AWS service
+
+        :param service: The name of the AWS service (e.g. "s3")
+        :return: A boto3 service resource
+        """
+
+        with self.lock:
+
+            return self.build_resource(service)
+
+    def get_client(self, service):
+
+        """
+        Returns the shared client for an AWS service, creating it on first use
+
+        :param service: The name of the AWS service (e.g. "s3")
+        :return: A boto3 client
+        """
+
+        if service in RESOURCE_BACKED_SERVICES:
+
+            return self.get_resource(service).meta.client
+
+        with self.lock:
+
+            if service not in self.clients:
+
+                self.clients[service] = self.build_client(service)
+
+            return self.clients[service]
+
+    def get_resource(self, service):
+
+        """
+        Returns the shared resource for an AWS service, creating it on first use
+
+        :param service: The name of the AWS service (e.g. "s3")
+        :return: A boto3 service resource
+        """
+
+        with self.lock:
+
+            if service not in self.resources:
+
+                self.resources[service] = self.build_resource(service)
+
+            return self.resources[service]
+
+    def clear(self):
+
+        """Forgets every shared client and resource so that the next request creates new ones"""
+
+        with self.lock:
+
+            self.clients = {}
+            self.resources = {}
+
+
+# The client registry shared by every module during a run
+registry = ClientRegistry()
+
+
+class PyTests:
+
+    @staticmethod
+    def test_get_client_shares_one_client_per_service():
+
+        clients = ClientRegistry()
+
+        assert clients.get_client("sts") is clients.get_client("sts")
+        assert list(clients.clients) == ["sts"]
+
+    @staticmethod
+    def test_get_resource_shares_one_resource_per_service():
+
+        clients = ClientRegistry()
+
+        assert clients.get_resource("s3") is clients.get_resource("s3")
+
+    @staticmethod
+    def test_s3_client_and_resource_share_one_client():
+
+        clients = ClientRegistry()
+
+        assert clients.get_client("s3") is clients.get_resource("s3").meta.client
+
+    @staticmethod
+    def test_clients_come_from_one_session():
+
+        clients = ClientRegistry()
+        clients.get_client("s3")
+        session = clients.session
+        clients.get_client("sts")
+
+        assert clients.session is session
+
+    @staticmethod
+    def test_configure_sizes_connection_pools_for_the_concurrency():
+
+        clients = ClientRegistry()
+        client = clients.get_client("s3")
+        clients.configure(32)
+
+        assert clients.get_client("s3") is not client
+        assert clients.get_client("s3").meta.config.max_pool_connections == 32 + POOL_HEADROOM
+
+    @staticmethod
+    def test_create_client_always_creates_a_new_client():
+
+        clients = ClientRegistry()
+
+        assert clients.create_client("s3") is not clients.create_client("s3")
+
+    @staticmethod
+    def test_clear_forgets_shared_clients():
+
+        clients = ClientRegistry()
+        client = clients.get_client("sts")
+        clients.clear()
+
+        assert clients.get_client("sts") is not client
+
+    @staticmethod
+    def test_importing_the_sync_modules_does_not_import_boto3():
+
+        import os
+        import sys
+        import subprocess
+
+        code = "import sys, s3_diff, s3_updater, file_set_loader, aws_clients; print('boto3' in sys.modules)"
+        output = subprocess.check_output([sys.executable, "-c", code], cwd = os.path.dirname(os.path.abspath(__file__)))
+
+        assert output.strip() == b"False"
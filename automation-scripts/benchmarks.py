@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""benchmarks.py:
+Micro-benchmarks for the automation scripts. Run a benchmark with `python3.6 automation-scripts/benchmarks.py <name>`.
+"""
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def time_command(command, repeat):
+
+    """
+    Times a command run in a fresh interpreter
+
+    :param command: The arguments to pass to the python interpreter
+    :param repeat: The number of times to run the command
+    :return: The median wall time of the runs, in seconds
+    """
+
+    timings = []
+
+    for _ in range(repeat):
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable] + command, cwd = SCRIPTS_DIR, stdout = subprocess.DEVNULL, check = True)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def benchmark_startup(repeat):
+
+    """
+    Measures the interpreter startup cost of each entry point and module, against bare interpreter startup and the cost
+    of importing boto3 eagerly
+
+    :param repeat: The number of times to run each command
+    :return: A list of (name, median seconds) tuples
+    """
+
+    commands = \
+    [
+        ("python (no imports)", ["-c", "pass"]),
+        ("import boto3 (eager cost)", ["-c", "import boto3"]),
+        ("import file_set_loader", ["-c", "import file_set_loader"]),
+        ("import s3_updater", ["-c", "import s3_updater"]),
+        ("automation-stack-sync.py --help", ["automation-stack-sync.py", "--help"]),
+        ("automation-linter-files-filter.py --help", ["automation-linter-files-filter.py", "--help"])
+    ]
+
+    return [(name, time_command(command, repeat)) for name, command in commands]
+
+
+def benchmark_upload_makespan(repeat):
+
+    """
+    Measures the makespan (total time) of uploading many small stack files and a few large files on a 16-worker pool,
+    with each transfer simulated by a sleep of its request latency plus its size over a per-connection bandwidth. Large
+    files at the tail of an arbitrary order are compared with largest-first ordering, with and without uploading the
+    large files in parallel parts.
+
+    :param repeat: The number of times to run each schedule
+    :return: A list of (name, median seconds) tuples
+    """
+
+    from worker_pool import WorkerPool
+    from publish_scheduler import largest_first
+    from s3_updater import MULTIPART_THRESHOLD, MULTIPART_CHUNKSIZE, MULTIPART_CONCURRENCY
+
+    latency = 0.02
+    bandwidth = 100 * 1024 ** 2
+    sizes = dict([(f"stacks/{index}.yaml", 2 * 1024) for index in range(600)] +
+                 [(f"artifacts/{index}.zip", 64 * 1024 ** 2) for index in range(4)])
+
+    def transfer(size, multipart):
+
+        parts = -(-size // MULTIPART_CHUNKSIZE) if multipart and size >= MULTIPART_THRESHOLD else 1
+        time.sleep(latency + size / bandwidth / min(parts, MULTIPART_CONCURRENCY))
+
+    def makespan(files, multipart):
+
+        pool = WorkerPool(16)
+        timings = []
+
+        for _ in range(repeat):
+
+            start = time.perf_counter()
+            pool.map(lambda file: transfer(sizes[file], multipart), files)
+            timings.append(time.perf_counter() - start)
+
+        return statistics.median(timings)
+
+    # Set order is arbitrary, so the worst case puts the large files last
+    arbitrary = sorted(sizes, key = lambda file: file.startswith("artifacts/"))
+
+    return \
+    [
+        ("arbitrary order (large files last)", makespan(arbitrary, False)),
+        ("largest first", makespan(largest_first(arbitrary, sizes.get), False)),
+        ("largest first, large files in parts", makespan(largest_first(arbitrary, sizes.get), True))
+    ]
+
+
+def benchmark_curried_hashing(repeat):
+
+    """
+    Measures the overhead curried templates add to hashing many small files, by hashing the same in-memory bytes through
+    a plain call, the curried decorator and the earlier decorator that inspected the signature on every application
+
+    :param repeat: The number of times to hash the files with each
+    :return: A list of (name, median seconds) tuples
+    """
+
+    import hashlib
+    from functools import partial
+    from inspect import signature
+    from curried import curried
+
+    def per_call_signature_curried(func):
+
+        def inner(arg):
+
+            if len(signature(func).parameters) == 1:
+
+                return func(arg)
+
+            return per_call_signature_curried(partial(func, arg))
+
+        return inner
+
+    def hash_file_template(read_bytes_func, hash_func, file):
+
+        return hash_func(read_bytes_func(file))
+
+    data_bytes = b"x" * 2048
+    files = [f"stacks/{index}.yaml" for index in range(20000)]
+    read_bytes = lambda file: data_bytes
+    md5_hash = lambda data: hashlib.md5(data).hexdigest()
+
+    def total(hash_file):
+
+        timings = []
+
+        for _ in range(repeat):
+
+            start = time.perf_counter()
+
+            for file in files:
+
+                hash_file(file)
+
+            timings.append(time.perf_counter() - start)
+
+        return statistics.median(timings)
+
+    return \
+    [
+        ("direct call (20000 files)", total(lambda file: hash_file_template(read_bytes, md5_hash, file))),
+        ("curried (20000 files)", total(curried(hash_file_template)(read_bytes)(md5_hash))),
+        ("per-call signature (20000 files)", total(per_call_signature_curried(hash_file_template)(read_bytes)(md5_hash)))
+    ]
+
+
+BENCHMARKS = \
+{
+    "curried-hashing": benchmark_curried_hashing,
+    "startup": benchmark_startup,
+    "upload-makespan": benchmark_upload_makespan
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices = sorted(BENCHMARKS), help = "The benchmark to run")
+    parser.add_argument("--repeat", type = int, default = 10, help = "The number of times to repeat each measurement")
+    args = parser.parse_args()
+
+    for name, seconds in BENCHMARKS[args.benchmark](args.repeat):
+
+        print(f"{name:<50} {seconds * 1000:10.2f} ms")
@@ -0,0 +1,448 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import subprocess
+from instrumentation import metrics
+from file_set_loader import read_bytes
+from git_index import open_blob_hash_cache
+
+
+# The cfn_nag command that scans templates
+CFN_NAG_COMMAND = ["cfn_nag_scan"]
+
+# The extensions cfn_nag_scan picks up from a directory by default
+CFN_NAG_EXTENSIONS = (".json", ".yaml", ".yml", ".template")
+
+# Bump whenever parse_results changes, so that results cached in an older shape aren't reused
+CFN_NAG_RESULTS_VERSION = 1
+
+# Each cfn_nag invocation pays for starting Ruby and loading every rule, so a batch should hold at least this many
+MIN_BATCH_TEMPLATES = 8
+
+
+def get_rule_set_version(command, args):
+
+    """
+    Identifies the rules a cfn_nag command applies: its version, the extra arguments it is run with and the content of
+    any files or directories those arguments name (e.g. --rule-directory, --deny-list-path)
+
+    :param command: The cfn_nag_scan command, as a list
+    :param args: The extra arguments passed to every invocation
+    :return: A short hash of the rule set, or None if the version of cfn_nag can't be determined
+    """
+
+    try:
+
+        version = subprocess.run \
+        (
+            command + ["--version"],
+            stdout = subprocess.PIPE,
+            stderr = subprocess.PIPE,
+            check = True
+        ).stdout
+
+    except (OSError, subprocess.CalledProcessError) as error:
+
+        print(f"Getting the cfn_nag version failed, so its results won't be cached => {error}")
+        return None
+
+    digest = hashlib.md5(version.strip())
+
+    for arg in args:
+
+        digest.update(b"\0" + arg.encode("utf-8"))
+        paths = [arg] if os.path.isfile(arg) else []
+
+        if os.path.isdir(arg):
+
+            paths = sorted(os.path.join(root, file) for root, dir_names, files in os.walk(arg) for file in files)
+
+        for path in paths:
+
+            digest.update(b"\0" + read_bytes(path))
+
+    return digest.hexdigest()[:16]
+
+
+def plan_batches(sizes, count):
+
+    """
+    Splits templates into batches of about the same total size, placing the largest templates first
+
+    :param sizes: A dictionary of the size of each template
+    :param count: The number of batches
+    :return: The list of the lists of templates in each non-empty batch
+    """
+
+    batches = [[0, index, []] for index in range(count)]
+
+    for name in sorted(sizes, key = lambda name: (-sizes[name], name)):
+
+        # The index breaks ties, so the lists of names are never compared
+        batch = min(batches)
+        batch[0] += sizes[name]
+        batch[2].append(name)
+
+    return [names for size, index, names in batches if len(names) > 0]
+
+
+def parse_results(output):
+
+    """
+    Parses the JSON output of cfn_nag_scan into the violations of each template it scanned
+
+    :param output: The bytes cfn_nag_scan wrote to stdout with --output-format json
+    :return: A dictionary of the list of violations of each scanned file name (without its directory)
+    """
+
+    results = {}
+
+    for file_result in json.loads(output.decode("utf-8")):
+
+        results[os.path.basename(file_result["filename"])] = \
+        [
+            {
+                "id": violation.get("id"),
+                "type": violation.get("type"),
+                "message": violation.get("message"),
+                "resources": violation.get("logical_resource_ids") or [],
+                "lines": violation.get("line_numbers") or []
+            }
+            for violation in file_result["file_results"]["violations"]
+        ]
+
+    return results
+
+
+def run_batches(command, args, batch_dirs):
+
+    """
+    Runs one cfn_nag_scan per batch directory, all at once, and waits for them to finish
+
+    :param command: The cfn_nag_scan command, as a list
+    :param args: The extra arguments passed to every invocation
+    :param batch_dirs: The directories holding each batch of templates
+    :return: A dictionary of the list of violations of each scanned file name (without its directory)
+    """
+
+    runs = []
+
+    for batch_dir in batch_dirs:
+
+        # Output goes to files rather than pipes, so a run is never blocked on a full pipe while another is read
+        stdout = tempfile.TemporaryFile()
+        stderr = tempfile.TemporaryFile()
+        process = subprocess.Popen \
+        (
+            command + ["--input-path", batch_dir, "--output-format", "json"] + args,
+            stdout = stdout,
+            stderr = stderr
+        )
+        runs.append((process, stdout, stderr))
+
+    results = {}
+
+    for process, stdout, stderr in runs:
+
+        # cfn_nag_scan exits with the number of failures it found, so only unreadable output is an error
+        return_code = process.wait()
+
+        with stdout, stderr:
+
+            stdout.seek(0)
+            stderr.seek(0)
+            output = stdout.read()
+
+            try:
+
+                results.update(parse_results(output))
+
+            except (ValueError, KeyError, TypeError) as error:
+
+                raise RuntimeError \
+                (
+                    f"cfn_nag failed with exit code {return_code} => {error}: {stderr.read().decode('utf-8').strip()}"
+                )
+
+    return results
+
+
+def scan_contents(contents, processes = None, command = CFN_NAG_COMMAND, args = ()):
+
+    """
+    Scans template contents with cfn_nag, batched into one long-lived invocation per CPU at most
+
+    :param contents: A dictionary of the (extension, bytes) of each template to scan, keyed by a unique name
+    :param processes: The maximum number of cfn_nag invocations to run at once, or None for one per CPU
+    :param command: The cfn_nag_scan command, as a list
+    :param args: The extra arguments passed to every invocation
+    :return: A dictionary of the list of violations of each template, keyed by the same names
+    """
+
+    count = min(processes or os.cpu_count() or 1, -(-len(contents) // MIN_BATCH_TEMPLATES))
+    batches = plan_batches({name: len(data_bytes) for name, (extension, data_bytes) in contents.items()}, count)
+    batch_root = tempfile.mkdtemp(prefix = "cfn-nag-")
+
+    try:
+
+        batch_dirs = []
+
+        for index, names in enumerate(batches):
+
+            batch_dir = os.path.join(batch_root, str(index))
+            os.makedirs(batch_dir)
+            batch_dirs.append(batch_dir)
+
+            for name in names:
+
+                extension, data_bytes = contents[name]
+
+                with open(os.path.join(batch_dir, name + extension), "wb") as file:
+
+                    file.write(data_bytes)
+
+        results = run_batches(list(command), list(args), batch_dirs)
+
+    finally:
+
+        shutil.rmtree(batch_root, ignore_errors = True)
+
+    missing = [{ "id": "FATAL", "type": "FAIL", "message": "cfn_nag returned no result", "resources": [], "lines": [] }]
+
+    return \
+    {
+        name: results[name + extension] if name + extension in results else missing
+        for name, (extension, data_bytes) in contents.items()
+    }
+
+
+def scan_templates(local_path, files, cache_location = None, processes = None, command = CFN_NAG_COMMAND, args = ()):
+
+    """
+    Scans templates with cfn_nag. Results are cached by the MD5 of each template and the rule set, so a template whose
+    content has been scanned before under the same cfn_nag version and arguments is never scanned again, and templates
+    with the same content are scanned once.
+
+    :param local_path: The local directory the templates are in
+    :param files: The paths of the templates to scan, relative to local_path; files cfn_nag wouldn't scan are skipped
+    :param cache_location: The s3://bucket/key URI or local path of the result cache, or None not to cache
+    :param processes: The maximum number of cfn_nag invocations to run at once, or None for one per CPU
+    :param command: The cfn_nag_scan command, as a list
+    :param args: The extra arguments passed to every invocation
+    :return: A dictionary of the list of violations of each template that has any
+    """
+
+    rule_set_version = None if cache_location is None else get_rule_set_version(list(command), list(args))
+    cache = None if rule_set_version is None else open_blob_hash_cache(cache_location)
+    cache_name = f"cfn-nag.v{CFN_NAG_RESULTS_VERSION}.{rule_set_version}"
+
+    files = [file for file in files if file.lower().endswith(CFN_NAG_EXTENSIONS)]
+    content_hashes = {}
+    results = {}
+    misses = {}
+
+    with metrics.span("cfn_nag.hash"):
+
+        for file in files:
+
+            data_bytes = read_bytes(os.path.join(local_path, file))
+            content_hash = hashlib.md5(data_bytes).hexdigest()
+            content_hashes[file] = content_hash
+
+            if content_hash in results or content_hash in misses:
+
+                continue
+
+            result = None if cache is None else cache.get(cache_name, content_hash)
+
+            if result is None:
+
+                misses[content_hash] = (os.path.splitext(file)[1].lower(), data_bytes)
+
+            else:
+
+                results[content_hash] = result
+
+    metrics.count("templates_nagged", len(misses))
+    metrics.count("templates_nag_cached", len(results))
+
+    if len(misses) > 0:
+
+        with metrics.span("cfn_nag.scan", files = len(misses)):
+
+            for content_hash, violations in scan_contents(misses, processes, command, args).items():
+
+                results[content_hash] = violations
+
+                if cache is not None and not any(violation["id"] == "FATAL" for violation in violations):
+
+                    cache.put(cache_name, content_hash, violations)
+
+    if cache is not None:
+
+        try:
+
+            cache.save()
+
+        except Exception as error:
+
+            # Losing the cache only costs the next run time, so it shouldn't fail the scan
+            print(f"Saving the cfn_nag result cache failed => {error}")
+
+    return \
+    {
+        file: results[content_hashes[file]]
+        for file in files
+        if len(results[content_hashes[file]]) > 0
+    }
+
+
+def has_failures(report):
+
+    """
+    Checks whether a cfn_nag report holds any failures, as opposed to only warnings
+
+    :param report: A dictionary of the list of violations of each template
+    :return: Whether any violation is a failure
+    """
+
+    return any(violation["type"] != "WARN" for violations in report.values() for violation in violations)
+
+
+def format_report(report):
+
+    """
+    Formats a cfn_nag report as one line per violation
+
+    :param report: A dictionary of the list of violations of each template
+    :return: The list of lines, ordered by template
+    """
+
+    lines = []
+
+    for file, violations in sorted(report.items()):
+
+        for violation in violations:
+
+            details = \
+            [
+                f"resources: {', '.join(violation['resources'])}" if len(violation["resources"]) > 0 else None,
+                f"lines: {', '.join(map(str, violation['lines']))}" if len(violation["lines"]) > 0 else None
+            ]
+            details = "; ".join(detail for detail in details if detail is not None)
+
+            lines.append \
+            (
+                f"{file} => {violation['type']} {violation['id']}: {violation['message']}" + \
+                (f" ({details})" if details else "")
+            )
+
+    return lines
+
+
+class PyTests:
+
+    # Stands in for cfn_nag_scan: WARN W1 for templates mentioning "Open", FAIL F1 for "Wide", logging each invocation
+    FAKE_CFN_NAG = \
+        "import os, sys, json\n" + \
+        "if sys.argv[1] == '--version':\n" + \
+        "    print('0.0.test')\n" + \
+        "    sys.exit(0)\n" + \
+        "input_path = sys.argv[sys.argv.index('--input-path') + 1]\n" + \
+        "with open(os.environ['FAKE_CFN_NAG_LOG'], 'a') as log:\n" + \
+        "    log.write(str(len(os.listdir(input_path))) + '\\n')\n" + \
+        "results = []\n" + \
+        "for name in sorted(os.listdir(input_path)):\n" + \
+        "    text = open(os.path.join(input_path, name)).read()\n" + \
+        "    violations = []\n" + \
+        "    if 'Open' in text:\n" + \
+        "        violations.append({'id': 'W1', 'type': 'WARN', 'message': 'open', " + \
+        "'logical_resource_ids': ['Group'], 'line_numbers': [3]})\n" + \
+        "    if 'Wide' in text:\n" + \
+        "        violations.append({'id': 'F1', 'type': 'FAIL', 'message': 'wide'})\n" + \
+        "    results.append({'filename': os.path.join(input_path, name), " + \
+        "'file_results': {'failure_count': 0, 'violations': violations}})\n" + \
+        "print(json.dumps(results))\n" + \
+        "sys.exit(sum(1 for result in results for violation in result['file_results']['violations']))\n"
+
+    @staticmethod
+    def test_plan_batches_balances_sizes():
+
+        batches = plan_batches({ "a": 10, "b": 6, "c": 5, "d": 1 }, 2)
+
+        assert batches == [["a", "d"], ["b", "c"]]
+        assert plan_batches({ "a": 1 }, 3) == [["a"]]
+
+    @staticmethod
+    def test_scan_templates_batches_and_caches_results(tmp_path, monkeypatch):
+
+        script = tmp_path / "fake_cfn_nag.py"
+        script.write_text(PyTests.FAKE_CFN_NAG)
+        log = tmp_path / "invocations.log"
+        monkeypatch.setenv("FAKE_CFN_NAG_LOG", str(log))
+
+        templates = tmp_path / "templates"
+        (templates / "app").mkdir(parents = True)
+
+        for index in range(20):
+
+            (templates / "app" / f"t{index}.yaml").write_text(f"Resources: {{}}\n# {index}\n")
+
+        (templates / "open.yaml").write_text("Resources:\n  Group:\n    Open: true\n")
+        (templates / "copy.yaml").write_text("Resources:\n  Group:\n    Open: true\n")
+        (templates / "wide.json").write_text('{"Wide": true}')
+
+        files = sorted(os.path.relpath(os.path.join(root, name), str(templates))
+                       for root, dir_names, names in os.walk(str(templates)) for name in names)
+        command = [sys.executable, str(script)]
+        cache = str(tmp_path / "cache.json")
+        warning = { "id": "W1", "type": "WARN", "message": "open", "resources": ["Group"], "lines": [3] }
+        expected = \
+        {
+            "copy.yaml": [warning],
+            "open.yaml": [warning],
+            "wide.json": [{ "id": "F1", "type": "FAIL", "message": "wide", "resources": [], "lines": [] }]
+        }
+
+        metrics.reset()
+        report = scan_templates(str(templates), files, cache, 2, command)
+
+        # 22 distinct templates split into two invocations, with the duplicate scanned once
+        assert report == expected
+        assert has_failures(report)
+        counts = [int(line) for line in log.read_text().split()]
+        assert [sum(counts), len(counts)] == [22, 2]
+        assert metrics.summary()["counters"]["templates_nagged"] == 22
+        assert format_report(report)[0] == "copy.yaml => WARN W1: open (resources: Group; lines: 3)"
+
+        log.write_text("")
+        (templates / "wide.json").write_text('{"Narrow": true}')
+        metrics.reset()
+        report = scan_templates(str(templates), files, cache, 2, command)
+
+        # Only the changed template is scanned again
+        assert report == { "copy.yaml": [warning], "open.yaml": [warning] }
+        assert not has_failures(report)
+        assert log.read_text().split() == ["1"]
+        assert metrics.summary()["counters"]["templates_nag_cached"] == 21
+
+        # A different rule set doesn't reuse the cached results
+        log.write_text("")
+        scan_templates(str(templates), files, cache, 2, command, ["--deny-list-path", str(script)])
+        counts = [int(line) for line in log.read_text().split()]
+        assert [sum(counts), len(counts)] == [22, 2]
+
+    @staticmethod
+    def test_run_batches_reports_unreadable_output(tmp_path):
+
+        try:
+
+            run_batches([sys.executable, "-c", "import sys; print('boom', file = sys.stderr); sys.exit(2)"], [], ["x"])
+            assert False
+
+        except RuntimeError as error:
+
+            assert "exit code 2" in str(error) and "boom" in str(error)
@@ -0,0 +1,82 @@
+import yaml
+
+
+class CfnLoader(yaml.SafeLoader):
+
+    """A safe YAML loader that also understands CloudFormation's short-form intrinsic function tags (e.g. !Ref)"""
+
+
+def construct_cfn_tag(loader, tag_suffix, node):
+
+    """
+    Constructs the long form of a CloudFormation short-form tag, so that "!Sub x" loads the same as "Fn::Sub: x"
+
+    :param loader: The YAML loader
+    :param tag_suffix: The tag without its leading "!" (e.g. "Ref")
+    :param node: The tagged YAML node
+    :return: The long form of the intrinsic function
+    """
+
+    if isinstance(node, yaml.ScalarNode):
+
+        value = loader.construct_scalar(node)
+
+    elif isinstance(node, yaml.SequenceNode):
+
+        value = loader.construct_sequence(node, deep = True)
+
+    else:
+
+        value = loader.construct_mapping(node, deep = True)
+
+    if tag_suffix in ("Ref", "Condition"):
+
+        return { tag_suffix: value }
+
+    if tag_suffix == "GetAtt" and isinstance(value, str):
+
+        value = value.split(".", 1)
+
+    return { "Fn::" + tag_suffix: value }
+
+
+CfnLoader.add_multi_constructor("!", construct_cfn_tag)
+
+
+def load(stream):
+
+    """
+    Loads a CloudFormation template or stack file written in YAML or JSON
+
+    :param stream: The text or bytes to load
+    :return: The loaded document
+    """
+
+    return yaml.load(stream, Loader = CfnLoader)
+
+
+class PyTests:
+
+    @staticmethod
+    def test_short_form_tags_load_as_their_long_form():
+
+        short_form = load("A: !Ref B\nC: !Sub 'x-${B}'\nD: !Join [',', [a, b]]\nE: !If [Cond, 1, 2]\nF: !Condition G\n")
+        long_form = load \
+        (
+            '{"A": {"Ref": "B"}, "C": {"Fn::Sub": "x-${B}"}, "D": {"Fn::Join": [",", ["a", "b"]]}, ' +
+            '"E": {"Fn::If": ["Cond", 1, 2]}, "F": {"Condition": "G"}}'
+        )
+
+        assert short_form == long_form
+
+    @staticmethod
+    def test_get_att_short_form_splits_the_resource_and_attribute():
+
+        assert load("A: !GetAtt Bucket.Arn") == { "A": { "Fn::GetAtt": ["Bucket", "Arn"] } }
+        assert load("A: !GetAtt [Bucket, Arn]") == { "A": { "Fn::GetAtt": ["Bucket", "Arn"] } }
+
+    @staticmethod
+    def test_nested_short_form_tags():
+
+        assert load("A: !Join ['', [!Ref B, !GetAtt C.D]]") == \
+               { "A": { "Fn::Join": ["", [{ "Ref": "B" }, { "Fn::GetAtt": ["C", "D"] }]] } }
@@ -0,0 +1,342 @@
+import base64
+import hashlib
+import argparse
+from common import Struct
+from instrumentation import metrics
+from rate_controller import controller
+
+
+# The reflected CRC-32C (Castagnoli) polynomial
+CRC32C_POLYNOMIAL = 0x82F63B78
+
+
+def make_crc32c_table():
+
+    """Builds the byte-at-a-time lookup table for the pure Python CRC-32C implementation"""
+
+    table = []
+
+    for byte in range(256):
+
+        crc = byte
+
+        for _ in range(8):
+
+            crc = (crc >> 1) ^ CRC32C_POLYNOMIAL if crc & 1 else crc >> 1
+
+        table.append(crc)
+
+    return table
+
+
+CRC32C_TABLE = make_crc32c_table()
+
+
+def crc32c_python(data_bytes):
+
+    """
+    Computes the CRC-32C of a byte array in pure Python, for when awscrt isn't installed
+
+    :param data_bytes: The byte array to checksum
+    :return: The CRC-32C as an integer
+    """
+
+    crc = 0xFFFFFFFF
+    table = CRC32C_TABLE
+
+    for byte in data_bytes:
+
+        crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+
+    return crc ^ 0xFFFFFFFF
+
+
+def get_crc32c_func():
+
+    """Returns the hardware-accelerated CRC-32C from awscrt (installed with boto3[crt]) if available"""
+
+    try:
+
+        from awscrt.checksums import crc32c
+
+        return crc32c
+
+    except ImportError:
+
+        return crc32c_python
+
+
+crc32c = get_crc32c_func()
+
+
+def md5_checksum(data_bytes):
+
+    """
+    Checksums a byte array with MD5, in the hexadecimal form S3 uses for the ETag of a single-part upload
+
+    :param data_bytes: The byte array to checksum
+    :return: The checksum of the byte array
+    """
+
+    metrics.count("files_hashed")
+
+    return hashlib.md5(data_bytes).hexdigest()
+
+
+def crc32c_checksum(data_bytes):
+
+    """
+    Checksums a byte array with CRC-32C, in the base64 form S3 uses for its ChecksumCRC32C
+
+    :param data_bytes: The byte array to checksum
+    :return: The checksum of the byte array
+    """
+
+    metrics.count("files_hashed")
+
+    return base64.b64encode(crc32c(data_bytes).to_bytes(4, "big")).decode("ascii")
+
+
+def sha256_checksum(data_bytes):
+
+    """
+    Checksums a byte array with SHA-256, in the base64 form S3 uses for its ChecksumSHA256
+
+    :param data_bytes: The byte array to checksum
+    :return: The checksum of the byte array
+    """
+
+    metrics.count("files_hashed")
+
+    return base64.b64encode(hashlib.sha256(data_bytes).digest()).decode("ascii")
+
+
+# The checksum algorithms that change detection can use. MD5 is compared with the ETag, which is only an MD5 for
+# single-part uploads to buckets without SSE-KMS; the others are compared with S3's additional checksums, falling back
+# to a copy of the checksum stored in the object's metadata.
+CHECKSUMS = \
+{
+    "md5": Struct
+    (
+        name = "md5",
+        checksum_func = md5_checksum,
+        s3_algorithm = None,
+        checksum_field = None,
+        metadata_key = None
+    ),
+    "crc32c": Struct
+    (
+        name = "crc32c",
+        checksum_func = crc32c_checksum,
+        s3_algorithm = "CRC32C",
+        checksum_field = "ChecksumCRC32C",
+        metadata_key = "cloudgenesis-crc32c"
+    ),
+    "sha256": Struct
+    (
+        name = "sha256",
+        checksum_func = sha256_checksum,
+        s3_algorithm = "SHA256",
+        checksum_field = "ChecksumSHA256",
+        metadata_key = "cloudgenesis-sha256"
+    )
+}
+
+
+def parse_checksum(value):
+
+    """
+    Parses the name of a checksum algorithm
+
+    :param value: The name of the algorithm (one of CHECKSUMS)
+    :return: The checksum algorithm
+    """
+
+    try:
+
+        checksum = CHECKSUMS[value.lower()]
+
+    except KeyError:
+
+        raise argparse.ArgumentTypeError(f"checksum must be one of {', '.join(sorted(CHECKSUMS))}, not {value!r}")
+
+    if checksum is CHECKSUMS["crc32c"]:
+
+        warn_if_crc32c_is_slow()
+
+    return checksum
+
+
+crc32c_warned = False
+
+
+def warn_if_crc32c_is_slow():
+
+    """Warns, once, that CRC-32C is computed in pure Python because awscrt (installed with boto3[crt]) is missing"""
+
+    global crc32c_warned
+
+    if crc32c is crc32c_python and not crc32c_warned:
+
+        crc32c_warned = True
+
+        print("awscrt is not installed, so CRC-32C checksums are computed in pure Python, which is much slower " +
+              "than MD5 => pip install boto3[crt]")
+
+
+def get_remote_checksum(s3, bucket, key, checksum):
+
+    """
+    Gets the checksum S3 stored for an object, falling back to the copy stored in the object's metadata when S3 has
+    none (e.g. the object predates the checksum) or only has a checksum of the parts of a multipart upload
+
+    :param s3: An S3 client
+    :param bucket: The S3 bucket the object is in
+    :param key: The key of the object
+    :param checksum: The checksum algorithm (one of CHECKSUMS, other than md5)
+    :return: The checksum, or None if the object has neither
+    """
+
+    with metrics.span("s3.head_object", key = key):
+
+        response = controller.call("HeadObject", s3.head_object, Bucket = bucket, Key = key, ChecksumMode = "ENABLED")
+
+    value = response.get(checksum.checksum_field)
+
+    if value is None or "-" in value:
+
+        value = response.get("Metadata", {}).get(checksum.metadata_key)
+
+    return value
+
+
+def get_upload_args(checksum, data_bytes):
+
+    """
+    Gets the extra arguments to upload an object with a checksum, both as an S3 additional checksum and in metadata.
+    The checksum is sent precomputed, so S3 verifies it and botocore doesn't compute it again (for CRC-32C, botocore
+    can only compute it with awscrt installed). Uploads in parts only keep the metadata (see get_multipart_upload_args).
+
+    :param checksum: The checksum algorithm, or None for md5
+    :param data_bytes: The bytes being uploaded
+    :return: The ExtraArgs for an upload_file call
+    """
+
+    if checksum is None or checksum.s3_algorithm is None:
+
+        return {}
+
+    value = checksum.checksum_func(data_bytes)
+
+    return \
+    {
+        checksum.checksum_field: value,
+        "Metadata": { checksum.metadata_key: value }
+    }
+
+
+def get_multipart_upload_args(extra_args):
+
+    """
+    Gets the extra arguments to upload an object in parts, leaving out any precomputed S3 additional checksum: S3 only
+    accepts a checksum of a whole multipart object for CRC algorithms, and botocore can only compute CRC-32C checksums
+    of the parts with awscrt installed. The copy in the object's metadata, which get_remote_checksum falls back to, is
+    kept.
+
+    :param extra_args: The ExtraArgs to upload the object with in a single request (see get_upload_args)
+    :return: The ExtraArgs for an upload in parts
+    """
+
+    checksum_fields = set(checksum.checksum_field for checksum in CHECKSUMS.values())
+
+    return { name: value for name, value in extra_args.items() if name not in checksum_fields }
+
+
+class PyTests:
+
+    @staticmethod
+    def test_crc32c_python_matches_the_standard_check_value():
+
+        assert crc32c_python(b"123456789") == 0xE3069283
+        assert crc32c_python(b"") == 0
+
+    @staticmethod
+    def test_crc32c_matches_the_pure_python_implementation():
+
+        data_bytes = bytes(range(256)) * 10
+
+        assert crc32c(data_bytes) == crc32c_python(data_bytes)
+
+    @staticmethod
+    def test_checksums_use_the_forms_s3_reports():
+
+        assert md5_checksum(b"abc") == "900150983cd24fb0d6963f7d28e17f72"
+        assert sha256_checksum(b"abc") == "ungWv48Bz+pBQUDeXa4iI7ADYaOWF3qctBD/YfIAFa0="
+        assert crc32c_checksum(b"123456789") == base64.b64encode(bytes.fromhex("e3069283")).decode("ascii")
+
+    @staticmethod
+    def test_crc32c_warns_once_without_awscrt(capsys):
+
+        global crc32c_warned
+
+        crc32c_warned = False
+
+        parse_checksum("crc32c")
+        parse_checksum("crc32c")
+        parse_checksum("sha256")
+
+        warnings = capsys.readouterr().out.count("awscrt is not installed")
+
+        assert warnings == (1 if crc32c is crc32c_python else 0)
+
+    @staticmethod
+    def test_parse_checksum():
+
+        assert parse_checksum("CRC32C") is CHECKSUMS["crc32c"]
+
+        try:
+            parse_checksum("crc64")
+            assert False
+        except argparse.ArgumentTypeError:
+            pass
+
+    @staticmethod
+    def test_get_remote_checksum_falls_back_to_metadata():
+
+        checksum = CHECKSUMS["sha256"]
+        responses = \
+        {
+            "plain": { "ChecksumSHA256": "full", "Metadata": { checksum.metadata_key: "meta" } },
+            "multipart": { "ChecksumSHA256": "parts-3", "Metadata": { checksum.metadata_key: "meta" } },
+            "old": { "Metadata": {} }
+        }
+
+        def my_head_object(Bucket, Key, ChecksumMode):
+            assert Bucket == "bucket" and ChecksumMode == "ENABLED"
+            return responses[Key]
+
+        s3 = Struct(head_object = my_head_object)
+
+        assert get_remote_checksum(s3, "bucket", "plain", checksum) == "full"
+        assert get_remote_checksum(s3, "bucket", "multipart", checksum) == "meta"
+        assert get_remote_checksum(s3, "bucket", "old", checksum) is None
+
+    @staticmethod
+    def test_get_upload_args():
+
+        assert get_upload_args(None, b"abc") == {}
+        assert get_upload_args(CHECKSUMS["md5"], b"abc") == {}
+        assert get_upload_args(CHECKSUMS["sha256"], b"abc") == \
+        {
+            "ChecksumSHA256": "ungWv48Bz+pBQUDeXa4iI7ADYaOWF3qctBD/YfIAFa0=",
+            "Metadata": { "cloudgenesis-sha256": "ungWv48Bz+pBQUDeXa4iI7ADYaOWF3qctBD/YfIAFa0=" }
+        }
+
+    @staticmethod
+    def test_get_multipart_upload_args_keeps_only_the_metadata_copy():
+
+        for checksum in (CHECKSUMS["crc32c"], CHECKSUMS["sha256"]):
+
+            extra_args = get_upload_args(checksum, b"abc")
+
+            assert get_multipart_upload_args(extra_args) == { "Metadata": extra_args["Metadata"] }
@@ -1,35 +1,56 @@
-from functools import partial
 from inspect import signature
 
+
 def curried(func):
 
     """
-    A decorator that converts a multi-parameter function into a set of single-parameter functions
+    A decorator that converts a multi-parameter function into a set of single-parameter functions. The number of
+    parameters is read once here, so applying an argument never inspects the function again, and applying the last
+    argument calls the function directly with every argument collected along the chain.
 
     :param func: The function to convert
     :return: A curried version of the specified function
     """
 
+    return apply_curried(func, len(signature(func).parameters), ())
+
+
+def apply_curried(func, arity, args):
+
+    """
+    Builds the single-parameter function that takes the next argument of a curried function
+
+    :param func: The function being curried
+    :param arity: The number of parameters of the function
+    :param args: The tuple of the arguments applied so far
+    :return: A function of the next argument
+    """
+
+    if len(args) + 1 >= arity:
+
+        def call(arg):
+
+            """
+            Calls the function with the last argument
+
+            :param arg: The last argument of the function
+            :return: The result of the function
+            """
+
+            return func(*args, arg)
+
+        return call
+
     def inner(arg):
 
         """
-        The inner function that curries the first parameter of a function to that function
+        The inner function that curries the next parameter of a function to that function
 
         :param arg: The parameter to curry to this function
         :return: The function with the parameter curried to it
         """
 
-        # Query for the number of parameters for this function
-        if len(signature(func).parameters) == 1:
-
-            # Simply call single parameter functions
-            return func(arg)
-
-        else:
-
-            # Curry the first parameter to the specified function with the partial function
-            # and recurse for the subsequent parameters, if any
-            return curried(partial(func, arg))
+        return apply_curried(func, arity, args + (arg,))
 
     return inner
 
@@ -95,3 +116,17 @@ class PyTests:
         assert called == False
         assert func(0)(0)(0) == True
         assert called == True
+
+    @staticmethod
+    def test_curried_passes_arguments_in_order_and_keeps_applied_chains_independent():
+
+        def func4(a, b, c, d = "d"):
+
+            return a + b + c + d
+
+        func = curried(func4)
+        applied = func("a")("b")
+
+        assert applied("c")("d") == "abcd"
+        assert applied("x")("y") == "abxy"
+        assert func("1")("2")("3")("4") == "1234"
@@ -1,22 +1,33 @@
 import os
 import re
+import time
 import hashlib
-import boto3
 from curried import curried
 from future import Future
 from common import Struct
+from instrumentation import metrics
+from rate_controller import controller
+from aws_clients import registry
+from worker_pool import shared_pool
+from checksums import get_remote_checksum
+from git_index import get_git_index_hash_file
+from sharding import shard_walk_template, get_shard_keys_from_bucket_template
+from sync_ignore import load_sync_ignore, ignore_walk_template
+from s3_inventory import get_inventory_keys_template, get_inventory_shard_keys
 
 
 class Item:
 
     """
-    A class that combines file paths, names, and hashes in a comparable way
+    A class that combines file paths, names, and hashes in a comparable way. The file size is carried along so that
+    files can be compared by size before hashing, but it is not part of the comparison itself.
     """
 
-    def __init__(self, file_path, file_name, file_hash = None):
+    def __init__(self, file_path, file_name, file_hash = None, file_size = None):
 
         self.file = file_name if file_path == "" else os.path.join(file_path, file_name)
         self.file_hash = file_hash
+        self.file_size = file_size
 
     def __eq__(self, other):
 
@@ -34,7 +45,7 @@ class Item:
 
     def __repr__(self):
 
-        return f'Item(file: "{self.file}", file_hash: "{self.file_hash}")'
+        return f'Item(file: "{self.file}", file_hash: "{self.file_hash}", file_size: {self.file_size})'
 
     def __str__(self):
 
@@ -53,7 +64,9 @@ def hash_file_template(read_bytes_func, hash_func, file):
     :return: The hash value of the file
     """
 
-    return hash_func(read_bytes_func(file))
+    with metrics.span("local.hash_file"):
+
+        return hash_func(read_bytes_func(file))
 
 
 def read_bytes(file):
@@ -67,7 +80,11 @@ def read_bytes(file):
 
     with open(file, "rb") as file_data:
 
-        return file_data.read()
+        data_bytes = file_data.read()
+
+    metrics.count("bytes_read", len(data_bytes))
+
+    return data_bytes
 
 
 def md5_hash(data_bytes):
@@ -79,6 +96,8 @@ def md5_hash(data_bytes):
     :return: The hash of the byte array
     """
 
+    metrics.count("files_hashed")
+
     return hashlib.md5(data_bytes).hexdigest()
 
 
@@ -113,12 +132,13 @@ def trim_path_prefix(string, prefix):
 
 
 @curried
-def enumerate_local_files_template(hash_file_func, list_files_func, local_path):
+def enumerate_local_files_template(get_file_size_func, list_files_func, local_path):
 
     """
-    Curried template function for enumerating files and their hashes from a local directory
+    Curried template function for enumerating files and their sizes from a local directory. Files are not hashed here;
+    see hash_size_matches_template.
 
-    :param hash_file_func: A function for computing the hash of a specified file
+    :param get_file_size_func: A function that returns the size of a specified file
     :param list_files_func: A function that lists the files from a local directory
     :param local_path: The local directory to enumerate
     :return: A generator object that will provide the enumerated files
@@ -130,15 +150,71 @@ def enumerate_local_files_template(hash_file_func, list_files_func, local_path):
         (
             trim_path_prefix(root, local_path),
             file_name,
-            hash_file_func(os.path.join(root, file_name))
+            None,
+            get_file_size_func(os.path.join(root, file_name))
         )
         for root, dir_names, file_names in list_files_func(local_path)
         for file_name in file_names
     )
 
 
-# Curry the hash_file and os.walk functions into the enumerate_local_files_template function
-enumerate_local_files = enumerate_local_files_template(hash_file)(os.walk)
+def walk(local_path):
+
+    """
+    Walks a local directory like os.walk, timing each directory listing
+
+    :param local_path: The local directory to walk
+    :return: A generator that yields (root, dir_names, file_names) tuples like os.walk
+    """
+
+    directories = os.walk(local_path)
+
+    while True:
+
+        with metrics.span("local.walk"):
+
+            directory = next(directories, None)
+
+        if directory is None:
+
+            return
+
+        yield directory
+
+
+# Curry the os.path.getsize and walk functions into the enumerate_local_files_template function
+enumerate_local_files = enumerate_local_files_template(os.path.getsize)(walk)
+
+
+@curried
+def hash_size_matches_template(hash_file_func, local_path, local_file_set, s3_file_set):
+
+    """
+    Curried template function for hashing only the local files whose size matches the size of an S3 object. Files
+    that match the size of the S3 object with the same name are hashed to see if they changed; files that match the
+    size of some other S3 object are hashed so that they can be copied from it if the content is the same. Any other
+    local file is known to have changed (and not to be a copy) without reading it, so it is left without a hash, which
+    never equals the hash of an S3 object.
+
+    :param hash_file_func: A function for computing the hash of a specified file
+    :param local_path: The local directory the local files were enumerated from
+    :param local_file_set: The set of local files (with sizes) to hash
+    :param s3_file_set: The set of S3 files (with sizes) to compare sizes with
+    :return: The set of local files, hashed where their size matched
+    """
+
+    s3_file_sizes = set(item.file_size for item in s3_file_set)
+
+    def hash_if_size_matches(item):
+
+        if item.file_size is None or item.file_size not in s3_file_sizes:
+
+            metrics.count("files_skipped_by_size")
+            return item
+
+        return Item("", item.file, hash_file_func(os.path.join(local_path, item.file)), item.file_size)
+
+    return set(map(hash_if_size_matches, local_file_set))
 
 
 @curried
@@ -160,18 +236,55 @@ def enumerate_s3_files_template(get_s3_client_func, get_prefixed_keys_from_bucke
         (
             "",
             trim_path_prefix(key.name, s3_path),
-            key.etag.strip('"').strip("'")
+            key.etag.strip('"').strip("'"),
+            key.size
         )
         for key in get_prefixed_keys_from_bucket_func(get_s3_client_func(), s3_bucket, s3_path)
         if not key.name.endswith('/')  # We don't care about "directories"
     )
 
 
+@curried
+def checksum_s3_files_template(get_s3_client_func, get_remote_checksum_func, checksum, s3_bucket, s3_path,
+                               local_file_set, s3_file_set):
+
+    """
+    Curried template function for replacing the ETags of S3 files with their stored checksums, for the S3 files whose
+    size matches the size of a local file (any other S3 file can't hold the same content as a local file). The checksums
+    are fetched concurrently on the shared worker pool. A file without a stored checksum keeps its ETag, which never
+    equals a checksum, so it is treated as changed and uploaded again with one.
+
+    :param get_s3_client_func: A function that returns an S3 client
+    :param get_remote_checksum_func: A function that gets the checksum stored for an S3 object
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS)
+    :param s3_bucket: The name of the S3 bucket the files are in
+    :param s3_path: The path into the S3 bucket the files are in
+    :param local_file_set: The set of local files (with sizes) to compare sizes with
+    :param s3_file_set: The set of S3 files (with sizes) to checksum
+    :return: The set of S3 files, with checksums where their size matched
+    """
+
+    s3 = get_s3_client_func()
+    local_file_sizes = set(item.file_size for item in local_file_set)
+
+    def checksum_if_size_matches(item):
+
+        if item.file_size is None or item.file_size not in local_file_sizes:
+
+            return item
+
+        value = get_remote_checksum_func(s3, s3_bucket, s3_path + "/" + item.file, checksum)
+
+        return item if value is None else Item("", item.file, value, item.file_size)
+
+    return set(shared_pool.map(checksum_if_size_matches, s3_file_set))
+
+
 def get_s3_client():
 
-    """Returns an s3 client for use by other functions"""
+    """Returns the shared s3 client for use by other functions"""
 
-    return boto3.client('s3')
+    return registry.get_client('s3')
 
 
 def get_prefixed_keys_from_bucket(s3, bucket, s3_path):
@@ -189,11 +302,13 @@ def get_prefixed_keys_from_bucket(s3, bucket, s3_path):
 
     while True:
 
-        response = s3.list_objects_v2(**kwargs)
+        with metrics.span("s3.list_objects_v2", prefix = s3_path):
+
+            response = controller.call("ListObjectsV2", s3.list_objects_v2, **kwargs)
 
         for key in response.get("Contents", []):
 
-            yield Struct(name = key["Key"], etag = key["ETag"])
+            yield Struct(name = key["Key"], etag = key["ETag"], size = key["Size"])
 
         try:
 
@@ -207,6 +322,9 @@ def get_prefixed_keys_from_bucket(s3, bucket, s3_path):
 # Curry the get_s3_client and get_prefixed_keys_from_bucket functions into the enumerate_s3_files_template function
 enumerate_s3_files = enumerate_s3_files_template(get_s3_client)(get_prefixed_keys_from_bucket)
 
+# Curry the get_s3_client and get_remote_checksum functions into the checksum_s3_files_template function
+checksum_s3_files = checksum_s3_files_template(get_s3_client)(get_remote_checksum)
+
 
 class FileSetLoader:
 
@@ -215,25 +333,161 @@ class FileSetLoader:
     """
 
     @staticmethod
-    def get_file_sets(local_path, s3_bucket, s3_path):
+    def get_file_sets \
+    (
+        local_path,
+        s3_bucket,
+        s3_path,
+        hash_file_func = hash_file,
+        blob_hash_cache = None,
+        shard = None,
+        checksum = None,
+        inventory = None
+    ):
 
         """
-        Enumerates files and hashes from a local path and an S3 location simultaneously
+        Enumerates files and sizes from a local path and an S3 location simultaneously, then hashes the local files
+        whose sizes match the S3 objects with the same names. Paths matched by a .syncignore file at the top of the
+        local path are left out of both sets.
 
         :param local_path: The local directory from which to enumerate its files and calculate their hashes
         :param s3_bucket: The S3 bucket to query
         :param s3_path: The path into the S3 bucket from which to enumerate its files and their hashes
+        :param hash_file_func: A function for computing the hash of a specified file
+        :param blob_hash_cache: The location (s3://bucket/key or local path) of a blob hash cache through which to look
+                                up files that are clean in the git index, or None to hash every file
+        :param shard: The shard (see sharding.parse_shard) of top-level directories to enumerate, or None for all
+        :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to compare files with, or None to compare MD5
+                         hashes (from hash_file_func) with ETags
+        :param inventory: The S3 Inventory and journal (see s3_inventory.open_inventory_source) to list the S3 location
+                          from, or None to list every key
         :return: Sets containing the local files and S3 files, respectively
         """
 
-        # Calls set(enumerate_local_files(local_path)) asynchronously
-        local_future = Future(set, (enumerate_local_files(local_path),))
+        local_set, s3_sets = FileSetLoader.get_bucket_file_sets \
+        (
+            local_path,
+            [s3_bucket],
+            s3_path,
+            hash_file_func,
+            blob_hash_cache,
+            shard,
+            checksum,
+            None if inventory is None else { s3_bucket: inventory }
+        )
 
-        # Calls set(enumerate_s3_files(s3_bucket)(s3_path)) asynchronously
-        s3_future = Future(set, (enumerate_s3_files(s3_bucket)(s3_path),))
+        return local_set, s3_sets[s3_bucket]
 
-        # Waits for both sets to be created
-        Future.wait_all(local_future, s3_future)
+    @staticmethod
+    def get_bucket_file_sets \
+    (
+        local_path,
+        s3_buckets,
+        s3_path,
+        hash_file_func = hash_file,
+        blob_hash_cache = None,
+        shard = None,
+        checksum = None,
+        inventories = None
+    ):
+
+        """
+        Enumerates files and sizes from a local path and the same path into several S3 buckets simultaneously, then
+        hashes the local files whose sizes match an S3 object in any of the buckets. The local path is only walked and
+        hashed once, however many buckets there are.
+
+        :param local_path: The local directory from which to enumerate its files and calculate their hashes
+        :param s3_buckets: The list of S3 buckets to query
+        :param s3_path: The path into the S3 buckets from which to enumerate their files and their hashes
+        :param hash_file_func: A function for computing the hash of a specified file
+        :param blob_hash_cache: The location (s3://bucket/key or local path) of a blob hash cache through which to look
+                                up files that are clean in the git index, or None to hash every file
+        :param shard: The shard (see sharding.parse_shard) of top-level directories to enumerate, or None for all
+        :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to compare files with, or None to compare MD5
+                         hashes (from hash_file_func) with ETags
+        :param inventories: A dictionary of the S3 Inventory and journal (see s3_inventory.open_inventory_source) to
+                            list each bucket from; buckets without one have every key listed
+        :return: The set of local files, and a dictionary of the set of S3 files in each bucket
+        """
+
+        # Paths matched by the tree's .syncignore file are neither walked locally nor deleted remotely
+        sync_ignore = load_sync_ignore(local_path)
+        list_files_func = ignore_walk_template(walk)(sync_ignore)
+        get_keys_from_bucket_func = get_prefixed_keys_from_bucket
+
+        if shard is not None:
+
+            list_files_func = shard_walk_template(list_files_func)(shard)
+
+            get_shard_keys_from_bucket = get_shard_keys_from_bucket_template(get_prefixed_keys_from_bucket)(shard)
+            get_keys_from_bucket_func = lambda s3, bucket, path: get_shard_keys_from_bucket(s3)(bucket)(path)
+
+        def enumerate_s3_files_func(s3_bucket):
+
+            inventory = (inventories or {}).get(s3_bucket)
+
+            if inventory is None:
+
+                return enumerate_s3_files_template(get_s3_client)(get_keys_from_bucket_func)(s3_bucket)
+
+            get_inventory_keys = get_inventory_keys_template(get_prefixed_keys_from_bucket)(time.time)(inventory)
+            get_keys_func = lambda s3, bucket, path: get_inventory_keys(s3)(bucket)(path)
+
+            if shard is not None:
+
+                return enumerate_s3_files_template                                                              \
+                    (get_s3_client)                                                                             \
+                    (lambda s3, bucket, path: get_inventory_shard_keys(get_keys_func, shard, s3, bucket, path)) \
+                    (s3_bucket)
+
+            return enumerate_s3_files_template(get_s3_client)(get_keys_func)(s3_bucket)
+
+        enumerate_local_files_func = enumerate_local_files_template(os.path.getsize)(list_files_func)
+
+        use_s3_checksums = checksum is not None and checksum.s3_algorithm is not None
+
+        if use_s3_checksums:
+
+            hash_file_func = hash_file_template(read_bytes)(checksum.checksum_func)
+
+        cache = None
+
+        if blob_hash_cache is not None:
+
+            algorithm = "md5" if checksum is None else checksum.name
+            hash_file_func, cache = get_git_index_hash_file(hash_file_func, algorithm, local_path, blob_hash_cache)
+
+        def timed_set(stage, items):
+
+            with metrics.span(stage):
+
+                return set(items)
+
+        with metrics.span("file_sets", local_path = local_path, s3_path = s3_path):
+
+            # Calls set(enumerate_local_files(local_path)) asynchronously
+            local_future = Future(timed_set, ("file_sets.local", enumerate_local_files_func(local_path)))
+
+            # Calls set(enumerate_s3_files(s3_bucket)(s3_path)) asynchronously for each bucket
+            s3_futures = \
+            {
+                s3_bucket: Future
+                (
+                    timed_set,
+                    (
+                        "file_sets.s3",
+                        (
+                            item
+                            for item in enumerate_s3_files_func(s3_bucket)(s3_path)
+                            if not sync_ignore.is_ignored(item.file)
+                        )
+                    )
+                )
+                for s3_bucket in s3_buckets
+            }
+
+            # Waits for every set to be created
+            Future.wait_all(local_future, *s3_futures.values())
 
         # Checks for failure in building the local set
         if local_future.has_failed():
@@ -242,15 +496,38 @@ class FileSetLoader:
             print(f"Future.error => {local_future.error}")
             raise local_future.error
 
-        # Checks for failure in building the s3 set
-        if s3_future.has_failed():
+        # Checks for failure in building the s3 sets
+        for s3_bucket, s3_future in s3_futures.items():
+
+            if s3_future.has_failed():
+
+                print(f"enumerating s3 files in {s3_bucket} failed!")
+                print(f"Future.error => {s3_future.error}")
+                raise s3_future.error
+
+        s3_sets = { s3_bucket: s3_future.result for s3_bucket, s3_future in s3_futures.items() }
+
+        with metrics.span("file_sets.hash"):
+
+            all_s3_files = set().union(*s3_sets.values())
+            local_set = hash_size_matches_template(hash_file_func)(local_path)(local_future.result)(all_s3_files)
+
+        if use_s3_checksums:
+
+            with metrics.span("file_sets.checksums"):
+
+                s3_sets = \
+                {
+                    s3_bucket: checksum_s3_files(checksum)(s3_bucket)(s3_path)(local_set)(s3_set)
+                    for s3_bucket, s3_set in s3_sets.items()
+                }
 
-            print("enumerating s3 files failed!")
-            print(f"Future.error => {s3_future.error}")
-            raise s3_future.error
+        if cache is not None:
 
-        # Return both sets on success
-        return local_future.result, s3_future.result
+            cache.save()
+
+        # Return every set on success
+        return local_set, s3_sets
 
 
 class PyTests:
@@ -344,19 +621,65 @@ class PyTests:
         expected_file_names = ["file1.txt", "file2.txt"]
         expected_result = \
         [
-            Item(file_path = "", file_name = "file1.txt", file_hash = "txt.1elif/htap_ym"),
-            Item(file_path = "", file_name = "file2.txt", file_hash = "txt.2elif/htap_ym")
+            Item(file_path = "", file_name = "file1.txt"),
+            Item(file_path = "", file_name = "file2.txt")
         ]
 
         def my_list_files(path):
             yield (path, "", expected_file_names)
 
+        def my_get_file_size(file):
+            return len(file)
+
+        res = list(enumerate_local_files_template(my_get_file_size)(my_list_files)(expected_path))
+
+        assert res == expected_result
+        assert [item.file_size for item in res] == [len("my_path/file1.txt"), len("my_path/file2.txt")]
+
+    @staticmethod
+    def test_hash_size_matches_template_only_hashes_files_whose_sizes_match():
+
+        hashed = []
+
         def my_hash_file(file):
+            hashed.append(file)
             return file[::-1]
 
-        res = enumerate_local_files_template(my_hash_file)(my_list_files)(expected_path)
+        local_set = \
+        {
+            Item("", "same.txt", None, 10),
+            Item("", "resized.txt", None, 20),
+            Item("", "new.txt", None, 40),
+            Item("", "moved.txt", None, 30)
+        }
+        s3_set = \
+        {
+            Item("", "same.txt", "hash1", 10),
+            Item("", "resized.txt", "hash2", 21),
+            Item("", "removed.txt", "hash3", 30)
+        }
+
+        res = hash_size_matches_template(my_hash_file)("root")(local_set)(s3_set)
+
+        assert sorted(hashed) == [os.path.join("root", "moved.txt"), os.path.join("root", "same.txt")]
+        assert res == \
+        {
+            Item("", "same.txt", os.path.join("root", "same.txt")[::-1]),
+            Item("", "resized.txt", None),
+            Item("", "new.txt", None),
+            Item("", "moved.txt", os.path.join("root", "moved.txt")[::-1])
+        }
+        assert all(item.file_size is not None for item in res)
 
-        assert list(res) == expected_result
+    @staticmethod
+    def test_hash_size_matches_template_leaves_files_with_differing_sizes_changed():
+
+        from s3_diff import S3Diff
+
+        s3_set = { Item("", "a.yaml", "hash", 2) }
+        local_set = hash_size_matches_template(lambda file: "hash")("")({ Item("", "a.yaml", None, 1) })(s3_set)
+
+        assert S3Diff.get_local_files_changed(local_set, s3_set) == { Item("", "a.yaml") }
 
     @staticmethod
     def test_enumerate_s3_files_template():
@@ -370,7 +693,7 @@ class PyTests:
         ]
 
         def my_new_key(key_name, etag):
-            return Struct(name = key_name, etag = etag)
+            return Struct(name = key_name, etag = etag, size = len(key_name))
 
         def my_get_prefixed_keys_from_bucket(s3, s3_bucket, s3_path):
             assert s3_bucket == expected_bucket_name
@@ -383,13 +706,14 @@ class PyTests:
                 for key_name in key_names
             ]
 
-        res = enumerate_s3_files_template       \
+        res = list(enumerate_s3_files_template  \
             (get_s3_client)                     \
             (my_get_prefixed_keys_from_bucket)  \
             (expected_bucket_name)              \
-            (expected_path)
+            (expected_path))
 
-        assert list(res) == expected_result
+        assert res == expected_result
+        assert [item.file_size for item in res] == [len("file1.txt"), len("file2.txt")]
 
 
     @staticmethod
@@ -399,9 +723,9 @@ class PyTests:
         expected_prefix = "stacks"
         expected_key_list = \
         [
-            Struct(name = "blah1", etag = "1halb"),
-            Struct(name = "blah2", etag = "2halb"),
-            Struct(name = "blah3", etag = "3halb")
+            Struct(name = "blah1", etag = "1halb", size = 1),
+            Struct(name = "blah2", etag = "2halb", size = 2),
+            Struct(name = "blah3", etag = "3halb", size = 3)
         ]
 
         # define my own implementation of list
@@ -410,10 +734,10 @@ class PyTests:
             assert kwargs["Prefix"] == expected_prefix
             return \
             {
-                "Contents": [{ "Key": key.name, "ETag": key.etag } for key in expected_key_list]
+                "Contents": [{ "Key": key.name, "ETag": key.etag, "Size": key.size } for key in expected_key_list]
             }
 
-        s3 = get_s3_client()
+        s3 = registry.create_client('s3')
         s3.list_objects_v2 = hijacked_list  # override Bucket's list function with my implementation
 
         # should call my list instead of the original
@@ -435,10 +759,39 @@ class PyTests:
             assert kwargs["Prefix"] == expected_prefix
             return {}
 
-        s3 = get_s3_client()
+        s3 = registry.create_client('s3')
         s3.list_objects_v2 = hijacked_list  # override Bucket's list function with my implementation
 
         # should call my list instead of the original
         keys = list(get_prefixed_keys_from_bucket(s3, expected_bucket, expected_prefix))
 
         assert keys == expected_key_list
+
+    @staticmethod
+    def test_checksum_s3_files_template_only_fetches_checksums_of_size_matches():
+
+        fetched = []
+
+        def my_get_remote_checksum(s3, bucket, key, checksum):
+            fetched.append(key)
+            return None if key == "stacks/old.yaml" else "checksum:" + key
+
+        local_set = { Item("", "a.yaml", "x", 10), Item("", "b.yaml", None, 30) }
+        s3_set = { Item("", "a.yaml", "etag1", 10), Item("", "old.yaml", "etag2", 10), Item("", "c.yaml", "etag3", 20) }
+
+        res = checksum_s3_files_template    \
+            (lambda: "s3")                  \
+            (my_get_remote_checksum)        \
+            ("checksum")                    \
+            ("bucket")                      \
+            ("stacks")                      \
+            (local_set)                     \
+            (s3_set)
+
+        assert sorted(fetched) == ["stacks/a.yaml", "stacks/old.yaml"]
+        assert res == \
+        {
+            Item("", "a.yaml", "checksum:stacks/a.yaml"),
+            Item("", "old.yaml", "etag2"),
+            Item("", "c.yaml", "etag3")
+        }
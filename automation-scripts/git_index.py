@@ -0,0 +1,518 @@
+import os
+import json
+import time
+import threading
+import subprocess
+from curried import curried
+from instrumentation import metrics
+from rate_controller import get_error_code, controller
+from aws_clients import registry
+
+
+# Git file modes whose working tree content is not the content of the blob (symbolic links and submodules)
+UNHASHABLE_GIT_MODES = { "120000", "160000" }
+
+# Cache entries that haven't been used for this many days are dropped when the cache is saved
+MAX_CACHE_ENTRY_AGE_DAYS = 30
+
+# The key of the blob hash cache object in the bucket being synced, outside of the synced paths
+DEFAULT_BLOB_HASH_CACHE_KEY = ".cloudgenesis/blob-hashes.json"
+
+
+def run_git(args, cwd):
+
+    """
+    Runs a git command
+
+    :param args: The arguments to pass to git
+    :param cwd: The directory in which to run git
+    :return: The standard output of the command as bytes
+    """
+
+    return subprocess.run(["git"] + args, cwd = cwd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, check = True).stdout
+
+
+def parse_ls_files(output):
+
+    """
+    Parses the output of `git ls-files -s -z`
+
+    :param output: The output of the command as bytes
+    :return: A generator of (path, blob SHA) tuples for the regular files in the index
+    """
+
+    for entry in output.split(b"\0"):
+
+        if entry == b"":
+
+            continue
+
+        info, path = entry.decode("utf-8").split("\t", 1)
+        mode, blob, stage = info.split(" ")
+
+        # Skip unmerged entries and entries whose working tree content isn't the blob content
+        if stage == "0" and mode not in UNHASHABLE_GIT_MODES:
+
+            yield path, blob
+
+
+def read_git_index(local_path, run_git_func = run_git):
+
+    """
+    Reads the blob SHAs of the files under a local directory from the git index, leaving out files whose working tree
+    content differs from the index. Untracked files are not in the index, so they are left out as well.
+
+    :param local_path: The local directory to read blob SHAs for
+    :param run_git_func: A function that runs a git command
+    :return: A dictionary mapping file paths (joined to local_path) to their blob SHAs
+    """
+
+    with metrics.span("git.read_index"):
+
+        indexed = parse_ls_files(run_git_func(["ls-files", "-s", "-z", "--", "."], local_path))
+        dirty = run_git_func(["diff-files", "--name-only", "--relative", "-z", "--", "."], local_path).split(b"\0")
+
+        dirty_paths = set(path.decode("utf-8") for path in dirty if path != b"")
+
+        return \
+        {
+            os.path.join(local_path, *path.split("/")): blob
+            for path, blob in indexed
+            if path not in dirty_paths
+        }
+
+
+def file_storage(path):
+
+    """
+    Returns functions that read and write the blob hash cache in a local file
+
+    :param path: The path of the file
+    :return: A (read function, write function) tuple
+    """
+
+    def read():
+
+        try:
+
+            with open(path, "rb") as cache_data:
+
+                return cache_data.read()
+
+        except FileNotFoundError:
+
+            return None
+
+    def write(data):
+
+        cache_dir = os.path.dirname(path)
+
+        if cache_dir != "":
+
+            os.makedirs(cache_dir, exist_ok = True)
+
+        with open(path, "wb") as cache_data:
+
+            cache_data.write(data)
+
+    return read, write
+
+
+def s3_storage(s3_bucket, key):
+
+    """
+    Returns functions that read and write the blob hash cache as an object in an S3 bucket, so that every build agent
+    shares it
+
+    :param s3_bucket: The name of the S3 bucket
+    :param key: The key of the object
+    :return: A (read function, write function) tuple
+    """
+
+    def read():
+
+        s3 = registry.get_client("s3")
+
+        try:
+
+            response = controller.call("GetObject", s3.get_object, Bucket = s3_bucket, Key = key)
+
+        except Exception as error:
+
+            if get_error_code(error) in ("NoSuchKey", "404"):
+
+                return None
+
+            raise
+
+        return response["Body"].read()
+
+    def write(data):
+
+        s3 = registry.get_client("s3")
+
+        controller.call("PutObject", s3.put_object, Bucket = s3_bucket, Key = key, Body = data)
+
+    return read, write
+
+
+def storage_for_location(location):
+
+    """
+    Returns the storage functions for a cache location
+
+    :param location: Either an s3://bucket/key URI or a local file path
+    :return: A (read function, write function) tuple
+    """
+
+    if location.startswith("s3://"):
+
+        s3_bucket, key = location[len("s3://"):].split("/", 1)
+
+        return s3_storage(s3_bucket, key)
+
+    return file_storage(location)
+
+
+class BlobHashCache:
+
+    """
+    A persistent map from git blob SHAs to the content hashes S3 comparisons need (e.g. MD5). A blob SHA identifies
+    file content exactly, so the map can be shared between runs, paths and build agents. Entries are populated from
+    working tree bytes, so agents sharing a cache must check out with the same line ending and filter settings.
+    """
+
+    def __init__(self, read_func, write_func, today_func = lambda: int(time.time() // 86400)):
+
+        self.lock = threading.Lock()
+        self.read_func = read_func
+        self.write_func = write_func
+        self.today = today_func()
+        self.entries = {}
+        self.changed = False
+
+    def load(self):
+
+        """Loads the cache from its storage, starting empty if it doesn't exist or can't be read"""
+
+        try:
+
+            data = self.read_func()
+            entries = json.loads(data.decode("utf-8")) if data else {}
+
+        except Exception as error:
+
+            print(f"Loading the blob hash cache failed, starting empty => {error}")
+            entries = {}
+
+        with self.lock:
+
+            self.entries = entries
+            self.changed = False
+
+        return self
+
+    def get(self, algorithm, blob):
+
+        """
+        Looks up the content hash of a blob
+
+        :param algorithm: The name of the content hash algorithm (e.g. "md5")
+        :param blob: The git blob SHA
+        :return: The content hash, or None if the blob isn't cached
+        """
+
+        with self.lock:
+
+            entry = self.entries.get(algorithm, {}).get(blob)
+
+            if entry is None:
+
+                return None
+
+            if entry[1] != self.today:
+
+                entry[1] = self.today
+                self.changed = True
+
+            return entry[0]
+
+    def put(self, algorithm, blob, value):
+
+        """
+        Stores the content hash of a blob
+
+        :param algorithm: The name of the content hash algorithm (e.g. "md5")
+        :param blob: The git blob SHA
+        :param value: The content hash
+        :return: Nothing
+        """
+
+        with self.lock:
+
+            self.entries.setdefault(algorithm, {})[blob] = [value, self.today]
+            self.changed = True
+
+    def save(self):
+
+        """Writes the cache back to its storage if anything changed, dropping entries that haven't been used lately"""
+
+        with self.lock:
+
+            if not self.changed:
+
+                return
+
+            entries = \
+            {
+                algorithm:
+                {
+                    blob: entry
+                    for blob, entry in blobs.items()
+                    if self.today - entry[1] <= MAX_CACHE_ENTRY_AGE_DAYS
+                }
+                for algorithm, blobs in self.entries.items()
+            }
+
+            data = json.dumps(entries, separators = (",", ":"), sort_keys = True).encode("utf-8")
+            self.changed = False
+
+        with metrics.span("git.save_blob_hash_cache"):
+
+            self.write_func(data)
+
+
+def open_blob_hash_cache(location):
+
+    """
+    Opens and loads the blob hash cache at a location
+
+    :param location: Either an s3://bucket/key URI or a local file path
+    :return: The loaded BlobHashCache
+    """
+
+    with metrics.span("git.load_blob_hash_cache"):
+
+        return BlobHashCache(*storage_for_location(location)).load()
+
+
+@curried
+def hash_file_with_git_index_template(hash_file_func, algorithm, blob_hashes, cache, file):
+
+    """
+    Curried template function for hashing a file through the blob hash cache. Files that are clean in the git index
+    are looked up by blob SHA and only read on a cache miss; any other file is always hashed.
+
+    :param hash_file_func: A function for computing the hash of a specified file
+    :param algorithm: The name of the algorithm hash_file_func computes
+    :param blob_hashes: A dictionary mapping file paths to their blob SHAs
+    :param cache: The BlobHashCache to look hashes up in and add them to
+    :param file: The file to hash
+    :return: The hash value of the file
+    """
+
+    blob = blob_hashes.get(file)
+
+    if blob is None:
+
+        return hash_file_func(file)
+
+    value = cache.get(algorithm, blob)
+
+    if value is None:
+
+        value = hash_file_func(file)
+        cache.put(algorithm, blob, value)
+
+    else:
+
+        metrics.count("files_hashed_from_git_index")
+
+    return value
+
+
+def get_blob_hash_cache_location(s3_bucket, location = None):
+
+    """
+    Returns the location of the blob hash cache to use for a bucket
+
+    :param s3_bucket: The name of the S3 bucket being synced
+    :param location: An explicit s3://bucket/key URI or local file path, if one was given
+    :return: The location of the blob hash cache
+    """
+
+    return location or f"s3://{s3_bucket}/{DEFAULT_BLOB_HASH_CACHE_KEY}"
+
+
+def get_git_index_hash_file(hash_file_func, algorithm, local_path, cache_location):
+
+    """
+    Builds a hash function that looks files up by their git blob SHAs in the blob hash cache. When the git index
+    can't be read (e.g. git isn't installed or the path isn't in a repository), the plain hash function is used.
+
+    :param hash_file_func: A function for computing the hash of a specified file
+    :param algorithm: The name of the algorithm hash_file_func computes
+    :param local_path: The local directory whose files will be hashed
+    :param cache_location: Either an s3://bucket/key URI or a local file path for the blob hash cache
+    :return: A (hash function, BlobHashCache or None) tuple; the cache must be saved once hashing is done
+    """
+
+    try:
+
+        blob_hashes = read_git_index(local_path)
+
+    except (OSError, subprocess.CalledProcessError) as error:
+
+        print(f"Reading the git index failed, hashing every file => {error}")
+        return hash_file_func, None
+
+    cache = open_blob_hash_cache(cache_location)
+
+    return hash_file_with_git_index_template(hash_file_func)(algorithm)(blob_hashes)(cache), cache
+
+
+class PyTests:
+
+    @staticmethod
+    def memory_storage(data = None):
+
+        stored = { "data": data }
+
+        def read():
+            return stored["data"]
+
+        def write(new_data):
+            stored["data"] = new_data
+
+        return stored, read, write
+
+    @staticmethod
+    def test_parse_ls_files_skips_symlinks_submodules_and_unmerged_entries():
+
+        output = \
+            b"100644 aaaa 0\tfile one.yaml\0" \
+            b"100755 bbbb 0\tdir/script.sh\0" \
+            b"120000 cccc 0\tlink\0" \
+            b"160000 dddd 0\tsubmodule\0" \
+            b"100644 eeee 2\tconflicted.yaml\0"
+
+        assert list(parse_ls_files(output)) == [("file one.yaml", "aaaa"), ("dir/script.sh", "bbbb")]
+
+    @staticmethod
+    def test_read_git_index_leaves_out_dirty_files():
+
+        def my_run_git(args, cwd):
+            assert cwd == "stacks"
+            if args[0] == "ls-files":
+                return b"100644 aaaa 0\ta/x.yaml\x00100644 bbbb 0\ty.yaml\x00"
+            return b"y.yaml\0"
+
+        assert read_git_index("stacks", my_run_git) == { os.path.join("stacks", "a", "x.yaml"): "aaaa" }
+
+    @staticmethod
+    def test_read_git_index_reads_a_real_repository(tmp_path):
+
+        root = str(tmp_path)
+        os.makedirs(os.path.join(root, "stacks", "a"))
+
+        for name, content in (("a/x.yaml", "hi\n"), ("y.yaml", "yo\n")):
+            with open(os.path.join(root, "stacks", *name.split("/")), "w") as file_data:
+                file_data.write(content)
+
+        run_git(["init", "-q"], root)
+        run_git(["add", "."], root)
+
+        with open(os.path.join(root, "stacks", "y.yaml"), "w") as file_data:
+            file_data.write("changed\n")
+
+        with open(os.path.join(root, "stacks", "z.yaml"), "w") as file_data:
+            file_data.write("untracked\n")
+
+        stacks = os.path.join(root, "stacks")
+
+        # "hi\n" has the well known blob SHA 45b983be...
+        assert read_git_index(stacks) == { os.path.join(stacks, "a", "x.yaml"): "45b983be36b73c0788dc9cbcb76cbb80fc7bb057" }
+
+    @staticmethod
+    def test_blob_hash_cache_round_trips_through_storage():
+
+        stored, read, write = PyTests.memory_storage()
+
+        cache = BlobHashCache(read, write).load()
+        cache.put("md5", "blob1", "md5-1")
+        cache.save()
+
+        assert BlobHashCache(read, write).load().get("md5", "blob1") == "md5-1"
+        assert BlobHashCache(read, write).load().get("sha256", "blob1") is None
+
+    @staticmethod
+    def test_blob_hash_cache_only_saves_when_changed():
+
+        stored, read, write = PyTests.memory_storage(b'{"md5":{"blob1":["md5-1",10]}}')
+
+        cache = BlobHashCache(read, write, lambda: 10).load()
+        stored["data"] = b"untouched"
+
+        assert cache.get("md5", "blob1") == "md5-1"
+        cache.save()
+
+        assert stored["data"] == b"untouched"
+
+    @staticmethod
+    def test_blob_hash_cache_drops_entries_unused_for_too_long():
+
+        stored, read, write = PyTests.memory_storage(b'{"md5":{"old":["md5-old",1],"used":["md5-used",1]}}')
+
+        cache = BlobHashCache(read, write, lambda: 2 + MAX_CACHE_ENTRY_AGE_DAYS).load()
+        cache.get("md5", "used")
+        cache.save()
+
+        assert json.loads(stored["data"].decode("utf-8")) == { "md5": { "used": ["md5-used", 2 + MAX_CACHE_ENTRY_AGE_DAYS] } }
+
+    @staticmethod
+    def test_blob_hash_cache_starts_empty_when_storage_is_unreadable():
+
+        stored, read, write = PyTests.memory_storage(b"not json")
+
+        assert BlobHashCache(read, write).load().entries == {}
+
+    @staticmethod
+    def test_file_storage_reads_none_for_missing_files(tmp_path):
+
+        read, write = file_storage(os.path.join(str(tmp_path), "cache", "blobs.json"))
+
+        assert read() is None
+        write(b"data")
+        assert read() == b"data"
+
+    @staticmethod
+    def test_hash_file_with_git_index_template_only_hashes_cache_misses_and_unindexed_files():
+
+        stored, read, write = PyTests.memory_storage()
+        cache = BlobHashCache(read, write).load()
+        cache.put("md5", "cached-blob", "cached-md5")
+        hashed = []
+
+        def my_hash_file(file):
+            hashed.append(file)
+            return file + "-md5"
+
+        blob_hashes = { "cached.yaml": "cached-blob", "uncached.yaml": "uncached-blob" }
+        hash_file = hash_file_with_git_index_template(my_hash_file)("md5")(blob_hashes)(cache)
+
+        assert hash_file("cached.yaml") == "cached-md5"
+        assert hash_file("uncached.yaml") == "uncached.yaml-md5"
+        assert hash_file("untracked.yaml") == "untracked.yaml-md5"
+        assert hashed == ["uncached.yaml", "untracked.yaml"]
+        assert cache.get("md5", "uncached-blob") == "uncached.yaml-md5"
+
+    @staticmethod
+    def test_get_git_index_hash_file_falls_back_outside_a_repository(tmp_path):
+
+        def my_hash_file(file):
+            return "md5"
+
+        hash_file, cache = get_git_index_hash_file(my_hash_file, "md5", str(tmp_path), os.path.join(str(tmp_path), "c"))
+
+        assert hash_file is my_hash_file
+        assert cache is None
@@ -0,0 +1,419 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from common import Struct
+
+
+# Error codes returned by S3 and CloudFormation when a request has been throttled
+THROTTLING_ERROR_CODES = \
+{
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "ThrottledException",
+    "RequestThrottled",
+    "RequestThrottledException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "ProvisionedThroughputExceededException",
+    "BandwidthLimitExceeded",
+    "503"
+}
+
+
+class Instrumentation:
+
+    """
+    Collects timed spans and counters for a run so that they can be reported as a summary or a Chrome trace
+    """
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.sections = {}
+        self.reset()
+
+    def reset(self):
+
+        """Discards everything recorded so far and restarts the run clock"""
+
+        with self.lock:
+
+            self.start_time = time.perf_counter()
+            self.spans = []
+            self.counters = {}
+
+    @contextmanager
+    def span(self, name, **args):
+
+        """
+        Times the enclosed block and records it as a named span
+
+        :param name: The name of the stage being timed
+        :param args: Any extra values to attach to the span in the trace
+        :return: A context manager timing the enclosed block
+        """
+
+        start = time.perf_counter()
+
+        try:
+
+            yield
+
+        finally:
+
+            end = time.perf_counter()
+
+            with self.lock:
+
+                self.spans.append \
+                (
+                    Struct
+                    (
+                        name = name,
+                        start = start - self.start_time,
+                        duration = end - start,
+                        thread = threading.get_ident(),
+                        args = args
+                    )
+                )
+
+    def count(self, name, amount = 1):
+
+        """
+        Adds an amount to a named counter
+
+        :param name: The name of the counter
+        :param amount: The amount to add to the counter
+        :return: Nothing
+        """
+
+        with self.lock:
+
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_section(self, name, func):
+
+        """
+        Adds a section to the summary whose contents are produced by a function when the summary is built
+
+        :param name: The name of the section
+        :param func: A function returning the contents of the section
+        :return: Nothing
+        """
+
+        with self.lock:
+
+            self.sections[name] = func
+
+    def summary(self):
+
+        """
+        Aggregates the spans and counters recorded so far
+
+        :return: A dictionary with the elapsed time, per-stage timings and the counters
+        """
+
+        with self.lock:
+
+            stages = {}
+
+            for span in self.spans:
+
+                stage = stages.setdefault(span.name, { "count": 0, "total_seconds": 0.0, "max_seconds": 0.0 })
+                stage["count"] += 1
+                stage["total_seconds"] += span.duration
+                stage["max_seconds"] = max(stage["max_seconds"], span.duration)
+
+            for stage in stages.values():
+
+                stage["total_seconds"] = round(stage["total_seconds"], 6)
+                stage["max_seconds"] = round(stage["max_seconds"], 6)
+
+            summary = \
+            {
+                "elapsed_seconds": round(time.perf_counter() - self.start_time, 6),
+                "stages": stages,
+                "counters": dict(self.counters)
+            }
+
+            sections = dict(self.sections)
+
+        for name, func in sections.items():
+
+            summary[name] = func()
+
+        return summary
+
+    def chrome_trace(self):
+
+        """
+        Converts the recorded spans into the Chrome trace event format (viewable in chrome://tracing or Perfetto)
+
+        :return: A dictionary in the Chrome trace event format
+        """
+
+        pid = os.getpid()
+
+        with self.lock:
+
+            events = \
+            [
+                {
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": round(span.start * 1000000, 3),
+                    "dur": round(span.duration * 1000000, 3),
+                    "pid": pid,
+                    "tid": span.thread,
+                    "args": span.args
+                }
+                for span in self.spans
+            ]
+
+            counters = dict(self.counters)
+
+        return { "traceEvents": events, "displayTimeUnit": "ms", "otherData": { "counters": counters } }
+
+    def write_trace(self, trace_file):
+
+        """
+        Writes the Chrome trace of the run to a file
+
+        :param trace_file: The path of the file to write
+        :return: Nothing
+        """
+
+        trace_dir = os.path.dirname(trace_file)
+
+        if trace_dir != "":
+
+            os.makedirs(trace_dir, exist_ok = True)
+
+        with open(trace_file, "w") as trace_data:
+
+            json.dump(self.chrome_trace(), trace_data, default = str)
+
+    def report(self, trace_file = None):
+
+        """
+        Prints the structured summary of the run and optionally writes its Chrome trace
+
+        :param trace_file: The path of the trace file to write, or None to skip writing it
+        :return: The summary that was printed
+        """
+
+        summary = self.summary()
+
+        print(f"Run summary: {json.dumps(summary, sort_keys = True)}")
+
+        if trace_file:
+
+            self.write_trace(trace_file)
+            print(f"Trace written to {trace_file}")
+
+        return summary
+
+
+# The instrumentation shared by every module during a run
+metrics = Instrumentation()
+
+
+def is_throttling_error(code):
+
+    """
+    Determines if an AWS error code means the request was throttled
+
+    :param code: The error code returned by the service
+    :return: Whether the error code is a throttling error
+    """
+
+    return str(code) in THROTTLING_ERROR_CODES
+
+
+def record_api_call(model = None, parsed = None, **kwargs):
+
+    """
+    Botocore "after-call" event handler counting API calls by operation and the retries they needed
+
+    :param model: The model of the operation that was called
+    :param parsed: The parsed response of the operation
+    :return: Nothing
+    """
+
+    metrics.count(f"api_calls.{model.name}")
+
+    retries = (parsed or {}).get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+    if retries:
+
+        metrics.count("retries", retries)
+
+
+def record_throttle(response = None, **kwargs):
+
+    """
+    Botocore "needs-retry" event handler counting throttled responses
+
+    :param response: The (http_response, parsed_response) tuple of the attempt, if a response was received
+    :return: None so that botocore's retry decision is left untouched
+    """
+
+    if response is not None:
+
+        error = (response[1] or {}).get("Error", {})
+
+        if is_throttling_error(error.get("Code")):
+
+            metrics.count("throttles")
+
+    return None
+
+
+def instrument_client(client):
+
+    """
+    Registers the instrumentation event handlers on a botocore client
+
+    :param client: The client to instrument
+    :return: The same client, for chaining
+    """
+
+    client.meta.events.register("after-call", record_api_call)
+    client.meta.events.register("needs-retry", record_throttle)
+
+    return client
+
+
+class PyTests:
+
+    @staticmethod
+    def test_span_records_name_duration_and_args():
+
+        instrumentation = Instrumentation()
+
+        with instrumentation.span("stage", file = "a.yaml"):
+            time.sleep(0.001)
+
+        assert len(instrumentation.spans) == 1
+        assert instrumentation.spans[0].name == "stage"
+        assert instrumentation.spans[0].duration > 0
+        assert instrumentation.spans[0].args == { "file": "a.yaml" }
+
+    @staticmethod
+    def test_span_is_recorded_when_the_block_raises():
+
+        instrumentation = Instrumentation()
+
+        try:
+            with instrumentation.span("failing"):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        assert [span.name for span in instrumentation.spans] == ["failing"]
+
+    @staticmethod
+    def test_count_accumulates_counters_across_threads():
+
+        instrumentation = Instrumentation()
+
+        def count_many():
+            for _ in range(1000):
+                instrumentation.count("files_hashed")
+                instrumentation.count("bytes_read", 2)
+
+        threads = [threading.Thread(target = count_many) for _ in range(4)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert instrumentation.counters == { "files_hashed": 4000, "bytes_read": 8000 }
+
+    @staticmethod
+    def test_summary_aggregates_spans_by_name():
+
+        instrumentation = Instrumentation()
+
+        for _ in range(3):
+            with instrumentation.span("hash"):
+                pass
+
+        with instrumentation.span("walk"):
+            pass
+
+        instrumentation.count("files_hashed", 3)
+
+        summary = instrumentation.summary()
+
+        assert summary["stages"]["hash"]["count"] == 3
+        assert summary["stages"]["walk"]["count"] == 1
+        assert summary["counters"] == { "files_hashed": 3 }
+        assert summary["elapsed_seconds"] >= 0
+
+    @staticmethod
+    def test_summary_includes_added_sections():
+
+        instrumentation = Instrumentation()
+        instrumentation.add_section("controller", lambda: { "throttles": 3 })
+
+        assert instrumentation.summary()["controller"] == { "throttles": 3 }
+
+    @staticmethod
+    def test_chrome_trace_contains_a_complete_event_per_span():
+
+        instrumentation = Instrumentation()
+
+        with instrumentation.span("upload", key = "stacks/a.yaml"):
+            pass
+
+        trace = instrumentation.chrome_trace()
+
+        assert len(trace["traceEvents"]) == 1
+        assert trace["traceEvents"][0]["ph"] == "X"
+        assert trace["traceEvents"][0]["name"] == "upload"
+        assert trace["traceEvents"][0]["args"] == { "key": "stacks/a.yaml" }
+
+    @staticmethod
+    def test_write_trace_writes_json_file(tmp_path):
+
+        instrumentation = Instrumentation()
+
+        with instrumentation.span("stage"):
+            pass
+
+        trace_file = os.path.join(str(tmp_path), "metrics", "trace.json")
+        instrumentation.write_trace(trace_file)
+
+        with open(trace_file) as trace_data:
+            assert json.load(trace_data)["traceEvents"][0]["name"] == "stage"
+
+    @staticmethod
+    def test_record_api_call_counts_operations_and_retries():
+
+        metrics.reset()
+
+        record_api_call(model = Struct(name = "ListObjectsV2"), parsed = { "ResponseMetadata": { "RetryAttempts": 2 } })
+        record_api_call(model = Struct(name = "ListObjectsV2"), parsed = {})
+
+        assert metrics.counters == { "api_calls.ListObjectsV2": 2, "retries": 2 }
+
+        metrics.reset()
+
+    @staticmethod
+    def test_record_throttle_counts_only_throttling_errors():
+
+        metrics.reset()
+
+        assert record_throttle(response = (None, { "Error": { "Code": "SlowDown" } })) is None
+        record_throttle(response = (None, { "Error": { "Code": "AccessDenied" } }))
+        record_throttle(response = None)
+
+        assert metrics.counters == { "throttles": 1 }
+
+        metrics.reset()
@@ -0,0 +1,217 @@
+import os
+import time
+import threading
+from itertools import zip_longest
+from instrumentation import metrics
+
+
+# Files at least this big are published before smaller ones (see largest_first)
+LARGE_FILE_SIZE = 256 * 1024
+
+
+def account_region_of(file):
+
+    """
+    Gets the "<account>/<region>" prefix of a stack file, which identifies where the downstream deployment it triggers
+    will run
+
+    :param file: The path of the file relative to the top of the synced directory
+    :return: The "<account>/<region>" prefix, just the first directory for shallower files, or "" for top-level files
+    """
+
+    parts = file.replace(os.path.sep, "/").split("/")[:-1]
+
+    return "/".join(parts[:2])
+
+
+def interleave_by_group(files, group_func = account_region_of):
+
+    """
+    Orders files round-robin across their groups (one file from each group in turn), so that publishing them in order
+    spreads the work over every group instead of finishing one group before starting the next
+
+    :param files: The files to order
+    :param group_func: A function that returns the group of a file
+    :return: The list of files, interleaved
+    """
+
+    groups = {}
+
+    for file in sorted(files):
+
+        groups.setdefault(group_func(file), []).append(file)
+
+    return \
+    [
+        file
+        for round_files in zip_longest(*(groups[group] for group in sorted(groups)))
+        for file in round_files
+        if file is not None
+    ]
+
+
+def largest_first(files, size_func, large_size = LARGE_FILE_SIZE):
+
+    """
+    Orders files so that the large ones are published first, largest first (longest-processing-time-first scheduling).
+    The shared pool runs tasks in submission order, so a long transfer never starts at the tail of a run while every
+    other worker sits idle. Files below large_size take about one request's latency each, so they keep their order
+    (e.g. from interleave_by_group) behind the large ones.
+
+    :param files: The files to order
+    :param size_func: A function that returns the size of a file
+    :param large_size: The size from which files are moved to the front
+    :return: The list of files, large ones first
+    """
+
+    files = list(files)
+    sizes = { file: size_func(file) for file in files }
+
+    return \
+        sorted((file for file in files if sizes[file] >= large_size), key = lambda file: -sizes[file]) + \
+        [file for file in files if sizes[file] < large_size]
+
+
+class PublishPacer:
+
+    """
+    Paces publishing so that each group (by default, each "<account>/<region>") receives at most a set number of files
+    per second. Slots are reserved in the order files are given (e.g. from interleave_by_group), and files are released
+    at their slots to the thread that submits them to the shared worker pool, so no worker ever waits for a slot.
+    """
+
+    def __init__(self, rate, group_func = account_region_of, clock = time.monotonic, sleep_func = time.sleep):
+
+        self.lock = threading.Lock()
+        self.interval = 1.0 / rate
+        self.group_func = group_func
+        self.clock = clock
+        self.sleep_func = sleep_func
+        self.next_slots = {}
+
+    def reserve(self, group):
+
+        """
+        Reserves the next publishing slot of a group
+
+        :param group: The group to publish to
+        :return: The number of seconds to wait until the slot
+        """
+
+        with self.lock:
+
+            now = self.clock()
+            slot = max(now, self.next_slots.get(group, now))
+            self.next_slots[group] = slot + self.interval
+
+            return slot - now
+
+    def paced(self, items, file_func = lambda item: item):
+
+        """
+        Reserves a slot for each item up front, then yields the items in slot order, each once its slot has come. The
+        waits happen on the thread consuming the items, so pass the result straight to shared_pool.map (which submits
+        each item as it is yielded) from a thread that isn't a pool worker.
+
+        :param items: The items to publish, in the order to reserve their slots in
+        :param file_func: A function that returns the path of the file an item publishes, relative to the top of the
+                          synced directory
+        :return: A generator of the items
+        """
+
+        now = self.clock()
+        slots = sorted \
+        (
+            (now + self.reserve(self.group_func(file_func(item))), index, item)
+            for index, item in enumerate(items)
+        )
+
+        for slot, index, item in slots:
+
+            delay = slot - self.clock()
+
+            if delay > 0:
+
+                metrics.count("publish_pacing_waits")
+
+                with metrics.span("publish.pace"):
+
+                    self.sleep_func(delay)
+
+            yield item
+
+
+class PyTests:
+
+    @staticmethod
+    def test_account_region_of():
+
+        assert account_region_of("acct.111111111111/us-east-1/stack.yaml") == "acct.111111111111/us-east-1"
+        assert account_region_of("acct.111111111111/us-east-1/nested/stack.yaml") == "acct.111111111111/us-east-1"
+        assert account_region_of("acct.111111111111/stack.yaml") == "acct.111111111111"
+        assert account_region_of("stack.yaml") == ""
+
+    @staticmethod
+    def test_interleave_by_group_takes_one_file_from_each_group_in_turn():
+
+        files = ["a/r/1.yaml", "a/r/2.yaml", "a/r/3.yaml", "b/r/1.yaml", "c/r/1.yaml", "c/r/2.yaml"]
+
+        assert interleave_by_group(reversed(files)) == \
+               ["a/r/1.yaml", "b/r/1.yaml", "c/r/1.yaml", "a/r/2.yaml", "c/r/2.yaml", "a/r/3.yaml"]
+
+    @staticmethod
+    def test_largest_first_moves_large_files_to_the_front_and_keeps_the_order_of_the_rest():
+
+        sizes = \
+        {
+            "a/r/1.yaml": 10,
+            "big.zip": 2 * LARGE_FILE_SIZE,
+            "b/r/1.yaml": 20,
+            "bigger.zip": 3 * LARGE_FILE_SIZE
+        }
+
+        assert largest_first(["a/r/1.yaml", "big.zip", "b/r/1.yaml", "bigger.zip"], sizes.get) == \
+               ["bigger.zip", "big.zip", "a/r/1.yaml", "b/r/1.yaml"]
+
+    @staticmethod
+    def test_publish_pacer_spaces_out_each_group_independently():
+
+        now = [0.0]
+        waits = []
+
+        def my_sleep(seconds):
+            waits.append(seconds)
+            now[0] += seconds
+
+        pacer = PublishPacer(2.0, clock = lambda: now[0], sleep_func = my_sleep)
+
+        assert pacer.reserve("a") == 0
+        assert pacer.reserve("a") == 0.5
+        assert pacer.reserve("a") == 1.0
+        assert pacer.reserve("b/r") == 0
+
+        assert list(pacer.paced(["b/r/stack.yaml"])) == ["b/r/stack.yaml"]
+        assert waits == [0.5]
+
+        # Slots that have passed are not saved up for a burst later
+        now[0] = 10.0
+        assert pacer.reserve("a") == 0
+        assert pacer.reserve("a") == 0.5
+
+    @staticmethod
+    def test_publish_pacer_releases_items_in_slot_order_without_holding_back_other_groups():
+
+        now = [0.0]
+        released = []
+
+        def my_sleep(seconds):
+            now[0] += seconds
+
+        pacer = PublishPacer(1.0, clock = lambda: now[0], sleep_func = my_sleep)
+        copies = [("old/a", "a/r/1.yaml"), ("old/b", "a/r/2.yaml"), ("old/c", "a/r/3.yaml"), ("old/d", "b/r/1.yaml")]
+
+        for source, file in pacer.paced(copies, lambda keys: keys[1]):
+            released.append((now[0], file))
+
+        # b/r/1.yaml isn't held back behind a/r's later slots, even though it was given last
+        assert released == [(0.0, "a/r/1.yaml"), (0.0, "b/r/1.yaml"), (1.0, "a/r/2.yaml"), (2.0, "a/r/3.yaml")]
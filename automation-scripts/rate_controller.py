@@ -0,0 +1,520 @@
+import time
+import random
+import threading
+from instrumentation import metrics, is_throttling_error
+
+
+# Error codes (besides throttling) for transient service failures that are worth retrying
+TRANSIENT_ERROR_CODES = \
+{
+    "InternalError",
+    "InternalFailure",
+    "ServiceUnavailable",
+    "RequestTimeout",
+    "RequestTimeoutException",
+    "PriorRequestNotComplete",
+    "500",
+    "502",
+    "504"
+}
+
+
+def get_error_code(error):
+
+    """
+    Finds the AWS error code of an exception, following the exception chain for errors that wrap a ClientError
+    (e.g. the S3UploadFailedError raised by upload_file)
+
+    :param error: The exception to inspect
+    :return: The AWS error code, or None if the exception is not an AWS service error
+    """
+
+    while error is not None:
+
+        response = getattr(error, "response", None)
+
+        if isinstance(response, dict) and "Error" in response:
+
+            return response["Error"].get("Code")
+
+        error = error.__cause__ or error.__context__
+
+    return None
+
+
+def is_connection_error(error):
+
+    """
+    Determines if an exception is a transient connection failure raised by botocore
+
+    :param error: The exception to inspect
+    :return: Whether the exception is a connection failure
+    """
+
+    from botocore.exceptions import ConnectionError, HTTPClientError
+
+    return isinstance(error, (ConnectionError, HTTPClientError))
+
+
+# The default ceiling on requests started per second. It is well above S3's per-prefix limits (3,500 writes and 5,500
+# reads per second), so the rate is only ever lowered below what AWS allows by the throttling AWS actually returns.
+DEFAULT_MAX_RATE = 10000.0
+
+
+class RateController:
+
+    """
+    A token bucket rate limiter with AIMD (additive increase, multiplicative decrease) control of both the request rate
+    and the number of requests in flight. Every AWS call made during a run goes through the same controller so that
+    throttling seen by one caller slows all of them down.
+    """
+
+    def __init__ \
+    (
+        self,
+        max_concurrency = 16,
+        min_concurrency = 1,
+        max_rate = DEFAULT_MAX_RATE,
+        min_rate = 1.0,
+        rate_increase = 1.0,
+        decrease_factor = 0.5,
+        decrease_cooldown = 1.0,
+        max_attempts = 8,
+        base_delay = 0.1,
+        max_delay = 20.0,
+        clock = time.monotonic,
+        sleep_func = time.sleep,
+        random_func = random.random
+    ):
+
+        self.condition = threading.Condition()
+        self.clock = clock
+        self.sleep_func = sleep_func
+        self.random_func = random_func
+
+        self.min_concurrency = min_concurrency
+        self.min_rate = min_rate
+        self.rate_increase = rate_increase
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.configure(max_concurrency, max_rate)
+
+    def configure(self, max_concurrency = None, max_rate = None):
+
+        """
+        Sets the ceilings the controller recovers towards and resets its state to them
+
+        :param max_concurrency: The maximum number of requests in flight
+        :param max_rate: The maximum number of requests started per second
+        :return: Nothing
+        """
+
+        with self.condition:
+
+            if max_concurrency is not None:
+
+                self.max_concurrency = max(self.min_concurrency, max_concurrency)
+
+            if max_rate is not None:
+
+                self.max_rate = max(self.min_rate, float(max_rate))
+
+            self.limit = float(self.max_concurrency)
+            self.rate = self.max_rate
+            self.tokens = self.max_rate
+            self.last_refill = self.clock()
+            self.last_decrease = None
+            self.in_flight = 0
+
+            self.lowest_limit = self.limit
+            self.lowest_rate = self.rate
+            self.calls = 0
+            self.retries = 0
+            self.throttles = 0
+            self.decreases = 0
+            self.failures = 0
+
+            self.condition.notify_all()
+
+    def acquire(self):
+
+        """Waits for a free request slot under the current concurrency limit and then for a rate token"""
+
+        with self.condition:
+
+            while self.in_flight >= max(self.min_concurrency, int(self.limit)):
+
+                self.condition.wait()
+
+            self.in_flight += 1
+
+        while True:
+
+            with self.condition:
+
+                now = self.clock()
+                self.tokens = min(self.rate, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            self.sleep_func(wait)
+
+    def release(self):
+
+        """Frees the request slot taken by acquire"""
+
+        with self.condition:
+
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self):
+
+        """Additively raises the concurrency limit and the rate after a healthy response"""
+
+        with self.condition:
+
+            self.calls += 1
+            self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self.rate = min(self.max_rate, self.rate + self.rate_increase)
+            self.condition.notify_all()
+
+    def on_throttle(self):
+
+        """Multiplicatively lowers the concurrency limit and the rate, at most once per cooldown period"""
+
+        with self.condition:
+
+            self.throttles += 1
+            now = self.clock()
+
+            if self.last_decrease is not None and now - self.last_decrease < self.decrease_cooldown:
+
+                return
+
+            self.last_decrease = now
+            self.decreases += 1
+            self.limit = max(float(self.min_concurrency), self.limit * self.decrease_factor)
+            self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+            self.tokens = min(self.tokens, self.rate)
+            self.lowest_limit = min(self.lowest_limit, self.limit)
+            self.lowest_rate = min(self.lowest_rate, self.rate)
+
+    def backoff(self, attempt):
+
+        """
+        Computes a full-jitter exponential backoff delay
+
+        :param attempt: The number of attempts made so far
+        :return: The number of seconds to wait before the next attempt
+        """
+
+        return self.random_func() * min(self.max_delay, self.base_delay * (2 ** attempt))
+
+    def call(self, operation, func, *args, **kwargs):
+
+        """
+        Calls an AWS operation under the controller's rate and concurrency limits, retrying throttled and transient
+        failures with backoff
+
+        :param operation: The name of the operation, for reporting
+        :param func: The function making the AWS call
+        :param args: The positional arguments to pass to func
+        :param kwargs: The keyword arguments to pass to func
+        :return: The result of func
+        """
+
+        attempt = 1
+
+        while True:
+
+            self.acquire()
+
+            try:
+
+                result = func(*args, **kwargs)
+
+            except Exception as error:
+
+                code = get_error_code(error)
+                throttled = is_throttling_error(code)
+
+                if throttled:
+
+                    self.on_throttle()
+
+                if not (throttled or code in TRANSIENT_ERROR_CODES or is_connection_error(error)) \
+                   or attempt >= self.max_attempts:
+
+                    with self.condition:
+
+                        self.failures += 1
+
+                    raise
+
+            else:
+
+                self.on_success()
+                return result
+
+            finally:
+
+                self.release()
+
+            with self.condition:
+
+                self.retries += 1
+
+            metrics.count("retries")
+            metrics.count(f"retries.{operation}")
+
+            self.sleep_func(self.backoff(attempt))
+            attempt += 1
+
+    def stats(self):
+
+        """
+        Reports the controller's state for the run summary
+
+        :return: A dictionary describing the controller's limits and activity
+        """
+
+        with self.condition:
+
+            return \
+            {
+                "max_concurrency": self.max_concurrency,
+                "concurrency_limit": round(self.limit, 2),
+                "lowest_concurrency_limit": round(self.lowest_limit, 2),
+                "rate": round(self.rate, 2),
+                "lowest_rate": round(self.lowest_rate, 2),
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "decreases": self.decreases,
+                "failures": self.failures
+            }
+
+    def botocore_config(self):
+
+        """
+        Returns the botocore configuration for clients whose calls go through this controller. botocore's own retries
+        are turned off so that throttling reaches the controller instead of stalling inside the client.
+
+        :return: A botocore Config object
+        """
+
+        from botocore.config import Config
+
+        return Config(retries = { "max_attempts": 0 })
+
+
+# The rate controller shared by every AWS call made during a run
+controller = RateController()
+
+metrics.add_section("rate_controller", controller.stats)
+
+
+class PyTests:
+
+    class FakeClock:
+
+        def __init__(self):
+            self.now = 0.0
+            self.slept = []
+
+        def clock(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+
+    class ThrottlingError(Exception):
+
+        def __init__(self, code = "SlowDown"):
+            super().__init__(code)
+            self.response = { "Error": { "Code": code } }
+
+    @staticmethod
+    def new_controller(**kwargs):
+
+        fake = PyTests.FakeClock()
+        controller = RateController(clock = fake.clock, sleep_func = fake.sleep, random_func = lambda: 1.0, **kwargs)
+
+        return controller, fake
+
+    @staticmethod
+    def test_get_error_code_follows_the_exception_chain():
+
+        class UploadFailed(Exception):
+            pass
+
+        try:
+            try:
+                raise PyTests.ThrottlingError("SlowDown")
+            except Exception:
+                raise UploadFailed()
+        except UploadFailed as error:
+            assert get_error_code(error) == "SlowDown"
+
+        assert get_error_code(ValueError()) is None
+
+    @staticmethod
+    def test_call_retries_throttled_calls_until_they_succeed():
+
+        controller, fake = PyTests.new_controller()
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise PyTests.ThrottlingError()
+            return "done"
+
+        assert controller.call("PutObject", flaky) == "done"
+        assert len(attempts) == 3
+        assert controller.stats()["retries"] == 2
+        assert controller.stats()["throttles"] == 2
+
+    @staticmethod
+    def test_call_does_not_retry_errors_that_are_not_transient():
+
+        controller, fake = PyTests.new_controller()
+        attempts = []
+
+        def denied():
+            attempts.append(1)
+            raise PyTests.ThrottlingError("AccessDenied")
+
+        try:
+            controller.call("PutObject", denied)
+            assert False
+        except PyTests.ThrottlingError:
+            pass
+
+        assert len(attempts) == 1
+        assert controller.stats()["failures"] == 1
+        assert controller.in_flight == 0
+
+    @staticmethod
+    def test_call_gives_up_after_max_attempts():
+
+        controller, fake = PyTests.new_controller(max_attempts = 3)
+        attempts = []
+
+        def always_throttled():
+            attempts.append(1)
+            raise PyTests.ThrottlingError()
+
+        try:
+            controller.call("ListObjectsV2", always_throttled)
+            assert False
+        except PyTests.ThrottlingError:
+            pass
+
+        assert len(attempts) == 3
+
+    @staticmethod
+    def test_throttling_decreases_limits_multiplicatively_once_per_cooldown():
+
+        controller, fake = PyTests.new_controller(max_concurrency = 16, max_rate = 100)
+
+        controller.on_throttle()
+        controller.on_throttle()
+
+        assert controller.limit == 8
+        assert controller.rate == 50
+        assert controller.stats()["decreases"] == 1
+
+        fake.now += 2
+        controller.on_throttle()
+
+        assert controller.limit == 4
+        assert controller.rate == 25
+
+    @staticmethod
+    def test_success_increases_limits_additively_up_to_the_maximum():
+
+        controller, fake = PyTests.new_controller(max_concurrency = 4, max_rate = 10, rate_increase = 1.0)
+
+        controller.on_throttle()
+
+        assert controller.limit == 2
+        assert controller.rate == 5
+
+        controller.on_success()
+
+        assert controller.limit == 2.5
+        assert controller.rate == 6
+
+        for _ in range(100):
+            controller.on_success()
+
+        assert controller.limit == 4
+        assert controller.rate == 10
+
+    @staticmethod
+    def test_default_max_rate_does_not_cap_below_s3_limits():
+
+        controller, fake = PyTests.new_controller(max_concurrency = 1000)
+
+        for _ in range(5500):
+            controller.acquire()
+            controller.release()
+
+        assert controller.max_rate > 5500
+        assert fake.slept == []
+
+        controller.configure(max_rate = 50)
+
+        assert controller.rate == 50
+
+    @staticmethod
+    def test_acquire_waits_for_rate_tokens():
+
+        controller, fake = PyTests.new_controller(max_concurrency = 100, max_rate = 2)
+
+        for _ in range(4):
+            controller.acquire()
+            controller.release()
+
+        assert sum(fake.slept) == 1.0
+
+    @staticmethod
+    def test_acquire_limits_requests_in_flight():
+
+        controller = RateController(max_concurrency = 2)
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def work():
+            controller.acquire()
+            with lock:
+                in_flight.append(1)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.pop()
+            controller.release()
+
+        threads = [threading.Thread(target = work) for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert max(peak) == 2
@@ -24,6 +24,30 @@ class S3Diff:
 
         return set(filter(lambda i: i.file in file_name_remove_set, s3_file_set))
 
+    @staticmethod
+    def get_local_files_copyable(local_files_changed, s3_file_set):
+
+        """Pairs each changed local file with an S3 file that already holds the same content (by hash), so that it can
+        be copied within S3 instead of uploaded. When several S3 files hold that content, the first by name is used.
+        S3 files that are themselves about to be overwritten are never used, as every copy runs at once (e.g. when two
+        files swap contents, one copy could otherwise read a key that the other is writing)."""
+
+        overwritten = set(map(lambda i: i.file, local_files_changed))
+        s3_files_by_hash = {}
+
+        for item in sorted(s3_file_set, key = lambda i: i.file, reverse = True):
+
+            if item.file not in overwritten:
+
+                s3_files_by_hash[item.file_hash] = item
+
+        return \
+        {
+            item: s3_files_by_hash[item.file_hash]
+            for item in local_files_changed
+            if item.file_hash is not None and item.file_hash in s3_files_by_hash
+        }
+
 
 class PyTests:
 
@@ -61,3 +85,22 @@ class PyTests:
 
         print (S3Diff.get_local_files_removed(local_set, remote_set))
         assert S3Diff.get_local_files_removed(local_set, remote_set) == set(remove_set)
+
+    @staticmethod
+    def test_get_local_files_copyable_pairs_changed_files_with_s3_files_holding_the_same_content():
+        changed_set = {Item("new", "a.yaml", "hasha"), Item("", "b.yaml", "hashx"), Item("", "c.yaml", None)}
+        remote_set = {Item("", "a.yaml", "hasha"), Item("", "b.yaml", "hashb"), Item("", "c.yaml", "hashc")}
+        assert S3Diff.get_local_files_copyable(changed_set, remote_set) == {Item("new", "a.yaml", "hasha"): Item("", "a.yaml", "hasha")}
+
+    @staticmethod
+    def test_get_local_files_copyable_picks_the_first_s3_file_by_name():
+        changed_set = {Item("", "d.yaml", "hash")}
+        remote_set = {Item("", "c.yaml", "hash"), Item("", "a.yaml", "hash"), Item("", "b.yaml", "hash")}
+        assert S3Diff.get_local_files_copyable(changed_set, remote_set)[Item("", "d.yaml", "hash")].file == "a.yaml"
+
+    @staticmethod
+    def test_get_local_files_copyable_never_copies_from_a_file_that_is_being_overwritten():
+        # a.yaml and b.yaml swap contents, and v1 -> v2 -> v3 shifts content along a chain of renames
+        changed_set = {Item("", "a.yaml", "hashb"), Item("", "b.yaml", "hasha"), Item("", "v2.yaml", "hash1"), Item("", "v3.yaml", "hash2")}
+        remote_set = {Item("", "a.yaml", "hasha"), Item("", "b.yaml", "hashb"), Item("", "v1.yaml", "hash1"), Item("", "v2.yaml", "hash2")}
+        assert S3Diff.get_local_files_copyable(changed_set, remote_set) == {Item("", "v2.yaml", "hash1"): Item("", "v1.yaml", "hash1")}
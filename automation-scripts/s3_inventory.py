@@ -0,0 +1,854 @@
+import io
+import os
+import re
+import csv
+import gzip
+import json
+import time
+import argparse
+import threading
+from contextlib import closing
+from urllib.parse import unquote_plus
+from common import Struct
+from curried import curried
+from instrumentation import metrics
+from rate_controller import controller
+from aws_clients import registry
+from worker_pool import shared_pool
+from sharding import in_shard
+from git_index import storage_for_location
+
+
+# The file an S3 Inventory run writes into its dated folder, listing the run's data files
+MANIFEST_FILE = "manifest.json"
+
+# The dated folders (e.g. 2024-01-31T00-00Z) an S3 Inventory configuration writes each run into
+MANIFEST_FOLDER_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}T\d{2}-\d{2}Z$")
+
+# The fields of an inventory row that are read, after normalize_field
+ROW_FIELDS = ("key", "size", "etag", "islatest", "isdeletemarker")
+
+# Where each sync records the prefixes it has changed, inside the synced bucket
+DEFAULT_JOURNAL_PREFIX = ".cloudgenesis/touched-prefixes"
+
+# How long the journal remembers a change; an inventory older than this can't be reconciled and isn't used
+MAX_JOURNAL_AGE_DAYS = 14
+
+# S3 Inventory may leave out changes made shortly before a run, so changes this long before it are also reconciled
+INVENTORY_LAG_SECONDS = 48 * 60 * 60
+
+
+def parse_inventory(value):
+
+    """
+    Parses an inventory option of the form "[bucket=]location"
+
+    :param value: The option value
+    :return: A (bucket or None, location) tuple
+    """
+
+    bucket, separator, location = value.partition("=")
+
+    # Bucket names can't hold "/" or ":", but locations can hold "=" (e.g. s3://inventories/hive/dt=2024-01-31)
+    if separator == "" or "/" in bucket or ":" in bucket:
+
+        bucket, location = None, value
+
+    if location == "" or bucket == "":
+
+        raise argparse.ArgumentTypeError(f"inventory must look like [bucket=]location, not {value!r}")
+
+    return bucket, location
+
+
+def normalize_field(name):
+
+    """
+    Normalizes an inventory field name, so that CSV schemas ("ETag", "IsLatest") and ORC/Parquet column names
+    ("e_tag", "is_latest") match
+
+    :param name: The field name
+    :return: The normalized field name
+    """
+
+    return name.strip().lower().replace("_", "")
+
+
+def parse_manifest(data_bytes):
+
+    """
+    Parses the manifest.json of an S3 Inventory run
+
+    :param data_bytes: The contents of the manifest
+    :return: A Struct with the run's creation time (in seconds), file format, CSV fields and data file keys
+    """
+
+    manifest = json.loads(data_bytes.decode("utf-8"))
+    file_format = manifest["fileFormat"]
+
+    if file_format not in ("CSV", "ORC", "Parquet"):
+
+        raise ValueError(f"unsupported inventory file format {file_format!r}")
+
+    return Struct \
+    (
+        created = int(manifest["creationTimestamp"]) / 1000.0,
+        file_format = file_format,
+        fields = [normalize_field(field) for field in manifest["fileSchema"].split(",")] if file_format == "CSV" \
+                 else None,
+        files = [file["key"] for file in manifest["files"]]
+    )
+
+
+def read_csv_rows(file_data, fields):
+
+    """
+    Reads the rows of a gzipped CSV inventory file as it is streamed. CSV inventories URL-encode their keys.
+
+    :param file_data: A binary file object of the gzipped CSV data
+    :param fields: The normalized fields of each row, from the manifest's schema
+    :return: A generator that yields a tuple of the ROW_FIELDS (None where missing) for each row
+    """
+
+    positions = [fields.index(field) if field in fields else None for field in ROW_FIELDS]
+
+    with gzip.GzipFile(fileobj = file_data) as data, io.TextIOWrapper(data, encoding = "utf-8", newline = "") as text:
+
+        for record in csv.reader(text):
+
+            row = [None if position is None else record[position] for position in positions]
+            row[0] = unquote_plus(row[0])
+
+            yield tuple(row)
+
+
+def read_columnar_rows(file_data, file_format):
+
+    """
+    Reads the rows of an ORC or Parquet inventory file, a record batch (or stripe) at a time. Reading these formats
+    needs pyarrow, which is only imported when an ORC or Parquet inventory is used.
+
+    :param file_data: A binary file object of the ORC or Parquet data
+    :param file_format: Either "ORC" or "Parquet"
+    :return: A generator that yields a tuple of the ROW_FIELDS (None where missing) for each row
+    """
+
+    try:
+
+        import pyarrow.orc as orc
+        import pyarrow.parquet as parquet
+
+    except ImportError:
+
+        raise RuntimeError(f"reading {file_format} inventories needs pyarrow (pip install pyarrow)")
+
+    # Both formats need random access to read their footers, which an S3 stream doesn't give
+    data = io.BytesIO(file_data.read())
+
+    if file_format == "Parquet":
+
+        batches = parquet.ParquetFile(data).iter_batches()
+
+    else:
+
+        orc_file = orc.ORCFile(data)
+        batches = (orc_file.read_stripe(stripe) for stripe in range(orc_file.nstripes))
+
+    for batch in batches:
+
+        names = [normalize_field(name) for name in batch.schema.names]
+        missing = [None] * batch.num_rows
+
+        yield from zip \
+        (
+            *(batch.column(names.index(field)).to_pylist() if field in names else missing for field in ROW_FIELDS)
+        )
+
+
+def select_keys(rows, prefix):
+
+    """
+    Selects the current objects with a prefix from inventory rows. Rows for older versions and delete markers (in the
+    inventories of versioned buckets) are left out.
+
+    :param rows: The inventory rows (see read_csv_rows)
+    :param prefix: The prefix of the keys to select
+    :return: A generator that yields a Struct with the name, ETag and size of each selected object
+    """
+
+    for key, size, etag, is_latest, is_delete_marker in rows:
+
+        if not key.startswith(prefix):
+
+            continue
+
+        if str(is_latest).lower() == "false" or str(is_delete_marker).lower() == "true":
+
+            continue
+
+        yield Struct(name = key, etag = etag or "", size = None if size in (None, "") else int(size))
+
+
+class S3Inventory:
+
+    """
+    An S3 Inventory run, read through a function that opens its data files. The data files are streamed and filtered
+    concurrently on the shared worker pool, so only the objects with the requested prefix are kept in memory.
+    """
+
+    def __init__(self, manifest, open_file_func):
+
+        self.manifest = manifest
+        self.open_file_func = open_file_func
+
+    def read_rows(self, key):
+
+        """
+        Reads the rows of one of the run's data files
+
+        :param key: The key of the data file, as listed in the manifest
+        :return: A generator that yields a tuple of the ROW_FIELDS for each row
+        """
+
+        with closing(self.open_file_func(key)) as file_data:
+
+            if self.manifest.file_format == "CSV":
+
+                yield from read_csv_rows(file_data, self.manifest.fields)
+
+            else:
+
+                yield from read_columnar_rows(file_data, self.manifest.file_format)
+
+    def keys(self, prefix):
+
+        """
+        Lists the objects with a prefix
+
+        :param prefix: The prefix of the keys to list
+        :return: A generator that yields a Struct with the name, ETag and size of each object
+        """
+
+        def read_file(key):
+
+            with metrics.span("s3.inventory.read", file = key):
+
+                return list(select_keys(self.read_rows(key), prefix))
+
+        for keys in shared_pool.map(read_file, self.manifest.files):
+
+            metrics.count("inventory_keys", len(keys))
+
+            yield from keys
+
+
+def open_local_inventory(location):
+
+    """
+    Opens an S3 Inventory run from a local copy of an inventory configuration's folder (the dated folders holding each
+    run's manifest.json, next to the data folder)
+
+    :param location: The path of a run's manifest.json, or of the configuration's folder to use its latest run
+    :return: An S3Inventory
+    """
+
+    if os.path.basename(location) != MANIFEST_FILE:
+
+        runs = sorted \
+        (
+            name
+            for name in os.listdir(location)
+            if MANIFEST_FOLDER_PATTERN.match(name) and os.path.isfile(os.path.join(location, name, MANIFEST_FILE))
+        )
+
+        if len(runs) == 0:
+
+            raise FileNotFoundError(f"no inventory manifests in {location}")
+
+        location = os.path.join(location, runs[-1], MANIFEST_FILE)
+
+    with open(location, "rb") as manifest_data:
+
+        manifest = parse_manifest(manifest_data.read())
+
+    configuration_path = os.path.dirname(os.path.dirname(os.path.abspath(location)))
+
+    # Data file keys end in ".../<configuration>/data/<file>", which sits in the configuration's folder
+    return S3Inventory \
+    (
+        manifest,
+        lambda key: open(os.path.join(configuration_path, *key.split("/")[-2:]), "rb")
+    )
+
+
+def open_s3_inventory(location):
+
+    """
+    Opens an S3 Inventory run from the bucket the inventory is delivered to
+
+    :param location: The s3://bucket/key URI of a run's manifest.json, or of the configuration's prefix to use its
+                     latest run
+    :return: An S3Inventory
+    """
+
+    s3 = registry.get_client("s3")
+    s3_bucket, _, key = location[len("s3://"):].partition("/")
+
+    if key.split("/")[-1] != MANIFEST_FILE:
+
+        prefix = key.rstrip("/") + "/"
+        kwargs = { "Bucket": s3_bucket, "Prefix": prefix, "Delimiter": "/" }
+        runs = []
+
+        while True:
+
+            response = controller.call("ListObjectsV2", s3.list_objects_v2, **kwargs)
+
+            runs.extend \
+            (
+                common_prefix["Prefix"]
+                for common_prefix in response.get("CommonPrefixes", [])
+                if MANIFEST_FOLDER_PATTERN.match(common_prefix["Prefix"][len(prefix):].rstrip("/"))
+            )
+
+            try:
+
+                kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+            except KeyError:
+
+                break
+
+        if len(runs) == 0:
+
+            raise FileNotFoundError(f"no inventory manifests in {location}")
+
+        key = max(runs) + MANIFEST_FILE
+
+    response = controller.call("GetObject", s3.get_object, Bucket = s3_bucket, Key = key)
+
+    return S3Inventory \
+    (
+        parse_manifest(response["Body"].read()),
+        lambda data_key: controller.call("GetObject", s3.get_object, Bucket = s3_bucket, Key = data_key)["Body"]
+    )
+
+
+def open_inventory(location):
+
+    """
+    Opens an S3 Inventory run
+
+    :param location: Either an s3://bucket/key URI or a local path (see open_s3_inventory and open_local_inventory)
+    :return: An S3Inventory
+    """
+
+    with metrics.span("s3.inventory.open", location = location):
+
+        if location.startswith("s3://"):
+
+            return open_s3_inventory(location)
+
+        return open_local_inventory(location)
+
+
+def list_journal_location(location):
+
+    """
+    Lists the names of the journal files at a journal location
+
+    :param location: Either an s3://bucket/prefix URI or a local directory
+    :return: The list of the names of the journal files
+    """
+
+    if not location.startswith("s3://"):
+
+        return os.listdir(location) if os.path.isdir(location) else []
+
+    s3 = registry.get_client("s3")
+    s3_bucket, _, prefix = location[len("s3://"):].partition("/")
+    kwargs = { "Bucket": s3_bucket, "Prefix": prefix.rstrip("/") + "/" }
+    names = []
+
+    while True:
+
+        response = controller.call("ListObjectsV2", s3.list_objects_v2, **kwargs)
+        names.extend(key["Key"][len(kwargs["Prefix"]):] for key in response.get("Contents", []))
+
+        try:
+
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+        except KeyError:
+
+            break
+
+    return names
+
+
+class TouchedPrefixJournal:
+
+    """
+    Remembers which prefixes of a synced path were changed, and when, so that a listing from an S3 Inventory can be
+    reconciled with the changes made since the inventory ran. Each writer (e.g. each shard of a sync) keeps its own
+    journal file, so concurrent writers don't lose each other's entries; reading merges every writer's file.
+    Entries older than MAX_JOURNAL_AGE_DAYS are dropped whenever a writer records new ones.
+    """
+
+    def __init__(self, location, writer = "all", clock = time.time):
+
+        self.lock = threading.Lock()
+        self.location = location.rstrip("/")
+        self.writer = writer
+        self.clock = clock
+
+    def storage(self, name):
+
+        """Returns the (read function, write function) tuple of one writer's journal file"""
+
+        return storage_for_location(f"{self.location}/{name}")
+
+    def touched_since(self, timestamp):
+
+        """
+        Gets the prefixes that any writer changed at or after a time
+
+        :param timestamp: The time, in seconds since the epoch
+        :return: The set of prefixes
+        """
+
+        prefixes = set()
+
+        for name in list_journal_location(self.location):
+
+            data = self.storage(name)[0]()
+
+            if data is not None:
+
+                prefixes.update(prefix for prefix, touched in json.loads(data).items() if touched >= timestamp)
+
+        return prefixes
+
+    def record(self, prefixes):
+
+        """
+        Records that this writer is changing prefixes now. It should be called before the changes are made, so that
+        a sync that fails part way through still has its changes reconciled.
+
+        :param prefixes: The prefixes being changed
+        """
+
+        prefixes = set(prefixes)
+
+        if len(prefixes) == 0:
+
+            return
+
+        read, write = self.storage(f"{self.writer}.json")
+
+        with self.lock, metrics.span("s3.inventory.journal"):
+
+            data = read()
+            now = self.clock()
+            oldest = now - MAX_JOURNAL_AGE_DAYS * 24 * 60 * 60
+            entries = {} if data is None else json.loads(data)
+            entries = { prefix: touched for prefix, touched in entries.items() if touched >= oldest }
+            entries.update((prefix, now) for prefix in prefixes)
+
+            write(json.dumps(entries, sort_keys = True).encode("utf-8"))
+
+
+def touched_prefix(s3_path, file):
+
+    """
+    Gets the prefix to record in the journal for a changed file: its directory, or the key itself for a file at the
+    top of the path (so that changing it doesn't mean listing the whole path)
+
+    :param s3_path: The synced path into the S3 bucket
+    :param file: The path of the file relative to the top of the synced directory
+    :return: The prefix
+    """
+
+    file = file.replace(os.path.sep, "/")
+    directory = os.path.dirname(file)
+
+    return f"{s3_path}/{file}" if directory == "" else f"{s3_path}/{directory}/"
+
+
+def open_journal(s3_bucket, s3_path, writer = "all"):
+
+    """
+    Opens the journal of the prefixes changed in a path into a bucket. Everything that writes the path records its
+    changes here, whether or not it lists the path from an inventory, so that later inventory listings see them.
+
+    :param s3_bucket: The S3 bucket
+    :param s3_path: The path into the S3 bucket
+    :param writer: The name of this writer's journal file (e.g. "all", a shard or "daemon")
+    :return: The TouchedPrefixJournal
+    """
+
+    return TouchedPrefixJournal(f"s3://{s3_bucket}/{DEFAULT_JOURNAL_PREFIX}/{s3_path}", writer)
+
+
+def journal_writer(shard = None):
+
+    """
+    Names the journal file of a sync
+
+    :param shard: The shard (see sharding.parse_shard) being synced, or None
+    :return: The writer name
+    """
+
+    return "all" if shard is None else f"shard-{shard.index}-of-{shard.count}"
+
+
+def open_inventory_source(s3_bucket, s3_path, location, shard = None):
+
+    """
+    Opens the inventory and the journal used to list a path into a bucket
+
+    :param s3_bucket: The S3 bucket the inventory is of
+    :param s3_path: The path into the S3 bucket to list
+    :param location: The location of the inventory (see open_inventory)
+    :param shard: The shard (see sharding.parse_shard) being synced, which names this writer's journal file
+    :return: A Struct with the S3Inventory and the TouchedPrefixJournal
+    """
+
+    return Struct \
+    (
+        inventory = open_inventory(location),
+        journal = open_journal(s3_bucket, s3_path, journal_writer(shard))
+    )
+
+
+@curried
+def get_inventory_keys_template(get_prefixed_keys_from_bucket_func, clock, source, s3, bucket, s3_path):
+
+    """
+    Curried template function for listing a path into an S3 bucket from an S3 Inventory instead of listing every key.
+    The prefixes the journal says were changed since the inventory ran are listed with ListObjectsV2 (concurrently, on
+    the shared worker pool) and replace the inventory's rows for them. An inventory too old for the journal to cover is
+    ignored, and the whole path is listed instead.
+
+    :param get_prefixed_keys_from_bucket_func: A function that gets a list of S3 keys with the specified prefix
+    :param clock: A function that returns the current time, in seconds since the epoch
+    :param source: The inventory and journal to use (see open_inventory_source)
+    :param s3: An S3 client
+    :param bucket: The S3 bucket to query
+    :param s3_path: The path into the S3 bucket to query
+    :return: A generator that lists keys from the S3 bucket in the specified path
+    """
+
+    created = source.inventory.manifest.created
+    age = clock() - created
+
+    if age + INVENTORY_LAG_SECONDS > MAX_JOURNAL_AGE_DAYS * 24 * 60 * 60:
+
+        print(f"The inventory of s3://{bucket} is {age / 86400:.1f} days old, so s3://{bucket}/{s3_path} is listed")
+        metrics.count("inventory_too_old")
+
+        yield from get_prefixed_keys_from_bucket_func(s3, bucket, s3_path)
+        return
+
+    touched = []
+
+    # Prefixes inside other touched prefixes are already listed with them
+    for prefix in sorted(source.journal.touched_since(created - INVENTORY_LAG_SECONDS)):
+
+        if prefix.startswith(s3_path + "/") and not (len(touched) > 0 and prefix.startswith(touched[-1])):
+
+            touched.append(prefix)
+
+    metrics.count("inventory_prefixes_reconciled", len(touched))
+
+    listings = shared_pool.map(lambda prefix: list(get_prefixed_keys_from_bucket_func(s3, bucket, prefix)), touched)
+
+    touched = tuple(touched)
+
+    for key in source.inventory.keys(s3_path):
+
+        if not key.name.startswith(touched):
+
+            yield key
+
+    for listing in listings:
+
+        yield from listing
+
+
+def get_inventory_shard_keys(get_inventory_keys_func, shard, s3, bucket, s3_path):
+
+    """
+    Lists only a shard of a path from an S3 Inventory
+
+    :param get_inventory_keys_func: A function that lists keys from an inventory (see get_inventory_keys_template)
+    :param shard: The shard to list
+    :param s3: An S3 client
+    :param bucket: The S3 bucket to query
+    :param s3_path: The path into the S3 bucket to query
+    :return: A generator that lists keys from the S3 bucket in the shard
+    """
+
+    return \
+    (
+        key
+        for key in get_inventory_keys_func(s3, bucket, s3_path)
+        if in_shard(key.name[len(s3_path) + 1:].split("/")[0], shard)
+    )
+
+
+class PyTests:
+
+    @staticmethod
+    def write_inventory(configuration_path, run, rows, file_format = "CSV", created = 1700000000000):
+
+        """Writes a CSV inventory run like S3 Inventory delivers it"""
+
+        data = io.StringIO()
+        csv.writer(data, lineterminator = "\n").writerows(rows)
+
+        os.makedirs(configuration_path / "data", exist_ok = True)
+        os.makedirs(configuration_path / run, exist_ok = True)
+
+        (configuration_path / "data" / f"{run}.csv.gz").write_bytes(gzip.compress(data.getvalue().encode("utf-8")))
+        (configuration_path / run / MANIFEST_FILE).write_text \
+        (
+            json.dumps
+            ({
+                "sourceBucket": "bkt",
+                "destinationBucket": "arn:aws:s3:::inventories",
+                "creationTimestamp": str(created),
+                "fileFormat": file_format,
+                "fileSchema": "Bucket, Key, Size, ETag, IsLatest, IsDeleteMarker",
+                "files": [{ "key": f"inv/bkt/daily/data/{run}.csv.gz", "size": 0, "MD5checksum": "" }]
+            })
+        )
+
+    @staticmethod
+    def test_parse_inventory():
+
+        assert parse_inventory("s3://inventories/bkt/daily/") == (None, "s3://inventories/bkt/daily/")
+        assert parse_inventory("bkt=./inventory") == ("bkt", "./inventory")
+        assert parse_inventory("s3://inventories/dt=1/manifest.json") == (None, "s3://inventories/dt=1/manifest.json")
+
+        for value in ("", "bkt=", "=./inventory"):
+
+            try:
+                parse_inventory(value)
+                assert False, value
+            except argparse.ArgumentTypeError:
+                pass
+
+    @staticmethod
+    def test_local_inventory_lists_current_objects_with_the_prefix(tmp_path):
+
+        PyTests.write_inventory \
+        (
+            tmp_path,
+            "2023-11-14T00-00Z",
+            [
+                ["bkt", "stacks/a/stack.yaml", "10", "etag1", "true", "false"],
+                ["bkt", "stacks/a/my+stack%2B1.yaml", "11", "etag2", "true", "false"],
+                ["bkt", "stacks/a/old.yaml", "12", "etag3", "false", "false"],
+                ["bkt", "stacks/a/deleted.yaml", "", "", "true", "true"],
+                ["bkt", "templates/t.yaml", "13", "etag4", "true", "false"]
+            ]
+        )
+        PyTests.write_inventory \
+        (
+            tmp_path,
+            "2023-11-13T00-00Z",
+            [["bkt", "stacks/stale.yaml", "1", "x", "true", "false"]]
+        )
+
+        # The latest run is used, keys are URL-decoded and only current objects with the prefix are listed
+        inventory = open_inventory(str(tmp_path))
+
+        assert inventory.manifest.created == 1700000000.0
+        assert list(inventory.keys("stacks")) == \
+        [
+            Struct(name = "stacks/a/stack.yaml", etag = "etag1", size = 10),
+            Struct(name = "stacks/a/my stack+1.yaml", etag = "etag2", size = 11)
+        ]
+
+    @staticmethod
+    def test_get_inventory_keys_template_reconciles_touched_prefixes(tmp_path):
+
+        PyTests.write_inventory \
+        (
+            tmp_path / "inventory",
+            "2023-11-14T00-00Z",
+            [
+                ["bkt", "stacks/a/stack.yaml", "10", "etag1", "true", "false"],
+                ["bkt", "stacks/b/stack.yaml", "10", "etag2", "true", "false"],
+                ["bkt", "stacks/b/removed.yaml", "10", "etag3", "true", "false"],
+                ["bkt", "stacks/top.yaml", "10", "etag4", "true", "false"]
+            ]
+        )
+
+        created = 1700000000.0
+        journal = TouchedPrefixJournal(str(tmp_path / "journal"), "shard-0-of-2", clock = lambda: created - 3 * 86400)
+        journal.record([touched_prefix("stacks", "a/old.yaml")])
+
+        journal.clock = lambda: created + 60
+        journal.record([touched_prefix("stacks", "b/stack.yaml"), touched_prefix("stacks", "b/x/deep.yaml")])
+        TouchedPrefixJournal(str(tmp_path / "journal"), "shard-1-of-2", clock = journal.clock) \
+            .record([touched_prefix("stacks", "top.yaml")])
+
+        assert journal.touched_since(created) == { "stacks/b/", "stacks/b/x/", "stacks/top.yaml" }
+
+        listed = []
+
+        def my_get_prefixed_keys(s3, bucket, prefix):
+            listed.append(prefix)
+            return \
+            {
+                "stacks/b/": [Struct(name = "stacks/b/stack.yaml", etag = "new", size = 11)],
+                "stacks/top.yaml": []
+            }[prefix]
+
+        source = Struct(inventory = open_inventory(str(tmp_path / "inventory")), journal = journal)
+        get_keys = get_inventory_keys_template(my_get_prefixed_keys)(lambda: created + 3600)(source)
+        keys = list(get_keys(None)("bkt")("stacks"))
+
+        # Only the touched prefixes are listed, and they replace the inventory's rows
+        assert sorted(listed) == ["stacks/b/", "stacks/top.yaml"]
+        assert sorted(key.name + "=" + key.etag for key in keys) == \
+               ["stacks/a/stack.yaml=etag1", "stacks/b/stack.yaml=new"]
+
+        # An inventory the journal no longer covers is not used at all
+        listed.clear()
+        too_late = lambda: created + MAX_JOURNAL_AGE_DAYS * 86400
+        get_all = lambda s3, bucket, prefix: listed.append(prefix) or []
+
+        assert list(get_inventory_keys_template(get_all)(too_late)(source)(None)("bkt")("stacks")) == []
+        assert listed == ["stacks"]
+
+    @staticmethod
+    def test_touched_prefix_journal_drops_old_entries(tmp_path):
+
+        now = [0.0]
+        journal = TouchedPrefixJournal(str(tmp_path), clock = lambda: now[0])
+
+        journal.record(["stacks/a/"])
+        now[0] = MAX_JOURNAL_AGE_DAYS * 86400 + 1
+        journal.record(["stacks/b/"])
+
+        assert json.loads((tmp_path / "all.json").read_text()) == { "stacks/b/": now[0] }
+        assert journal.touched_since(0) == { "stacks/b/" }
+
+    @staticmethod
+    def test_parse_manifest_normalizes_the_csv_schema():
+
+        manifest = \
+        {
+            "creationTimestamp": "1700000000500",
+            "fileFormat": "CSV",
+            "fileSchema": "Bucket, Key, Size, ETag, IsLatest",
+            "files": [{ "key": "inv/data/1.csv.gz" }, { "key": "inv/data/2.csv.gz" }]
+        }
+
+        parsed = parse_manifest(json.dumps(manifest).encode("utf-8"))
+
+        assert parsed.created == 1700000000.5
+        assert parsed.fields == ["bucket", "key", "size", "etag", "islatest"]
+        assert parsed.files == ["inv/data/1.csv.gz", "inv/data/2.csv.gz"]
+
+        manifest["fileFormat"] = "Parquet"
+
+        assert parse_manifest(json.dumps(manifest).encode("utf-8")).fields is None
+
+        manifest["fileFormat"] = "JSON"
+
+        try:
+            parse_manifest(json.dumps(manifest).encode("utf-8"))
+            assert False
+        except ValueError:
+            pass
+
+    @staticmethod
+    def test_read_csv_rows_and_select_keys_filter_by_the_manifest_schema():
+
+        # Fields are read by their position in the schema, and fields the schema leaves out read as None
+        fields = [normalize_field(field) for field in ["Key", "Bucket", "ETag", "Size"]]
+        rows = \
+        [
+            ["stacks/a%2Fb.yaml", "bkt", "e1", "5"],
+            ["stacks/c.yaml", "bkt", "e2", ""],
+            ["other/d.yaml", "bkt", "e3", "1"]
+        ]
+        data = io.StringIO()
+        csv.writer(data, lineterminator = "\n").writerows(rows)
+
+        read = list(read_csv_rows(io.BytesIO(gzip.compress(data.getvalue().encode("utf-8"))), fields))
+
+        assert read[0] == ("stacks/a/b.yaml", "5", "e1", None, None)
+        assert list(select_keys(read, "stacks/")) == \
+        [
+            Struct(name = "stacks/a/b.yaml", etag = "e1", size = 5),
+            Struct(name = "stacks/c.yaml", etag = "e2", size = None)
+        ]
+
+        versioned = \
+        [
+            ("stacks/a.yaml", "1", "old", "false", "false"),
+            ("stacks/a.yaml", "2", "new", "TRUE", "false"),
+            ("stacks/b.yaml", None, None, "true", "true")
+        ]
+
+        assert list(select_keys(versioned, "stacks/")) == [Struct(name = "stacks/a.yaml", etag = "new", size = 2)]
+
+    @staticmethod
+    def test_get_inventory_keys_template_expiry_and_lag_windows():
+
+        created = 1700000000.0
+        listed = []
+        journals = {}
+
+        class MyJournal:
+
+            @staticmethod
+            def touched_since(timestamp):
+                journals["since"] = timestamp
+                return { "stacks/a/" }
+
+        inventory = Struct \
+        (
+            manifest = Struct(created = created),
+            keys = lambda prefix: iter([Struct(name = "stacks/a/x.yaml", etag = "old", size = 1)])
+        )
+        source = Struct(inventory = inventory, journal = MyJournal)
+        get_keys = lambda s3, bucket, prefix: listed.append(prefix) or []
+        newest_usable = created + MAX_JOURNAL_AGE_DAYS * 86400 - INVENTORY_LAG_SECONDS
+
+        # Changes made within the lag before the inventory ran are reconciled too, as it may have missed them
+        assert list(get_inventory_keys_template(get_keys)(lambda: newest_usable)(source)(None)("bkt")("stacks")) == []
+        assert journals["since"] == created - INVENTORY_LAG_SECONDS
+        assert listed == ["stacks/a/"]
+
+        # Once the journal may have dropped changes made since that window, the inventory isn't used
+        listed.clear()
+
+        assert list(get_inventory_keys_template(get_keys)(lambda: newest_usable + 1)(source)(None)("bkt")("stacks")) \
+               == []
+        assert listed == ["stacks"]
+
+    @staticmethod
+    def test_touched_prefix_journal_merges_entries_and_writers(tmp_path):
+
+        now = [100.0]
+        clock = lambda: now[0]
+        sync = TouchedPrefixJournal(str(tmp_path), clock = clock)
+        daemon = TouchedPrefixJournal(str(tmp_path), "daemon", clock = clock)
+
+        sync.record(["stacks/a/", "stacks/b/"])
+        now[0] = 200.0
+        sync.record(["stacks/b/"])
+        daemon.record(["stacks/c/"])
+        sync.record([])
+
+        # A writer's later records keep its earlier entries, updating the time of the ones changed again
+        assert json.loads((tmp_path / "all.json").read_text()) == { "stacks/a/": 100.0, "stacks/b/": 200.0 }
+        assert sync.touched_since(150.0) == { "stacks/b/", "stacks/c/" }
+        assert daemon.touched_since(0) == { "stacks/a/", "stacks/b/", "stacks/c/" }
+        assert TouchedPrefixJournal(str(tmp_path / "missing")).touched_since(0) == set()
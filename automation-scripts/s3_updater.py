@@ -1,7 +1,29 @@
 import os
-import boto3
+import io
 from curried import curried
 from common import Struct
+from instrumentation import metrics
+from rate_controller import controller, get_error_code
+from worker_pool import shared_pool
+from aws_clients import registry
+from checksums import get_upload_args, get_multipart_upload_args
+from semantic_hash import CANONICAL_METADATA_KEY, CANONICAL_EXTENSIONS
+from file_set_loader import read_bytes
+from publish_scheduler import largest_first
+
+
+# The maximum number of keys that S3 accepts in a single DeleteObjects request
+MAX_DELETE_KEYS = 1000
+
+# The largest object that S3 can copy with a single CopyObject request
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+
+# Files smaller than this are uploaded with a single PutObject request; larger ones are uploaded in parts
+MULTIPART_THRESHOLD = 8 * 1024 ** 2
+
+# The size of each part of a multipart upload, and how many parts of one file are uploaded at once
+MULTIPART_CHUNKSIZE = 8 * 1024 ** 2
+MULTIPART_CONCURRENCY = 4
 
 
 def prepend_path(path, file):
@@ -19,9 +41,9 @@ def prepend_path(path, file):
 
 def get_s3_client():
 
-    """Returns an S3 client that can create Bucket objects"""
+    """Returns the shared S3 client that can create Bucket objects"""
 
-    return boto3.resource("s3")
+    return registry.get_resource("s3")
 
 
 def get_bucket(s3, s3_bucket):
@@ -62,14 +84,14 @@ def delete_files_template(get_s3_client_func, get_bucket_func, delete_keys_func,
     )
 
 
-def delete_keys(s3_bucket, key_list):
+def delete_key_batch(s3_bucket, key_batch):
 
     """
-    Deletes the specified list of keys from the specified bucket
+    Deletes a batch of at most MAX_DELETE_KEYS keys from the specified bucket with a single request
 
     :param s3_bucket: The bucket from which to delete
-    :param key_list: The list of keys to delete from the S3 bucket
-    :return: A MultiDeleteResult object detailing the keys that were deleted and any errors encountered
+    :param key_batch: The list of keys to delete from the S3 bucket
+    :return: The DeleteObjects response
     """
 
     delete = \
@@ -77,19 +99,40 @@ def delete_keys(s3_bucket, key_list):
         "Objects" :
         [
             { "Key": key }
-            for key in key_list
+            for key in key_batch
         ]
     }
 
-    if len(delete["Objects"]) > 0:
+    with metrics.span("s3.delete_objects", keys = len(delete["Objects"])):
 
-        response = s3_bucket.delete_objects(Delete = delete)
+        return controller.call("DeleteObjects", s3_bucket.delete_objects, Delete = delete)
 
-        return Struct(deleted = response.get("Deleted", []), errors = response.get("Errors", []))
 
-    else:
+def delete_keys(s3_bucket, key_list):
 
-        return Struct(deleted=[], errors=[])
+    """
+    Deletes the specified list of keys from the specified bucket, sending batches of keys concurrently
+
+    :param s3_bucket: The bucket from which to delete
+    :param key_list: The list of keys to delete from the S3 bucket
+    :return: A MultiDeleteResult object detailing the keys that were deleted and any errors encountered
+    """
+
+    key_list = list(key_list)
+
+    key_batches = \
+    [
+        key_list[index:index + MAX_DELETE_KEYS]
+        for index in range(0, len(key_list), MAX_DELETE_KEYS)
+    ]
+
+    responses = shared_pool.map(lambda key_batch: delete_key_batch(s3_bucket, key_batch), key_batches)
+
+    return Struct \
+    (
+        deleted = [deleted for response in responses for deleted in response.get("Deleted", [])],
+        errors = [error for response in responses for error in response.get("Errors", [])]
+    )
 
 
 # Curry the get_bucket (from file_set_loader) and delete_keys functions into the delete_files_template function
@@ -109,7 +152,7 @@ def upload_files_template \
 ):
 
     """
-    Curried template function for uploading files to an S3 bucket
+    Curried template function for uploading files to an S3 bucket concurrently on the shared worker pool
 
     :param get_s3_client_func: A function that returns an S3 client
     :param get_bucket_func: A function that returns an object representing an S3 bucket
@@ -124,54 +167,317 @@ def upload_files_template \
     s3 = get_s3_client_func()
     bucket = get_bucket_func(s3, s3_bucket)
 
-    for file in local_file_set:
-
-        upload_file_func    \
+    shared_pool.map \
+    (
+        lambda file: upload_file_func
         (
             bucket,
             prepend_path(local_path, file),
             prepend_path(s3_path, file)
+        ),
+        local_file_set
+    )
+
+
+def get_transfer_config():
+
+    """Returns the transfer configuration for multipart uploads"""
+
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig \
+    (
+        multipart_threshold = MULTIPART_THRESHOLD,
+        multipart_chunksize = MULTIPART_CHUNKSIZE,
+        max_concurrency = MULTIPART_CONCURRENCY
+    )
+
+
+def put_object(bucket, data_bytes, key_path, extra_args):
+
+    """
+    Uploads bytes with a single PutObject request, which skips the transfer manager that upload_file starts for every
+    file; for small files, that overhead costs more than the upload itself
+
+    :param bucket: The bucket to which to upload
+    :param data_bytes: The bytes to upload
+    :param key_path: The key to which to upload
+    :param extra_args: The extra arguments (e.g. checksums and metadata) to upload with
+    :return: The PutObject response
+    """
+
+    with metrics.span("s3.put_object", key = key_path):
+
+        return controller.call \
+        (
+            "PutObject",
+            bucket.meta.client.put_object,
+            Bucket = bucket.name,
+            Key = key_path,
+            Body = data_bytes,
+            **extra_args
         )
 
 
-def upload_file(bucket, key_path, file):
+def upload_file(bucket, file_path, key_path):
 
     """
-    Creates a key object representing a key in the specified bucket
+    Uploads a file to a key in the specified bucket, with a single request if it is small or in parts if it is large
 
     :param bucket: The bucket in which the key resides
+    :param file_path: The local file to upload
     :param key_path: The path into the bucket in which the key resides
-    :param file: The file to upload to the key object
-    :return: The key object
+    :return: Nothing
+    """
+
+    if os.path.getsize(file_path) < MULTIPART_THRESHOLD:
+
+        put_object(bucket, read_bytes(file_path), key_path, {})
+        return
+
+    with metrics.span("s3.upload_file", file = file_path):
+
+        controller.call("upload_file", bucket.upload_file, file_path, key_path, Config = get_transfer_config())
+
+
+
+
+def get_object_upload_args(checksum, canonical_hash_func, file_path, data_bytes):
+
+    """
+    Gets the extra arguments to upload an object with, combining an S3 additional checksum with a canonical hash
+
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to upload with, or None
+    :param canonical_hash_func: A function that computes the canonical hash of a file's bytes, or None
+    :param file_path: The local file being uploaded; only files with one of semantic_hash.CANONICAL_EXTENSIONS get a
+                      canonical hash, as no other file is ever compared by one
+    :param data_bytes: The bytes being uploaded
+    :return: The ExtraArgs for an upload call
     """
 
-    return bucket.upload_file(file, key_path)
+    extra_args = get_upload_args(checksum, data_bytes)
+
+    if canonical_hash_func is not None and file_path.lower().endswith(CANONICAL_EXTENSIONS):
+
+        canonical_hash = canonical_hash_func(data_bytes)
+
+        if canonical_hash is not None:
+
+            extra_args.setdefault("Metadata", {})[CANONICAL_METADATA_KEY] = canonical_hash
+
+    return extra_args
 
 
+@curried
+def upload_file_with_args_template(read_bytes_func, get_upload_args_func, bucket, file_path, key_path):
+
+    """
+    Curried template function for uploading a file with extra arguments computed from its bytes (e.g. an S3 additional
+    checksum, with a copy in the object's metadata for when S3 only reports a checksum of the parts of a multipart
+    upload). The file is read once, both to compute the arguments and to upload it, with a single request if it is small
+    or in parts if it is large. Large files are uploaded without the precomputed S3 checksum, keeping only the copy in
+    metadata (see checksums.get_multipart_upload_args).
+
+    :param read_bytes_func: The function to use to read the bytes from the specified file
+    :param get_upload_args_func: A function that returns the ExtraArgs to upload the specified bytes with
+    :param bucket: The bucket to which to upload
+    :param file_path: The local file to upload
+    :param key_path: The key to which to upload
+    :return: Nothing
+    """
+
+    data_bytes = read_bytes_func(file_path)
+    extra_args = get_upload_args_func(data_bytes)
+
+    if len(data_bytes) < MULTIPART_THRESHOLD:
+
+        put_object(bucket, data_bytes, key_path, extra_args)
+        return
+
+    with metrics.span("s3.upload_file", file = file_path):
+
+        controller.call \
+        (
+            "upload_file",
+            bucket.upload_fileobj,
+            io.BytesIO(data_bytes),
+            key_path,
+            ExtraArgs = get_multipart_upload_args(extra_args),
+            Config = get_transfer_config()
+        )
 
 
 # Curry the get_s3_client, get_bucket, and upload_file functions into the upload_files_template function
 upload_files = upload_files_template(get_s3_client)(get_bucket)(upload_file)
 
+# Curry the read_bytes function into the upload_file_with_args_template function
+upload_file_with_args = upload_file_with_args_template(read_bytes)
+
+
+@curried
+def copy_files_template(get_s3_client_func, get_bucket_func, copy_object_func, copy_list, s3_bucket):
+
+    """
+    Curried template function for copying objects within an S3 bucket concurrently on the shared worker pool
+
+    :param get_s3_client_func: A function that returns an S3 client
+    :param get_bucket_func: A function that returns an object representing an S3 bucket
+    :param copy_object_func: A function that copies one key to another within an S3 bucket
+    :param copy_list: The list of (source key, destination key) tuples to copy
+    :param s3_bucket: The S3 bucket in which to copy
+    :return: The list of (source key, destination key) tuples that could not be copied as the source was gone
+    """
+
+    s3 = get_s3_client_func()
+    bucket = get_bucket_func(s3, s3_bucket)
+
+    # The list is passed through as it is, so that a paced generator is consumed as the copies are submitted
+    copied = shared_pool.map(lambda keys: (keys, copy_object_func(bucket, keys[0], keys[1])), copy_list)
+
+    return [keys for keys, was_copied in copied if not was_copied]
+
+
+def copy_object(bucket, source_key, key_path, checksum = None):
+
+    """
+    Copies an object to another key in the same bucket without transferring its data through this machine. The
+    object's metadata, including any checksum stored there, is copied with it.
+
+    :param bucket: The bucket in which the keys reside
+    :param source_key: The key to copy from
+    :param key_path: The key to copy to
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS) for S3 to compute for the copy, or None
+    :return: Whether the object was copied; False if the source no longer exists (e.g. another sync deleted it)
+    """
+
+    extra_args = {}
+
+    if checksum is not None and checksum.s3_algorithm is not None:
+
+        extra_args["ChecksumAlgorithm"] = checksum.s3_algorithm
+
+    with metrics.span("s3.copy_object", key = key_path):
+
+        try:
+
+            controller.call \
+            (
+                "CopyObject",
+                bucket.meta.client.copy_object,
+                Bucket = bucket.name,
+                Key = key_path,
+                CopySource = { "Bucket": bucket.name, "Key": source_key },
+                **extra_args
+            )
+
+        except Exception as error:
+
+            if get_error_code(error) in ("NoSuchKey", "404"):
+
+                print(f"Copying {source_key} to {key_path} failed, as the source is gone => {error}")
+                return False
+
+            raise
+
+        return True
+
+
+# Curry the get_s3_client, get_bucket, and copy_object functions into the copy_files_template function
+copy_files = copy_files_template(get_s3_client)(get_bucket)(copy_object)
+
 
 class S3Updater:
 
     """Wrapper class that makes calling upload_files and delete_files a little nicer"""
 
     @staticmethod
-    def upload_files(local_file_set, local_path, s3_bucket, s3_path):
+    def upload_files \
+    (
+        local_file_set,
+        local_path,
+        s3_bucket,
+        s3_path,
+        checksum = None,
+        canonical_hash_func = None,
+        gate_func = None,
+        pace_func = None
+    ):
 
         """
-        Upload files to an S3 bucket
+        Upload files to an S3 bucket. Large files are uploaded first, largest first, so that they don't stretch the
+        end of the run (see publish_scheduler.largest_first); the rest keep the order they were given in.
 
         :param local_file_set: The set of local files to upload
         :param local_path: The path to the local files to upload
         :param s3_bucket: The S3 bucket to which to upload
         :param s3_path: The path into the S3 bucket to which to upload
+        :param checksum: The checksum algorithm (see checksums.CHECKSUMS) to upload with, or None
+        :param canonical_hash_func: A function that computes the canonical hash of a file's bytes to store in the
+                                    object's metadata (see semantic_hash), or None
+        :param gate_func: A function called with each local file just before it is uploaded, on the same worker, that
+                          returns whether to upload it (e.g. template_validator.ValidationGate), or None
+        :param pace_func: A function that takes the files in upload order and yields each one when it may be uploaded
+                          (e.g. publish_scheduler.PublishPacer.paced), or None; it runs on the calling thread
         :return: Nothing
         """
 
-        return upload_files(local_file_set)(local_path)(s3_bucket)(s3_path)
+        upload_file_func = upload_file
+
+        if (checksum is not None and checksum.s3_algorithm is not None) or canonical_hash_func is not None:
+
+            get_upload_args_func = lambda file_path: \
+                lambda data_bytes: get_object_upload_args(checksum, canonical_hash_func, file_path, data_bytes)
+
+            upload_file_func = lambda bucket, file_path, key_path: \
+                upload_file_with_args(get_upload_args_func(file_path))(bucket)(file_path)(key_path)
+
+        if gate_func is not None:
+
+            ungated_upload_file_func = upload_file_func
+
+            upload_file_func = lambda bucket, file_path, key_path: \
+                gate_func(file_path) and ungated_upload_file_func(bucket, file_path, key_path)
+
+        upload_order = largest_first(local_file_set, lambda file: os.path.getsize(prepend_path(local_path, file)))
+
+        if pace_func is not None:
+
+            upload_order = pace_func(upload_order)
+
+        with metrics.span("upload_files", s3_path = s3_path):
+
+            return upload_files_template            \
+                (get_s3_client)                     \
+                (get_bucket)                        \
+                (upload_file_func)                  \
+                (upload_order)                      \
+                (local_path)                        \
+                (s3_bucket)                         \
+                (s3_path)
+
+    @staticmethod
+    def copy_files(copy_list, s3_bucket, checksum = None, pace_func = None):
+
+        """
+        Copy objects within an S3 bucket
+
+        :param copy_list: The list of (source key, destination key) tuples to copy
+        :param s3_bucket: The S3 bucket in which to copy
+        :param checksum: The checksum algorithm (see checksums.CHECKSUMS) for S3 to compute for the copies, or None
+        :param pace_func: A function that takes the list of tuples and yields each one when it may be copied (e.g.
+                          publish_scheduler.PublishPacer.paced), or None; it runs on the calling thread
+        :return: The list of (source key, destination key) tuples that could not be copied as the source was gone
+        """
+
+        copy_object_func = lambda bucket, source_key, key_path: copy_object(bucket, source_key, key_path, checksum)
+
+        if pace_func is not None:
+
+            copy_list = pace_func(copy_list)
+
+        with metrics.span("copy_files"):
+
+            return copy_files_template(get_s3_client)(get_bucket)(copy_object_func)(copy_list)(s3_bucket)
 
     @staticmethod
     def delete_files(key_list, s3_bucket):
@@ -184,7 +490,9 @@ class S3Updater:
         :return: A MultiDeleteResult object detailing the keys that were deleted and any errors encountered
         """
 
-        return delete_files(key_list)(s3_bucket)
+        with metrics.span("delete_files"):
+
+            return delete_files(key_list)(s3_bucket)
 
 
 class PyTests:
@@ -200,7 +508,7 @@ class PyTests:
 
         expected_bucket_name = "my_bucket"
 
-        s3 = get_s3_client()
+        s3 = registry.create_resource("s3")
 
         expected_bucket = s3.Bucket(expected_bucket_name)
 
@@ -285,6 +593,39 @@ class PyTests:
         assert len(res.errors) == 1
         assert res.errors[0] == "key3"
 
+    @staticmethod
+    def test_delete_keys_should_send_at_most_max_delete_keys_per_request():
+
+        key_list = [f"key{index}" for index in range(MAX_DELETE_KEYS * 2 + 1)]
+        batch_sizes = []
+
+        def hijacked_delete_objects(Delete):
+            batch_sizes.append(len(Delete["Objects"]))
+            return { "Deleted": [obj["Key"] for obj in Delete["Objects"]] }
+
+        bucket = get_bucket(get_s3_client(), "my_bucket")
+        bucket.delete_objects = hijacked_delete_objects
+
+        res = delete_keys(bucket, iter(key_list))
+
+        assert sorted(batch_sizes) == [1, MAX_DELETE_KEYS, MAX_DELETE_KEYS]
+        assert res.deleted == key_list
+        assert res.errors == []
+
+    @staticmethod
+    def test_delete_keys_should_not_call_delete_objects_without_keys():
+
+        def hijacked_delete_objects(Delete):
+            assert False
+
+        bucket = get_bucket(get_s3_client(), "my_bucket")
+        bucket.delete_objects = hijacked_delete_objects
+
+        res = delete_keys(bucket, [])
+
+        assert res.deleted == []
+        assert res.errors == []
+
     @staticmethod
     def test_upload_files_template_should_call_get_bucket_func_with_correct_parameter():
 
@@ -326,6 +667,7 @@ class PyTests:
 
         actual_parameters = []
 
+        # Uploads run concurrently, so they may complete in any order
         def my_upload_file(s3_bucket, local_file, s3_path):
             assert s3_bucket == bucket
             actual_parameters.append((s3_path, local_file))
@@ -339,12 +681,158 @@ class PyTests:
             (bucket)                        \
             (s3_path)
 
-        assert actual_parameters == expected_parameters
+        assert sorted(actual_parameters) == sorted(expected_parameters)
+
+    @staticmethod
+    def test_copy_files_template_should_call_copy_object_func_for_each_pair():
 
+        bucket = "my_bucket"
+        copy_list = [("stacks/old/a.yaml", "stacks/new/a.yaml"), ("stacks/old/b.yaml", "stacks/new/b.yaml")]
+        actual_parameters = []
 
+        def my_copy_object(s3_bucket, source_key, key_path):
+            assert s3_bucket == bucket
+            actual_parameters.append((source_key, key_path))
+            return source_key != "stacks/old/b.yaml"
 
+        not_copied = copy_files_template    \
+            (get_s3_client)                 \
+            (lambda s3, s3_bucket: bucket)  \
+            (my_copy_object)                \
+            (iter(copy_list))               \
+            (bucket)
+
+        assert sorted(actual_parameters) == copy_list
+        assert not_copied == [("stacks/old/b.yaml", "stacks/new/b.yaml")]
+
+    @staticmethod
+    def test_copy_object_should_copy_within_the_bucket():
+
+        calls = []
+
+        s3 = registry.create_resource("s3")
+        bucket = s3.Bucket("my_bucket")
+        bucket.meta.client.copy_object = lambda **kwargs: calls.append(kwargs)
+
+        assert copy_object(bucket, "stacks/old.yaml", "stacks/new.yaml")
+        assert calls == \
+        [
+            {
+                "Bucket": "my_bucket",
+                "Key": "stacks/new.yaml",
+                "CopySource": { "Bucket": "my_bucket", "Key": "stacks/old.yaml" }
+            }
+        ]
+
+    @staticmethod
+    def test_copy_object_should_report_a_missing_source():
+
+        class NoSuchKey(Exception):
+            response = { "Error": { "Code": "NoSuchKey" } }
+
+        def missing_copy_object(**kwargs):
+            raise NoSuchKey()
+
+        s3 = registry.create_resource("s3")
+        bucket = s3.Bucket("my_bucket")
+        bucket.meta.client.copy_object = missing_copy_object
+
+        assert not copy_object(bucket, "stacks/old.yaml", "stacks/new.yaml")
+
+    @staticmethod
+    def test_upload_file_with_args_template_uploads_the_bytes_it_computed_the_args_from():
+
+        from checksums import CHECKSUMS
+
+        calls = []
+
+        client = Struct(put_object = lambda **kwargs: calls.append(kwargs))
+        bucket = Struct(name = "my_bucket", meta = Struct(client = client))
+        get_args = lambda data_bytes: \
+            get_object_upload_args(CHECKSUMS["sha256"], lambda data: data.decode(), "local/a.yaml", data_bytes)
+
+        upload_file_with_args_template(lambda file: b"abc")(get_args)(bucket)("local/a.yaml")("s3/a.yaml")
+
+        assert calls == \
+        [
+            {
+                "Bucket": "my_bucket",
+                "Key": "s3/a.yaml",
+                "Body": b"abc",
+                "ChecksumSHA256": "ungWv48Bz+pBQUDeXa4iI7ADYaOWF3qctBD/YfIAFa0=",
+                "Metadata":
+                {
+                    "cloudgenesis-sha256": "ungWv48Bz+pBQUDeXa4iI7ADYaOWF3qctBD/YfIAFa0=",
+                    CANONICAL_METADATA_KEY: "abc"
+                }
+            }
+        ]
+
+    @staticmethod
+    def test_get_object_upload_args_only_stores_canonical_hashes_of_yaml_and_json_files():
+
+        canonical_hash_func = lambda data: "canonical"
+
+        assert get_object_upload_args(None, canonical_hash_func, "a/t.YAML", b"x") == \
+               { "Metadata": { CANONICAL_METADATA_KEY: "canonical" } }
+        assert get_object_upload_args(None, canonical_hash_func, "a/app.py", b"x") == {}
+        assert get_object_upload_args(None, None, "a/t.yaml", b"x") == {}
+
+    @staticmethod
+    def test_upload_file_with_args_template_uploads_large_files_in_parts():
+
+        calls = []
+
+        def my_upload_fileobj(file_data, key_path, ExtraArgs, Config):
+            calls.append((len(file_data.read()), key_path, ExtraArgs, Config.multipart_chunksize))
+
+        bucket = Struct(upload_fileobj = my_upload_fileobj)
+        data_bytes = b"x" * MULTIPART_THRESHOLD
+
+        get_args = lambda data: { "Metadata": {} }
+
+        upload_file_with_args_template(lambda file: data_bytes)(get_args)(bucket)("a.zip")("s3/a.zip")
+
+        assert calls == [(MULTIPART_THRESHOLD, "s3/a.zip", { "Metadata": {} }, MULTIPART_CHUNKSIZE)]
+
+    @staticmethod
+    def test_upload_file_with_args_template_uploads_large_files_with_the_checksum_in_metadata_only():
+
+        from checksums import CHECKSUMS
+
+        calls = []
+
+        def my_upload_fileobj(file_data, key_path, ExtraArgs, Config):
+            calls.append(ExtraArgs)
+
+        bucket = Struct(upload_fileobj = my_upload_fileobj)
+        data_bytes = b"x" * (MULTIPART_THRESHOLD + 1)
+
+        for checksum in (CHECKSUMS["crc32c"], CHECKSUMS["sha256"]):
+
+            get_args = lambda data: get_object_upload_args(checksum, lambda data: "canonical", "a.json", data)
+
+            upload_file_with_args_template(lambda file: data_bytes)(get_args)(bucket)("a.zip")("s3/a.zip")
+
+            assert calls.pop() == \
+            {
+                "Metadata":
+                {
+                    checksum.metadata_key: checksum.checksum_func(data_bytes),
+                    CANONICAL_METADATA_KEY: "canonical"
+                }
+            }
+
+    @staticmethod
+    def test_upload_file_puts_small_files_with_one_request(tmp_path):
 
+        calls = []
 
+        (tmp_path / "a.yaml").write_bytes(b"abc")
 
+        client = Struct(put_object = lambda **kwargs: calls.append(kwargs))
+        bucket = Struct(name = "my_bucket", meta = Struct(client = client))
 
+        upload_file(bucket, str(tmp_path / "a.yaml"), "stacks/a.yaml")
 
+        assert calls == [{ "Bucket": "my_bucket", "Key": "stacks/a.yaml", "Body": b"abc" }]
@@ -0,0 +1,257 @@
+import os
+import json
+import hashlib
+import threading
+from curried import curried
+from instrumentation import metrics
+from rate_controller import controller
+from worker_pool import shared_pool
+from file_set_loader import Item, get_s3_client, read_bytes
+
+
+# The object metadata key the canonical hash of an uploaded file is stored under
+CANONICAL_METADATA_KEY = "cloudgenesis-canonical-md5"
+
+# The file extensions that are parsed to compute a canonical hash
+CANONICAL_EXTENSIONS = (".yaml", ".yml", ".json", ".template")
+
+
+def canonicalize(data_bytes):
+
+    """
+    Converts YAML or JSON (including CloudFormation short-form tags) into a canonical form that doesn't depend on
+    whitespace, comments, quoting, mapping key order or the use of short or long form intrinsic functions
+
+    :param data_bytes: The bytes of the file
+    :return: The canonical form as bytes, or None if the file can't be parsed
+    """
+
+    import yaml
+    import cfn_yaml
+
+    try:
+
+        document = cfn_yaml.load(data_bytes)
+
+    except (yaml.YAMLError, UnicodeDecodeError, ValueError):
+
+        return None
+
+    # Timestamps (e.g. an unquoted AWSTemplateFormatVersion) are compared as their ISO format strings
+    return json.dumps(document, sort_keys = True, separators = (",", ":"), default = str).encode("utf-8")
+
+
+class CanonicalHasher:
+
+    """
+    Computes canonical hashes, caching them by the MD5 of the raw bytes so each distinct file is only parsed once per run
+    """
+
+    def __init__(self, canonicalize_func = canonicalize):
+
+        self.lock = threading.Lock()
+        self.canonicalize_func = canonicalize_func
+        self.hashes = {}
+
+    def hash_bytes(self, data_bytes):
+
+        """
+        Computes the canonical hash of a file's bytes
+
+        :param data_bytes: The bytes of the file
+        :return: The MD5 of the canonical form, or None if the file can't be parsed
+        """
+
+        raw_hash = hashlib.md5(data_bytes).hexdigest()
+
+        with self.lock:
+
+            if raw_hash in self.hashes:
+
+                metrics.count("canonical_hash_cache_hits")
+                return self.hashes[raw_hash]
+
+        with metrics.span("local.canonicalize"):
+
+            canonical = self.canonicalize_func(data_bytes)
+
+        value = None if canonical is None else hashlib.md5(canonical).hexdigest()
+
+        with self.lock:
+
+            self.hashes[raw_hash] = value
+
+        return value
+
+
+# The canonical hasher shared by every stage during a run
+canonical_hasher = CanonicalHasher()
+
+
+def get_remote_canonical_hash(s3, bucket, key):
+
+    """
+    Gets the canonical hash stored in an S3 object's metadata
+
+    :param s3: An S3 client
+    :param bucket: The S3 bucket the object is in
+    :param key: The key of the object
+    :return: The canonical hash, or None if the object doesn't have one
+    """
+
+    with metrics.span("s3.head_object", key = key):
+
+        response = controller.call("HeadObject", s3.head_object, Bucket = bucket, Key = key)
+
+    return response.get("Metadata", {}).get(CANONICAL_METADATA_KEY)
+
+
+@curried
+def filter_semantic_changes_template \
+(
+    get_s3_client_func,
+    get_remote_canonical_hash_func,
+    read_bytes_func,
+    hasher,
+    local_path,
+    s3_bucket,
+    s3_path,
+    local_files_changed,
+    s3_file_set
+):
+
+    """
+    Curried template function for leaving out changed files whose canonical hash equals the canonical hash stored on
+    the S3 object with the same name, i.e. files whose only changes are formatting, comments or key order. Files are
+    checked concurrently on the shared worker pool.
+
+    :param get_s3_client_func: A function that returns an S3 client
+    :param get_remote_canonical_hash_func: A function that gets the canonical hash stored on an S3 object
+    :param read_bytes_func: The function to use to read the bytes from a local file
+    :param hasher: The CanonicalHasher to compute canonical hashes with
+    :param local_path: The local directory the changed files are in
+    :param s3_bucket: The S3 bucket the S3 files are in
+    :param s3_path: The path into the S3 bucket the S3 files are in
+    :param local_files_changed: The set of local files that changed byte for byte
+    :param s3_file_set: The set of S3 files
+    :return: The set of local files that changed semantically
+    """
+
+    s3_file_names = set(item.file for item in s3_file_set)
+
+    candidates = \
+    [
+        item
+        for item in local_files_changed
+        if item.file in s3_file_names and item.file.lower().endswith(CANONICAL_EXTENSIONS)
+    ]
+
+    if len(candidates) == 0:
+
+        return local_files_changed
+
+    s3 = get_s3_client_func()
+
+    def is_unchanged(item):
+
+        local_hash = hasher.hash_bytes(read_bytes_func(os.path.join(local_path, item.file)))
+
+        return local_hash is not None and \
+               local_hash == get_remote_canonical_hash_func(s3, s3_bucket, s3_path + "/" + item.file)
+
+    unchanged = set(item for item, was_unchanged in zip(candidates, shared_pool.map(is_unchanged, candidates))
+                    if was_unchanged)
+
+    metrics.count("files_unchanged_semantically", len(unchanged))
+
+    return local_files_changed.difference(unchanged)
+
+
+# Curry the get_s3_client, get_remote_canonical_hash, read_bytes and canonical_hasher into the
+# filter_semantic_changes_template function
+filter_semantic_changes = filter_semantic_changes_template  \
+    (get_s3_client)                                         \
+    (get_remote_canonical_hash)                             \
+    (read_bytes)                                            \
+    (canonical_hasher)
+
+
+class PyTests:
+
+    @staticmethod
+    def test_canonical_hash_ignores_formatting_comments_and_key_order():
+
+        hasher = CanonicalHasher()
+
+        original = b"Resources:\n  Bucket:\n    Type: AWS::S3::Bucket\n    Properties:\n      Name: !Ref Name\n"
+        reformatted = b"# A comment\nResources:\n    Bucket:\n        Properties: { Name: { Ref: Name } }\n" + \
+                      b"        Type: 'AWS::S3::Bucket'   # trailing\n"
+        changed = b"Resources:\n  Bucket:\n    Type: AWS::S3::Bucket\n    Properties:\n      Name: !Ref Other\n"
+
+        assert hasher.hash_bytes(original) == hasher.hash_bytes(reformatted)
+        assert hasher.hash_bytes(original) != hasher.hash_bytes(changed)
+
+    @staticmethod
+    def test_canonical_hash_matches_between_yaml_and_json():
+
+        hasher = CanonicalHasher()
+
+        assert hasher.hash_bytes(b"AWSTemplateFormatVersion: 2010-09-09\nA: [1, 2]\n") == \
+               hasher.hash_bytes(b'{ "A": [1, 2], "AWSTemplateFormatVersion": "2010-09-09" }')
+
+    @staticmethod
+    def test_canonical_hash_is_none_for_unparseable_files():
+
+        assert CanonicalHasher().hash_bytes(b"A: [unclosed\n") is None
+        assert CanonicalHasher().hash_bytes(b"\xff\xfe\x00") is None
+
+    @staticmethod
+    def test_canonical_hasher_parses_each_distinct_file_once():
+
+        parsed = []
+
+        def my_canonicalize(data_bytes):
+            parsed.append(data_bytes)
+            return data_bytes
+
+        hasher = CanonicalHasher(my_canonicalize)
+
+        for data_bytes in (b"a", b"b", b"a", b"a"):
+            hasher.hash_bytes(data_bytes)
+
+        assert parsed == [b"a", b"b"]
+
+    @staticmethod
+    def test_filter_semantic_changes_template_leaves_out_formatting_only_changes():
+
+        files = \
+        {
+            os.path.join("root", "reformatted.yaml"): b"A:   1 # comment\n",
+            os.path.join("root", "changed.yaml"): b"A: 2\n",
+            os.path.join("root", "notes.txt"): b"A: 1\n",
+            os.path.join("root", "new.yaml"): b"A: 1\n"
+        }
+        hasher = CanonicalHasher()
+        remote_hash = hasher.hash_bytes(b"A: 1\n")
+        heads = []
+
+        def my_get_remote_canonical_hash(s3, bucket, key):
+            heads.append(key)
+            return remote_hash
+
+        local_files_changed = { Item("", name) for name in ("reformatted.yaml", "changed.yaml", "notes.txt", "new.yaml") }
+        s3_file_set = { Item("", name, "etag") for name in ("reformatted.yaml", "changed.yaml", "notes.txt") }
+
+        res = filter_semantic_changes_template  \
+            (lambda: "s3")                      \
+            (my_get_remote_canonical_hash)      \
+            (files.get)                         \
+            (hasher)                            \
+            ("root")                            \
+            ("bucket")                          \
+            ("stacks")                          \
+            (local_files_changed)               \
+            (s3_file_set)
+
+        assert res == { Item("", "changed.yaml"), Item("", "notes.txt"), Item("", "new.yaml") }
+        assert sorted(heads) == ["stacks/changed.yaml", "stacks/reformatted.yaml"]
@@ -0,0 +1,222 @@
+import os
+import hashlib
+import argparse
+from common import Struct
+from curried import curried
+from instrumentation import metrics
+from rate_controller import controller
+from worker_pool import shared_pool
+
+
+def parse_shard(value):
+
+    """
+    Parses a shard specification of the form "i/N" (shard i of N shards, counting from 0)
+
+    :param value: The shard specification
+    :return: A Struct with the shard's index and count
+    """
+
+    try:
+
+        index, count = (int(part) for part in value.split("/"))
+
+    except ValueError:
+
+        raise argparse.ArgumentTypeError(f"shard must look like i/N, not {value!r}")
+
+    if count < 1 or index < 0 or index >= count:
+
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and N - 1, not {value!r}")
+
+    return Struct(index = index, count = count)
+
+
+def shard_of(name, count):
+
+    """
+    Assigns a top-level name (e.g. an account directory) to a shard. The assignment only depends on the name, so every
+    build worker agrees on it.
+
+    :param name: The top-level directory or file name
+    :param count: The number of shards
+    :return: The index of the shard the name belongs to
+    """
+
+    return int(hashlib.md5(name.encode("utf-8")).hexdigest(), 16) % count
+
+
+def in_shard(name, shard):
+
+    """
+    Determines if a top-level name belongs to a shard
+
+    :param name: The top-level directory or file name
+    :param shard: The shard, or None if the work isn't sharded
+    :return: Whether the name belongs to the shard
+    """
+
+    return shard is None or shard_of(name, shard.count) == shard.index
+
+
+@curried
+def shard_walk_template(list_files_func, shard, local_path):
+
+    """
+    Curried template function for walking only a shard of a local directory. Top-level directories outside the shard
+    are pruned before they are descended into, and top-level files outside the shard are skipped.
+
+    :param list_files_func: A function that walks a local directory top-down like os.walk
+    :param shard: The shard to walk
+    :param local_path: The local directory to walk
+    :return: A generator that yields (root, dir_names, file_names) tuples like os.walk
+    """
+
+    for root, dir_names, file_names in list_files_func(local_path):
+
+        if root == local_path:
+
+            dir_names[:] = [name for name in dir_names if in_shard(name, shard)]
+            file_names = [name for name in file_names if in_shard(name, shard)]
+
+        yield root, dir_names, file_names
+
+
+@curried
+def get_shard_keys_from_bucket_template(get_prefixed_keys_from_bucket_func, shard, s3, bucket, s3_path):
+
+    """
+    Curried template function for listing only a shard of a path into an S3 bucket. The top level of the path is
+    listed with a delimiter, then each top-level "directory" in the shard is listed concurrently.
+
+    :param get_prefixed_keys_from_bucket_func: A function that gets a list of S3 keys with the specified prefix
+    :param shard: The shard to list
+    :param s3: An S3 client
+    :param bucket: The S3 bucket to query
+    :param s3_path: The path into the S3 bucket to query
+    :return: A generator that lists keys from the S3 bucket in the shard
+    """
+
+    root = s3_path + "/"
+    kwargs = { "Bucket": bucket, "Prefix": root, "Delimiter": "/" }
+    keys = []
+    prefixes = []
+
+    while True:
+
+        with metrics.span("s3.list_objects_v2", prefix = root):
+
+            response = controller.call("ListObjectsV2", s3.list_objects_v2, **kwargs)
+
+        for key in response.get("Contents", []):
+
+            if in_shard(key["Key"][len(root):], shard):
+
+                keys.append(Struct(name = key["Key"], etag = key["ETag"], size = key["Size"]))
+
+        for prefix in response.get("CommonPrefixes", []):
+
+            if in_shard(prefix["Prefix"][len(root):].rstrip("/"), shard):
+
+                prefixes.append(prefix["Prefix"])
+
+        try:
+
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+        except KeyError:
+
+            break
+
+    listings = shared_pool.map(lambda prefix: list(get_prefixed_keys_from_bucket_func(s3, bucket, prefix)), prefixes)
+
+    yield from keys
+
+    for listing in listings:
+
+        yield from listing
+
+
+class PyTests:
+
+    @staticmethod
+    def test_parse_shard_parses_index_and_count():
+
+        assert parse_shard("2/5") == Struct(index = 2, count = 5)
+
+    @staticmethod
+    def test_parse_shard_rejects_invalid_specifications():
+
+        for value in ("5/5", "-1/2", "1/0", "1", "a/b", "1/2/3"):
+            try:
+                parse_shard(value)
+                assert False, value
+            except argparse.ArgumentTypeError:
+                pass
+
+    @staticmethod
+    def test_every_name_belongs_to_exactly_one_shard():
+
+        names = [f"account-{index}.{index:012d}" for index in range(200)]
+        shards = [Struct(index = index, count = 4) for index in range(4)]
+
+        for name in names:
+            assert sum(in_shard(name, shard) for shard in shards) == 1
+
+        # The assignment should spread the names over every shard
+        assert all(any(in_shard(name, shard) for name in names) for shard in shards)
+
+    @staticmethod
+    def test_shard_of_is_stable():
+
+        assert shard_of("account-alias.123456789012", 7) == shard_of("account-alias.123456789012", 7)
+        assert shard_of("account-alias.123456789012", 1) == 0
+
+    @staticmethod
+    def test_shard_walk_template_prunes_top_level_directories_outside_the_shard(tmp_path):
+
+        root = str(tmp_path)
+        names = [f"account{index}" for index in range(20)]
+
+        for name in names:
+            os.makedirs(os.path.join(root, name, "us-east-1"))
+            with open(os.path.join(root, name, "us-east-1", "stack.yaml"), "w") as file_data:
+                file_data.write(name)
+
+        shard = Struct(index = 1, count = 3)
+        walked = [path for path, dir_names, file_names in shard_walk_template(os.walk)(shard)(root)]
+
+        expected = [name for name in names if in_shard(name, shard)]
+
+        assert sorted(os.path.relpath(path, root).split(os.path.sep)[0] for path in walked if path != root) == \
+               sorted(expected * 2)
+
+    @staticmethod
+    def test_get_shard_keys_from_bucket_template_only_lists_the_shard():
+
+        shard = Struct(index = 0, count = 2)
+        accounts = [f"account{index}" for index in range(10)]
+        listed_prefixes = []
+
+        def my_list_objects_v2(**kwargs):
+            assert kwargs == { "Bucket": "bucket", "Prefix": "stacks/", "Delimiter": "/" }
+            return \
+            {
+                "Contents": [{ "Key": f"stacks/{name}.yaml", "ETag": "e", "Size": 1 } for name in accounts],
+                "CommonPrefixes": [{ "Prefix": f"stacks/{name}/" } for name in accounts]
+            }
+
+        def my_get_prefixed_keys_from_bucket(s3, bucket, prefix):
+            listed_prefixes.append(prefix)
+            return [Struct(name = prefix + "stack.yaml", etag = "e", size = 1)]
+
+        s3 = Struct(list_objects_v2 = my_list_objects_v2)
+
+        keys = list(get_shard_keys_from_bucket_template(my_get_prefixed_keys_from_bucket)(shard)(s3)("bucket")("stacks"))
+
+        expected = [name for name in accounts if in_shard(name, shard)]
+        expected_files = [name for name in accounts if in_shard(f"{name}.yaml", shard)]
+
+        assert sorted(listed_prefixes) == sorted(f"stacks/{name}/" for name in expected)
+        assert sorted(key.name for key in keys) == \
+               sorted([f"stacks/{name}.yaml" for name in expected_files] + [f"stacks/{name}/stack.yaml" for name in expected])
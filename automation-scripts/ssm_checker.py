@@ -0,0 +1,273 @@
+import json
+import time
+import threading
+from curried import curried
+from instrumentation import metrics
+from rate_controller import controller
+from aws_clients import registry
+from worker_pool import shared_pool
+from git_index import storage_for_location
+
+
+# The most names SSM accepts in a single GetParameters request
+MAX_GET_PARAMETERS_NAMES = 10
+
+# How long a parameter that was seen to exist is trusted to still exist, in seconds
+DEFAULT_SSM_CACHE_TTL = 3600
+
+
+def get_ssm_client():
+
+    """Returns the shared SSM client for use by other functions"""
+
+    return registry.get_client("ssm")
+
+
+class LocalParameterStore:
+
+    """
+    A local stand-in for the SSM client's GetParameters, for checking stack files without AWS (e.g. in tests)
+    """
+
+    def __init__(self, names):
+
+        self.names = set(names)
+
+    def get_parameters(self, Names, WithDecryption = False):
+
+        """
+        Looks up parameters like SSM's GetParameters, without their values
+
+        :param Names: The names of the parameters
+        :param WithDecryption: Ignored; no values are returned
+        :return: A GetParameters response with the Parameters that exist and the InvalidParameters that don't
+        """
+
+        return \
+        {
+            "Parameters": [{ "Name": name } for name in Names if name in self.names],
+            "InvalidParameters": [name for name in Names if name not in self.names]
+        }
+
+
+def load_local_parameter_store(path):
+
+    """
+    Loads a local stand-in for SSM from a JSON file
+
+    :param path: The path of a JSON list of parameter names, or of an object keyed by parameter name
+    :return: The LocalParameterStore
+    """
+
+    with open(path, "r") as store_data:
+
+        return LocalParameterStore(json.load(store_data))
+
+
+class SsmNameCache:
+
+    """
+    A persistent set of the SSM parameter names that were seen to exist lately, so that repeated runs don't look them
+    up again. Names that don't exist are never cached, so a parameter created to fix a build is seen right away.
+    """
+
+    def __init__(self, read_func, write_func, ttl = DEFAULT_SSM_CACHE_TTL, clock = time.time):
+
+        self.lock = threading.Lock()
+        self.read_func = read_func
+        self.write_func = write_func
+        self.ttl = ttl
+        self.clock = clock
+        self.checked = {}
+        self.changed = False
+
+    def load(self):
+
+        """Loads the cache from its storage, starting empty if it doesn't exist or can't be read"""
+
+        try:
+
+            data = self.read_func()
+            checked = json.loads(data.decode("utf-8")) if data else {}
+
+        except Exception as error:
+
+            print(f"Loading the SSM name cache failed, starting empty => {error}")
+            checked = {}
+
+        with self.lock:
+
+            self.checked = checked
+            self.changed = False
+
+        return self
+
+    def exists(self, name):
+
+        """
+        Checks whether a parameter was seen to exist within the cache's time to live
+
+        :param name: The name of the parameter
+        :return: Whether the parameter is known to exist
+        """
+
+        with self.lock:
+
+            return self.clock() - self.checked.get(name, float("-inf")) < self.ttl
+
+    def add(self, names):
+
+        """
+        Records that parameters exist
+
+        :param names: The names of the parameters
+        :return: Nothing
+        """
+
+        now = self.clock()
+
+        with self.lock:
+
+            for name in names:
+
+                self.checked[name] = now
+                self.changed = True
+
+    def save(self):
+
+        """Writes the cache back to its storage if anything changed, dropping names that have expired"""
+
+        now = self.clock()
+
+        with self.lock:
+
+            if not self.changed:
+
+                return
+
+            checked = { name: checked_at for name, checked_at in self.checked.items() if now - checked_at < self.ttl }
+            data = json.dumps(checked, separators = (",", ":"), sort_keys = True).encode("utf-8")
+            self.changed = False
+
+        with metrics.span("ssm.save_name_cache"):
+
+            self.write_func(data)
+
+
+def open_ssm_name_cache(location, ttl = DEFAULT_SSM_CACHE_TTL):
+
+    """
+    Opens and loads the SSM name cache at a location
+
+    :param location: Either an s3://bucket/key URI or a local file path
+    :param ttl: How long a parameter that was seen to exist is trusted to still exist, in seconds
+    :return: The loaded SsmNameCache
+    """
+
+    with metrics.span("ssm.load_name_cache"):
+
+        return SsmNameCache(*storage_for_location(location), ttl = ttl).load()
+
+
+@curried
+def find_missing_parameters_template(get_ssm_client_func, cache, names):
+
+    """
+    Curried template function for finding which SSM parameters don't exist. Names that aren't cached are looked up in
+    batches of MAX_GET_PARAMETERS_NAMES, concurrently on the shared worker pool.
+
+    :param get_ssm_client_func: A function that returns an SSM client (or a stand-in, see LocalParameterStore)
+    :param cache: The SsmNameCache of the names that exist, or None not to cache
+    :param names: The names of the parameters
+    :return: The set of names that don't exist
+    """
+
+    names = sorted(set(names))
+    unknown = [name for name in names if cache is None or not cache.exists(name)]
+
+    metrics.count("ssm_names_checked", len(unknown))
+    metrics.count("ssm_names_cached", len(names) - len(unknown))
+
+    if len(unknown) == 0:
+
+        return set()
+
+    client = get_ssm_client_func()
+
+    def get_parameters(batch):
+
+        with metrics.span("ssm.get_parameters", names = len(batch)):
+
+            response = controller.call("GetParameters", client.get_parameters, Names = batch, WithDecryption = False)
+
+        return response.get("InvalidParameters", [])
+
+    batches = \
+    [
+        unknown[index:index + MAX_GET_PARAMETERS_NAMES]
+        for index in range(0, len(unknown), MAX_GET_PARAMETERS_NAMES)
+    ]
+    missing = set(name for invalid in shared_pool.map(get_parameters, batches) for name in invalid)
+
+    if cache is not None:
+
+        cache.add(name for name in unknown if name not in missing)
+
+    return missing
+
+
+# Curry the get_ssm_client function into the find_missing_parameters_template function
+find_missing_parameters = find_missing_parameters_template(get_ssm_client)
+
+
+class PyTests:
+
+    @staticmethod
+    def test_find_missing_parameters_batches_names_and_caches_the_ones_that_exist():
+
+        store = LocalParameterStore([f"/app/{index}" for index in range(25)])
+        requests = []
+
+        class RecordingStore:
+
+            @staticmethod
+            def get_parameters(Names, WithDecryption):
+
+                requests.append(list(Names))
+                return store.get_parameters(Names, WithDecryption)
+
+        stored = { "data": None }
+        now = [1000.0]
+
+        def write(data):
+            stored["data"] = data
+
+        cache = SsmNameCache(lambda: stored["data"], write, ttl = 60, clock = lambda: now[0]).load()
+        names = [f"/app/{index}" for index in range(25)] + ["/app/typo", "/app/typo", "/app/0"]
+
+        assert find_missing_parameters_template(lambda: RecordingStore)(cache)(names) == { "/app/typo" }
+        assert sorted(len(request) for request in requests) == [6, 10, 10]
+
+        cache.save()
+        requests.clear()
+        cache = SsmNameCache(lambda: stored["data"], write, ttl = 60, clock = lambda: now[0]).load()
+
+        # Only the missing name is looked up again, until the cached names expire
+        assert find_missing_parameters_template(lambda: RecordingStore)(cache)(names) == { "/app/typo" }
+        assert requests == [["/app/typo"]]
+
+        requests.clear()
+        now[0] += 60
+
+        assert find_missing_parameters_template(lambda: RecordingStore)(cache)(names) == { "/app/typo" }
+        assert sum(len(request) for request in requests) == 26
+
+    @staticmethod
+    def test_load_local_parameter_store_reads_names_or_objects(tmp_path):
+
+        (tmp_path / "names.json").write_text('["/a", "/b"]')
+        (tmp_path / "values.json").write_text('{"/a": "1"}')
+
+        assert load_local_parameter_store(str(tmp_path / "names.json")).get_parameters(Names = ["/a", "/c"]) == \
+               { "Parameters": [{ "Name": "/a" }], "InvalidParameters": ["/c"] }
+        assert load_local_parameter_store(str(tmp_path / "values.json")).names == { "/a" }
@@ -0,0 +1,264 @@
+import os
+import json
+import hashlib
+from common import Struct
+from instrumentation import metrics
+from rate_controller import controller
+from aws_clients import registry
+from worker_pool import shared_pool
+from file_set_loader import read_bytes
+from stack_linter import STACK_EXTENSIONS
+
+
+# The name of the index object kept in each "<account>/<region>" directory
+INDEX_FILE = "_index.json"
+
+# Bump whenever the shape of an index changes, so that readers can tell the shapes apart
+INDEX_VERSION = 1
+
+
+def index_directory(file):
+
+    """
+    Gets the "<account>/<region>" directory whose index lists a file
+
+    :param file: The path of the file relative to the top of the synced path
+    :return: The directory, separated by "/", or None if the file isn't inside an "<account>/<region>/" directory
+    """
+
+    parts = file.replace(os.sep, "/").split("/")
+
+    return None if len(parts) < 3 else "/".join(parts[:2])
+
+
+def is_index_file(file):
+
+    """
+    Checks whether a path is where an index object is kept
+
+    :param file: The path relative to the top of the synced path
+    :return: Whether the path is an "<account>/<region>/_index.json" index
+    """
+
+    parts = file.replace(os.sep, "/").split("/")
+
+    return len(parts) == 3 and parts[2] == INDEX_FILE
+
+
+def group_stack_files(local_set):
+
+    """
+    Groups the local stack files by the directory whose index lists them
+
+    :param local_set: The set of local files
+    :return: A dictionary of the sorted list of stack file paths in each "<account>/<region>" directory
+    """
+
+    groups = {}
+
+    for item in local_set:
+
+        directory = index_directory(item.file)
+
+        if directory is not None and item.file.lower().endswith(STACK_EXTENSIONS):
+
+            groups.setdefault(directory, []).append(item.file)
+
+    return { directory: sorted(files) for directory, files in groups.items() }
+
+
+def plan_indexes(indexes, existing, checksum = None):
+
+    """
+    Determines which indexes have to be written or deleted: those that are missing or differ from the index built from
+    the local files, and those of directories that no longer have stack files. Comparing every index, rather than only
+    those of directories this sync changed, repairs any index left stale (e.g. by a sync that failed before publishing
+    its indexes).
+
+    :param indexes: A dictionary of the bytes of the index built for each local directory (see build_index)
+    :param existing: A dictionary of the ETag (or stored checksum) of each index in the destination
+    :param checksum: The checksum algorithm (see checksums.CHECKSUMS) the destination was listed with, or None
+    :return: A Struct with the sets of directories whose index to write and to delete
+    """
+
+    def is_current(directory):
+
+        data_bytes = indexes[directory]
+        hashes = { hashlib.md5(data_bytes).hexdigest() }
+
+        if checksum is not None and checksum.s3_algorithm is not None:
+
+            hashes.add(checksum.checksum_func(data_bytes))
+
+        return existing.get(directory) in hashes
+
+    return Struct \
+    (
+        write = set(directory for directory in indexes if not is_current(directory)),
+        delete = set(existing).difference(indexes)
+    )
+
+
+def read_stack_template(data_bytes):
+
+    """
+    Reads the Template a stack file refers to
+
+    :param data_bytes: The contents of the stack file
+    :return: The Template, or None if the stack file doesn't name one
+    """
+
+    import yaml
+
+    try:
+
+        stack = yaml.safe_load(data_bytes)
+
+    except yaml.YAMLError:
+
+        return None
+
+    template = stack.get("Template") if isinstance(stack, dict) else None
+
+    return template if isinstance(template, str) else None
+
+
+def build_index(local_path, files):
+
+    """
+    Builds the index of the stack files in one directory
+
+    :param local_path: The local directory the files are in
+    :param files: The sorted paths of the stack files, relative to local_path
+    :return: The bytes of the index: compact JSON with the path, template and MD5 of each stack file. The MD5 is of
+             the local file as checked in, which may not match the object in S3 (e.g. when semantic hashing skipped
+             uploading a formatting-only change).
+    """
+
+    stacks = []
+
+    for file in files:
+
+        data_bytes = read_bytes(os.path.join(local_path, file))
+        stacks.append \
+        (
+            {
+                "path": file.replace(os.sep, "/"),
+                "template": read_stack_template(data_bytes),
+                "hash": hashlib.md5(data_bytes).hexdigest()
+            }
+        )
+
+    return json.dumps({ "version": INDEX_VERSION, "stacks": stacks }, separators = (",", ":")).encode("utf-8")
+
+
+def publish_indexes(s3_bucket, s3_path, indexes):
+
+    """
+    Writes and deletes index objects concurrently on the shared worker pool
+
+    :param s3_bucket: The name of the S3 bucket
+    :param s3_path: The path to the s3 "directory" the indexes are in
+    :param indexes: A dictionary of the bytes of the index of each directory, or None to delete a directory's index
+    :return: The number of indexes written and deleted
+    """
+
+    s3 = registry.get_client("s3")
+
+    def publish(directory):
+
+        key = f"{s3_path}/{directory}/{INDEX_FILE}"
+
+        with metrics.span("s3.publish_index", key = key):
+
+            if indexes[directory] is None:
+
+                controller.call("DeleteObject", s3.delete_object, Bucket = s3_bucket, Key = key)
+
+            else:
+
+                controller.call \
+                (
+                    "PutObject",
+                    s3.put_object,
+                    Bucket = s3_bucket,
+                    Key = key,
+                    Body = indexes[directory],
+                    ContentType = "application/json"
+                )
+
+    shared_pool.map(publish, sorted(indexes))
+    metrics.count("indexes_published", len(indexes))
+
+    return len(indexes)
+
+
+class PyTests:
+
+    @staticmethod
+    def test_index_directory_and_is_index_file():
+
+        assert index_directory("123456789012/us-east-1/app/stack.yaml") == "123456789012/us-east-1"
+        assert index_directory("123456789012/stack.yaml") is None
+        assert is_index_file("123456789012/us-east-1/_index.json")
+        assert not is_index_file("123456789012/us-east-1/app/_index.json")
+
+    @staticmethod
+    def test_group_stack_files_only_lists_the_yaml_files_that_are_deployed():
+
+        from file_set_loader import Item
+
+        local_set = \
+        {
+            Item("", "a/us-east-1/s.yaml", "1"),
+            Item("", "a/us-east-1/README.json", "2"),
+            Item("", "a/us-east-1/tool.yml", "3"),
+            Item("", "a/top.yaml", "4")
+        }
+
+        assert group_stack_files(local_set) == { "a/us-east-1": ["a/us-east-1/s.yaml"] }
+
+    @staticmethod
+    def test_plan_indexes_only_touches_stale_missing_and_emptied_directories():
+
+        from checksums import CHECKSUMS
+
+        indexes = { name: name.encode("utf-8") for name in ("a/us-east-1", "b/us-east-1", "c/us-east-1") }
+        existing = \
+        {
+            "a/us-east-1": hashlib.md5(b"a/us-east-1").hexdigest(),
+            "b/us-east-1": hashlib.md5(b"left stale by a failed sync").hexdigest(),
+            "d/us-east-1": "x"
+        }
+        plan = plan_indexes(indexes, existing)
+
+        assert plan.write == { "b/us-east-1", "c/us-east-1" }
+        assert plan.delete == { "d/us-east-1" }
+
+        # A destination listed with checksums may hold the stored checksum instead of the ETag
+        existing["b/us-east-1"] = CHECKSUMS["sha256"].checksum_func(b"b/us-east-1")
+
+        assert plan_indexes(indexes, existing, CHECKSUMS["sha256"]).write == { "c/us-east-1" }
+
+    @staticmethod
+    def test_build_index_lists_each_stack_file_with_its_template_and_hash(tmp_path):
+
+        (tmp_path / "a" / "us-east-1" / "app").mkdir(parents = True)
+        (tmp_path / "a" / "us-east-1" / "app" / "s.yaml").write_text("Template: app/t.yaml\n")
+        (tmp_path / "a" / "us-east-1" / "broken.yaml").write_text("Template: [")
+
+        index = json.loads(build_index(str(tmp_path), ["a/us-east-1/app/s.yaml", "a/us-east-1/broken.yaml"]))
+
+        assert index == \
+        {
+            "version": INDEX_VERSION,
+            "stacks":
+            [
+                {
+                    "path": "a/us-east-1/app/s.yaml",
+                    "template": "app/t.yaml",
+                    "hash": hashlib.md5(b"Template: app/t.yaml\n").hexdigest()
+                },
+                { "path": "a/us-east-1/broken.yaml", "template": None, "hash": hashlib.md5(b"Template: [").hexdigest() }
+            ]
+        }
@@ -0,0 +1,581 @@
+import os
+import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from instrumentation import metrics
+from file_set_loader import walk, read_bytes
+from git_index import open_blob_hash_cache
+from sync_ignore import load_sync_ignore, ignore_walk_template
+
+
+# Bump whenever a check in lint_stack_content changes, so that results cached by older rules aren't reused
+LINT_RULES_VERSION = 2
+
+# The extensions of the stack files that are linted; CloudGenesis only deploys *.yaml, so anything else in the stacks
+# directory (e.g. docs or tooling config) isn't a stack file
+STACK_EXTENSIONS = (".yaml",)
+
+# "<optional alias>.<12-digit account id>", where the alias can't hold a "."
+ACCOUNT_DIR_PATTERN = re.compile(r"^(?:[^.]+\.)?\d{12}$")
+
+# Standard AWS region codes (e.g. us-east-1, us-gov-west-1, ap-southeast-4)
+REGION_PATTERN = re.compile(r"^[a-z]{2}(?:-gov|-iso[a-z]?)?-[a-z]+-\d{1,2}$")
+
+# CloudFormation's limits on stack tags
+MAX_TAGS = 50
+MAX_TAG_KEY_LENGTH = 128
+MAX_TAG_VALUE_LENGTH = 256
+
+# The parameter types the downstream deployment understands, besides plain values
+PARAMETER_TYPES = ("SSM",)
+
+# Below this many files to parse, starting worker processes costs more than it saves
+MIN_PROCESS_POOL_FILES = 32
+
+
+def lint_stack_path(file):
+
+    """
+    Checks that a stack file is in a "<account>/<region>/" directory with a valid account id and region
+
+    :param file: The path of the stack file relative to the top of the stacks directory
+    :return: The list of errors
+    """
+
+    parts = file.replace(os.path.sep, "/").split("/")
+
+    if len(parts) < 3:
+
+        return ["must be in a <account>/<region>/ directory"]
+
+    errors = []
+
+    if not ACCOUNT_DIR_PATTERN.match(parts[0]):
+
+        errors.append(f"account directory {parts[0]!r} must be a 12-digit account id, optionally after 'alias.'")
+
+    if not REGION_PATTERN.match(parts[1]):
+
+        errors.append(f"region directory {parts[1]!r} must be an AWS region code (e.g. us-east-1)")
+
+    return errors
+
+
+def is_scalar(value):
+
+    """Returns whether a YAML value is a string, number or boolean"""
+
+    return isinstance(value, (str, int, float, bool))
+
+
+def lint_tags(tags):
+
+    """
+    Checks that a stack file's Tags are a list of unique Key/Value pairs within CloudFormation's limits
+
+    :param tags: The loaded Tags
+    :return: The list of errors
+    """
+
+    if not isinstance(tags, list):
+
+        return ["Tags must be a list of Key/Value pairs"]
+
+    errors = []
+    keys = set()
+
+    if len(tags) > MAX_TAGS:
+
+        errors.append(f"Tags has {len(tags)} tags, more than CloudFormation's limit of {MAX_TAGS}")
+
+    for index, tag in enumerate(tags):
+
+        if not isinstance(tag, dict) or "Key" not in tag or "Value" not in tag:
+
+            errors.append(f"Tags[{index}] must have a Key and a Value")
+            continue
+
+        key, value = tag["Key"], tag["Value"]
+
+        if not isinstance(key, str) or not 0 < len(key) <= MAX_TAG_KEY_LENGTH or key.startswith("aws:"):
+
+            errors.append(f"Tags[{index}] Key must be 1 to {MAX_TAG_KEY_LENGTH} characters, not starting 'aws:'")
+
+        elif key in keys:
+
+            errors.append(f"Tags[{index}] Key {key!r} is repeated")
+
+        keys.add(key)
+
+        if not is_scalar(value) or len(str(value)) > MAX_TAG_VALUE_LENGTH:
+
+            errors.append(f"Tags[{index}] Value must be a string of at most {MAX_TAG_VALUE_LENGTH} characters")
+
+    return errors
+
+
+def lint_parameters(parameters):
+
+    """
+    Checks that a stack file's Parameters are a list of uniquely named parameters with plain values
+
+    :param parameters: The loaded Parameters
+    :return: The list of errors
+    """
+
+    if not isinstance(parameters, list):
+
+        return ["Parameters must be a list of Name/Value pairs"]
+
+    errors = []
+    names = set()
+
+    for index, parameter in enumerate(parameters):
+
+        if not isinstance(parameter, dict) or "Name" not in parameter or "Value" not in parameter:
+
+            errors.append(f"Parameters[{index}] must have a Name and a Value")
+            continue
+
+        name, value = parameter["Name"], parameter["Value"]
+
+        if not isinstance(name, str) or name == "":
+
+            errors.append(f"Parameters[{index}] Name must be a string")
+
+        elif name in names:
+
+            errors.append(f"Parameters[{index}] Name {name!r} is repeated")
+
+        names.add(name)
+
+        if not is_scalar(value):
+
+            errors.append(f"Parameters[{index}] Value must be a string, number or boolean")
+
+        if "Type" in parameter and parameter["Type"] not in PARAMETER_TYPES:
+
+            errors.append(f"Parameters[{index}] Type must be one of {', '.join(PARAMETER_TYPES)}")
+
+        elif parameter.get("Type") == "SSM" and not isinstance(value, str):
+
+            errors.append(f"Parameters[{index}] Value must be the SSM parameter name to read")
+
+    return errors
+
+
+def find_ssm_references(parameters):
+
+    """
+    Finds the SSM parameters a stack file's Parameters read their values from
+
+    :param parameters: The loaded Parameters
+    :return: The list of [index, SSM parameter name] pairs
+    """
+
+    if not isinstance(parameters, list):
+
+        return []
+
+    return \
+    [
+        [index, parameter["Value"]]
+        for index, parameter in enumerate(parameters)
+        if isinstance(parameter, dict) and parameter.get("Type") == "SSM" and isinstance(parameter.get("Value"), str)
+    ]
+
+
+def lint_stack_content(data_bytes):
+
+    """
+    Parses a stack file and checks everything about it that only depends on its content. This runs in worker
+    processes, so it must not use any shared state.
+
+    :param data_bytes: The contents of the stack file
+    :return: A dictionary with the stack's Template reference (or None), the list of errors and its SSM references
+    """
+
+    import yaml
+
+    try:
+
+        stack = yaml.safe_load(data_bytes)
+
+    except yaml.YAMLError as error:
+
+        mark = getattr(error, "problem_mark", None)
+        where = "" if mark is None else f" at line {mark.line + 1}"
+
+        return \
+        {
+            "template": None,
+            "errors": [f"invalid YAML{where}: {getattr(error, 'problem', None) or error}"],
+            "ssm": []
+        }
+
+    if not isinstance(stack, dict):
+
+        return { "template": None, "errors": ["must be a mapping with a Template"], "ssm": [] }
+
+    errors = []
+    template = stack.get("Template")
+
+    if template is None:
+
+        errors.append("has no Template")
+
+    elif not isinstance(template, str):
+
+        errors.append("Template must be the path of a template under templates/")
+        template = None
+
+    if "Tags" in stack:
+
+        errors.extend(lint_tags(stack["Tags"]))
+
+    if "Parameters" in stack:
+
+        errors.extend(lint_parameters(stack["Parameters"]))
+
+    return { "template": template, "errors": errors, "ssm": find_ssm_references(stack.get("Parameters")) }
+
+
+def list_template_files(templates_path):
+
+    """
+    Lists the templates a stack file can reference
+
+    :param templates_path: The local templates directory
+    :return: The set of template paths relative to the templates directory, separated by "/"
+    """
+
+    return set \
+    (
+        os.path.relpath(os.path.join(root, file_name), templates_path).replace(os.path.sep, "/")
+        for root, dir_names, file_names in ignore_walk_template(walk)(load_sync_ignore(templates_path))(templates_path)
+        for file_name in file_names
+    )
+
+
+def list_stack_files(stacks_path):
+
+    """
+    Lists the stack files to lint, leaving out paths matched by the tree's .syncignore file
+
+    :param stacks_path: The local stacks directory
+    :return: The sorted list of stack file paths relative to the stacks directory
+    """
+
+    return sorted \
+    (
+        os.path.relpath(os.path.join(root, file_name), stacks_path)
+        for root, dir_names, file_names in ignore_walk_template(walk)(load_sync_ignore(stacks_path))(stacks_path)
+        for file_name in file_names
+        if file_name.lower().endswith(STACK_EXTENSIONS)
+    )
+
+
+def lint_contents(contents, processes = None):
+
+    """
+    Runs lint_stack_content over stack file contents, across a pool of worker processes when there are enough of them
+
+    :param contents: The list of the contents of the stack files
+    :param processes: The number of worker processes, or None for one per CPU
+    :return: The list of results, in the same order
+    """
+
+    if processes == 1 or len(contents) < MIN_PROCESS_POOL_FILES:
+
+        return [lint_stack_content(data_bytes) for data_bytes in contents]
+
+    with ProcessPoolExecutor(max_workers = processes) as executor:
+
+        return list(executor.map(lint_stack_content, contents, chunksize = 16))
+
+
+def lint_stacks \
+(
+    stacks_path,
+    templates_path,
+    cache_location = None,
+    processes = None,
+    find_missing_parameters_func = None,
+    changed_files = None
+):
+
+    """
+    Lints every stack file under a stacks directory. Content checks are cached by the MD5 of each file, so only stack
+    files whose content hasn't been linted before (under the same LINT_RULES_VERSION) are parsed, each distinct content
+    once; the directory, Template and SSM checks are always run, as the files and parameters they look for can change.
+
+    :param stacks_path: The local stacks directory
+    :param templates_path: The local templates directory that Template references are relative to
+    :param cache_location: The s3://bucket/key URI or local path of the lint result cache, or None not to cache
+    :param processes: The number of worker processes to parse stack files with, or None for one per CPU
+    :param find_missing_parameters_func: A function that returns which of a list of SSM parameter names don't exist
+                                         (see ssm_checker.find_missing_parameters), or None not to check them
+    :param changed_files: The set of stack file paths (relative to stacks_path) whose SSM names to check, or None to
+                          check every stack file's
+    :return: A dictionary of the list of errors in each stack file that has any
+    """
+
+    # The blob hash cache's store works for any content-addressed value, here lint results keyed by content MD5
+    cache = None if cache_location is None else open_blob_hash_cache(cache_location)
+    cache_name = f"stack-lint.v{LINT_RULES_VERSION}"
+
+    with metrics.span("stack_lint.list"):
+
+        templates = list_template_files(templates_path)
+        files = list_stack_files(stacks_path)
+
+    content_hashes = {}
+    results = {}
+    misses = {}
+
+    with metrics.span("stack_lint.hash"):
+
+        for file in files:
+
+            data_bytes = read_bytes(os.path.join(stacks_path, file))
+            content_hash = hashlib.md5(data_bytes).hexdigest()
+            content_hashes[file] = content_hash
+
+            if content_hash in results or content_hash in misses:
+
+                continue
+
+            result = None if cache is None else cache.get(cache_name, content_hash)
+
+            if result is None:
+
+                misses[content_hash] = data_bytes
+
+            else:
+
+                results[content_hash] = result
+
+    metrics.count("stacks_linted", len(misses))
+    metrics.count("stacks_lint_cached", len(results))
+
+    with metrics.span("stack_lint.parse", files = len(misses)):
+
+        for content_hash, result in zip(misses, lint_contents(list(misses.values()), processes)):
+
+            results[content_hash] = result
+
+            if cache is not None:
+
+                cache.put(cache_name, content_hash, result)
+
+    if cache is not None:
+
+        try:
+
+            cache.save()
+
+        except Exception as error:
+
+            # Losing the cache only costs the next run time, so it shouldn't fail the lint
+            print(f"Saving the stack lint result cache failed => {error}")
+
+    missing_parameters = set()
+    ssm_files = set(files if changed_files is None else changed_files)
+
+    if find_missing_parameters_func is not None:
+
+        # Every distinct name is checked once, however many stack files read it
+        names = set(name for file in files if file in ssm_files for index, name in results[content_hashes[file]]["ssm"])
+
+        with metrics.span("stack_lint.ssm", names = len(names)):
+
+            missing_parameters = find_missing_parameters_func(names)
+
+    errors = {}
+
+    for file in files:
+
+        result = results[content_hashes[file]]
+        file_errors = lint_stack_path(file) + result["errors"]
+
+        if result["template"] is not None and result["template"] not in templates:
+
+            file_errors.append(f"Template {result['template']!r} is not in {templates_path}/")
+
+        for index, name in result["ssm"]:
+
+            if name in missing_parameters and file in ssm_files:
+
+                file_errors.append(f"Parameters[{index}] SSM parameter {name!r} doesn't exist")
+
+        if len(file_errors) > 0:
+
+            errors[file] = file_errors
+
+    return errors
+
+
+class PyTests:
+
+    @staticmethod
+    def test_lint_stack_path():
+
+        assert lint_stack_path("alias.123456789012/us-east-1/stack.yaml") == []
+        assert lint_stack_path("123456789012/us-gov-west-1/some/folder/stack.yaml") == []
+        assert lint_stack_path("stack.yaml") == ["must be in a <account>/<region>/ directory"]
+        assert len(lint_stack_path("alias.12345/us-east-1/stack.yaml")) == 1
+        assert len(lint_stack_path("my.alias.123456789012/useast1/stack.yaml")) == 2
+
+    @staticmethod
+    def test_lint_stack_content():
+
+        valid = b"Template: a/t.yaml\nTags:\n  - Key: Owner\n    Value: me\nParameters:\n" + \
+                b"  - Name: A\n    Value: 1\n  - Name: S\n    Type: SSM\n    Value: /secret\n"
+
+        assert lint_stack_content(valid) == { "template": "a/t.yaml", "errors": [], "ssm": [[1, "/secret"]] }
+        assert lint_stack_content(b"Template: [")["errors"][0].startswith("invalid YAML at line 1")
+        assert lint_stack_content(b"- a") == \
+               { "template": None, "errors": ["must be a mapping with a Template"], "ssm": [] }
+
+        result = lint_stack_content \
+        (
+            b"Tags:\n  - Key: A\n    Value: 1\n  - Key: A\n    Value: [x]\n  - Value: 2\n" +
+            b"Parameters:\n  - Name: P\n    Value: {a: 1}\n  - Name: P\n    Type: Secret\n    Value: x\n"
+        )
+
+        assert result["template"] is None
+        assert result["errors"] == \
+        [
+            "has no Template",
+            "Tags[1] Key 'A' is repeated",
+            "Tags[1] Value must be a string of at most 256 characters",
+            "Tags[2] must have a Key and a Value",
+            "Parameters[0] Value must be a string, number or boolean",
+            "Parameters[1] Name 'P' is repeated",
+            "Parameters[1] Type must be one of SSM"
+        ]
+
+    @staticmethod
+    def test_lint_stacks_caches_content_results(tmp_path):
+
+        stacks = tmp_path / "stacks"
+        templates = tmp_path / "templates"
+        (stacks / "123456789012" / "us-east-1").mkdir(parents = True)
+        (stacks / "bad" / "us-east-1").mkdir(parents = True)
+        (templates / "a").mkdir(parents = True)
+        (templates / "a" / "t.yaml").write_text("Resources: {}")
+        (stacks / "123456789012" / "us-east-1" / "ok.yaml").write_text("Template: a/t.yaml\n")
+        (stacks / "123456789012" / "us-east-1" / "missing.yaml").write_text("Template: a/missing.yaml\n")
+        (stacks / "123456789012" / "us-east-1" / "notes.txt").write_text("not a stack")
+        (stacks / "123456789012" / "us-east-1" / "tooling.json").write_text("{}")
+        (stacks / "123456789012" / "us-east-1" / "config.yml").write_text("not: a stack")
+        (stacks / "bad" / "us-east-1" / "ok.yaml").write_text("Template: a/t.yaml\n")
+
+        cache = str(tmp_path / "cache.json")
+        expected = \
+        {
+            os.path.join("123456789012", "us-east-1", "missing.yaml"):
+                [f"Template 'a/missing.yaml' is not in {templates}/"],
+            os.path.join("bad", "us-east-1", "ok.yaml"):
+                ["account directory 'bad' must be a 12-digit account id, optionally after 'alias.'"]
+        }
+
+        metrics.reset()
+        assert lint_stacks(str(stacks), str(templates), cache) == expected
+        assert metrics.summary()["counters"]["stacks_linted"] == 2
+
+        # Files with the same content as an earlier run aren't parsed again, but path checks still run
+        metrics.reset()
+        assert lint_stacks(str(stacks), str(templates), cache) == expected
+        assert metrics.summary()["counters"]["stacks_linted"] == 0
+        assert metrics.summary()["counters"]["stacks_lint_cached"] == 2
+
+    @staticmethod
+    def test_lint_stacks_still_lints_when_the_cache_cant_be_saved(tmp_path, capsys):
+
+        stacks = tmp_path / "stacks" / "123456789012" / "us-east-1"
+        templates = tmp_path / "templates"
+        stacks.mkdir(parents = True)
+        templates.mkdir()
+        (stacks / "ok.yaml").write_text("Template: t.yaml\n")
+        (tmp_path / "not-a-directory").write_text("")
+
+        cache = str(tmp_path / "not-a-directory" / "cache.json")
+        file = os.path.join("123456789012", "us-east-1", "ok.yaml")
+
+        assert lint_stacks(str(tmp_path / "stacks"), str(templates), cache) == \
+               { file: [f"Template 't.yaml' is not in {templates}/"] }
+        assert "Saving the stack lint result cache failed" in capsys.readouterr().out
+
+    @staticmethod
+    def test_lint_stacks_checks_every_ssm_name_once(tmp_path):
+
+        from ssm_checker import LocalParameterStore, find_missing_parameters_template
+
+        stacks = tmp_path / "stacks" / "123456789012" / "us-east-1"
+        templates = tmp_path / "templates"
+        stacks.mkdir(parents = True)
+        templates.mkdir()
+        (templates / "t.yaml").write_text("Resources: {}")
+
+        for name, secret in (("a.yaml", "/ok"), ("b.yaml", "/typo"), ("c.yaml", "/typo")):
+
+            (stacks / name).write_text \
+            (
+                f"Template: t.yaml\nParameters:\n  - Name: P\n    Value: x\n  - Name: S\n    Type: SSM\n" +
+                f"    Value: {secret}\n"
+            )
+
+        checked = []
+
+        def find_missing_parameters(names):
+
+            checked.append(sorted(names))
+            return find_missing_parameters_template(lambda: LocalParameterStore(["/ok"]))(None)(names)
+
+        errors = lint_stacks(str(tmp_path / "stacks"), str(templates), None, 1, find_missing_parameters)
+
+        assert checked == [["/ok", "/typo"]]
+        assert errors == \
+        {
+            os.path.join("123456789012", "us-east-1", name): ["Parameters[1] SSM parameter '/typo' doesn't exist"]
+            for name in ("b.yaml", "c.yaml")
+        }
+
+    @staticmethod
+    def test_lint_stacks_only_checks_the_ssm_names_of_changed_stack_files(tmp_path):
+
+        from ssm_checker import LocalParameterStore, find_missing_parameters_template
+
+        stacks = tmp_path / "stacks" / "123456789012" / "us-east-1"
+        templates = tmp_path / "templates"
+        stacks.mkdir(parents = True)
+        templates.mkdir()
+        (templates / "t.yaml").write_text("Resources: {}")
+
+        for name, secret in (("changed.yaml", "/typo"), ("unchanged.yaml", "/deleted")):
+
+            (stacks / name).write_text \
+            (
+                f"Template: t.yaml\nParameters:\n  - Name: S\n    Type: SSM\n    Value: {secret}\n"
+            )
+
+        checked = []
+
+        def find_missing_parameters(names):
+
+            checked.append(sorted(names))
+            return find_missing_parameters_template(lambda: LocalParameterStore([]))(None)(names)
+
+        changed = os.path.join("123456789012", "us-east-1", "changed.yaml")
+        errors = lint_stacks(str(tmp_path / "stacks"), str(templates), None, 1, find_missing_parameters, { changed })
+
+        assert checked == [["/typo"]]
+        assert errors == { changed: ["Parameters[0] SSM parameter '/typo' doesn't exist"] }
+
+    @staticmethod
+    def test_lint_contents_matches_across_processes():
+
+        contents = [f"Template: t{index}.yaml\nTags: {index}\n".encode("utf-8") for index in range(40)]
+
+        assert lint_contents(contents, 2) == lint_contents(contents, 1)
@@ -0,0 +1,1234 @@
+import os
+import sys
+import time
+import errno
+import hashlib
+import select
+import struct
+import ctypes
+import ctypes.util
+from common import Struct
+from instrumentation import metrics
+from worker_pool import shared_pool
+from s3_updater import S3Updater
+from file_set_loader import Item, walk, hash_file, enumerate_s3_files
+from sync_ignore import SYNC_IGNORE_FILE, load_sync_ignore, ignore_walk_template
+from stack_linter import STACK_EXTENSIONS
+from stack_index import INDEX_FILE, index_directory, is_index_file, plan_indexes, build_index, publish_indexes
+from template_validator import validate_template_file
+from s3_inventory import open_journal, touched_prefix
+
+
+# inotify event flags (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# The events that mean a path's content or existence changed
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+# The fixed part of each inotify event: watch descriptor, mask, cookie and name length
+EVENT_HEADER = struct.Struct("iIII")
+
+# The most seconds the daemon waits for a change before checking whether it should stop
+STOP_CHECK_INTERVAL = 1.0
+
+# The most seconds the daemon waits before listing the bucket again after a refresh failed
+REFRESH_RETRY_INTERVAL = 30.0
+
+
+def load_libc():
+
+    """Returns the C library with inotify, or None if this platform doesn't have it"""
+
+    if not sys.platform.startswith("linux"):
+
+        return None
+
+    try:
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno = True)
+
+    except OSError:
+
+        return None
+
+    return libc if hasattr(libc, "inotify_init1") else None
+
+
+class InotifyWatcher:
+
+    """
+    Watches directory trees for changes with inotify, through ctypes so that nothing needs installing. inotify watches
+    single directories, so every directory in the trees is watched, and directories that appear later are watched as
+    they are created.
+    """
+
+    def __init__(self, roots, libc):
+
+        self.libc = libc
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.directories = {}
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+
+        if self.fd < 0:
+
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1 failed: {os.strerror(error)}")
+
+        for root in self.roots:
+
+            self.watch_tree(root)
+
+    def watch_tree(self, directory):
+
+        """
+        Watches a directory and every directory below it
+
+        :param directory: The directory to watch
+        :return: Nothing
+        """
+
+        for root, dir_names, file_names in os.walk(directory):
+
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+
+            if wd < 0:
+
+                error = ctypes.get_errno()
+
+                # A directory that was removed before it could be watched has nothing left to watch
+                if error in (errno.ENOENT, errno.ENOTDIR):
+
+                    continue
+
+                raise OSError(error, f"watching {root} failed: {os.strerror(error)}")
+
+            self.directories[wd] = root
+
+    def read(self, timeout):
+
+        """
+        Waits for changes
+
+        :param timeout: The most seconds to wait
+        :return: The set of changed paths (a directory means anything below it may have changed), empty on a timeout
+        """
+
+        readable, _, _ = select.select([self.fd], [], [], max(0, timeout))
+
+        if len(readable) == 0:
+
+            return set()
+
+        try:
+
+            data = os.read(self.fd, 64 * 1024)
+
+        except BlockingIOError:
+
+            return set()
+
+        changed = set()
+        offset = 0
+
+        while offset < len(data):
+
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+
+                # Events were lost, so everything has to be looked at again
+                metrics.count("watch_overflows")
+                changed.update(self.roots)
+                continue
+
+            if mask & IN_IGNORED:
+
+                self.directories.pop(wd, None)
+                continue
+
+            directory = self.directories.get(wd)
+
+            if directory is None:
+
+                continue
+
+            path = os.path.join(directory, name) if name else directory
+            changed.add(path)
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+
+                self.watch_tree(path)
+
+        return changed
+
+    def close(self):
+
+        """Stops watching"""
+
+        os.close(self.fd)
+
+
+class PollingWatcher:
+
+    """
+    Watches directory trees for changes by comparing the size and modification time of every file at an interval, for
+    platforms without inotify
+    """
+
+    def __init__(self, roots, interval = 1.0, clock = time.monotonic, sleep_func = time.sleep):
+
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.interval = interval
+        self.clock = clock
+        self.sleep_func = sleep_func
+        self.snapshot = self.scan()
+
+    def scan(self):
+
+        """Returns the size and modification time of every file in the trees"""
+
+        snapshot = {}
+
+        for root in self.roots:
+
+            for directory, dir_names, file_names in os.walk(root):
+
+                for file_name in file_names:
+
+                    path = os.path.join(directory, file_name)
+
+                    try:
+
+                        stat = os.stat(path)
+
+                    except FileNotFoundError:
+
+                        continue
+
+                    snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+
+        return snapshot
+
+    def read(self, timeout):
+
+        """
+        Waits for changes
+
+        :param timeout: The most seconds to wait
+        :return: The set of changed files, empty on a timeout
+        """
+
+        deadline = self.clock() + max(0, timeout)
+
+        while True:
+
+            snapshot = self.scan()
+            changed = set \
+            (
+                path
+                for path in set(snapshot).union(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path)
+            )
+            self.snapshot = snapshot
+
+            remaining = deadline - self.clock()
+
+            if len(changed) > 0 or remaining <= 0:
+
+                return changed
+
+            self.sleep_func(min(self.interval, remaining))
+
+    def close(self):
+
+        """Stops watching"""
+
+        pass
+
+
+def open_watcher(roots, poll_interval = None):
+
+    """
+    Watches directory trees with inotify where it is available, or by polling
+
+    :param roots: The directories to watch
+    :param poll_interval: The seconds between polls, to poll even where inotify is available, or None
+    :return: An InotifyWatcher or PollingWatcher
+    """
+
+    libc = None if poll_interval is not None else load_libc()
+
+    if libc is not None:
+
+        try:
+
+            return InotifyWatcher(roots, libc)
+
+        except OSError as error:
+
+            print(f"Watching with inotify failed, polling instead => {error}")
+
+    return PollingWatcher(roots, poll_interval or 1.0)
+
+
+def wait_for_changes(watcher, timeout, debounce, max_delay, clock = time.monotonic):
+
+    """
+    Waits for a burst of changes to settle: once something changes, changes are gathered until none arrive for the
+    debounce period, or for at most max_delay
+
+    :param watcher: The watcher to read changes from
+    :param timeout: The most seconds to wait for the first change
+    :param debounce: The seconds without changes that end a burst
+    :param max_delay: The most seconds to gather a burst for
+    :param clock: A function that returns the current time in seconds
+    :return: The set of changed paths, empty on a timeout
+    """
+
+    changed = watcher.read(timeout)
+
+    if len(changed) == 0:
+
+        return changed
+
+    deadline = clock() + max_delay
+
+    while True:
+
+        remaining = deadline - clock()
+
+        if remaining <= 0:
+
+            return changed
+
+        more = watcher.read(min(debounce, remaining))
+
+        if len(more) == 0:
+
+            return changed
+
+        changed.update(more)
+
+
+class SyncTree:
+
+    """
+    The in-memory indexes of one local directory and the path into the bucket it is synced to. Local files are indexed
+    by size and modification time, and only hashed when an S3 object of the same size needs comparing, so unchanged
+    files are read at most once. Like the sync's --validate and --index, a tree can have the files it uploads validated
+    as templates first, and keep an "<account>/<region>/_index.json" object listing each directory's stack files.
+    """
+
+    def __init__(self, local_path, s3_path, hash_file_func = hash_file, validate = False, index = False):
+
+        self.local_path = os.path.abspath(local_path)
+        self.s3_path = s3_path
+        self.hash_file_func = hash_file_func
+        self.validate = validate
+        self.index = index
+        self.sync_ignore = load_sync_ignore(self.local_path)
+        self.local = {}
+        self.remote = {}
+        self.indexes = {}
+
+    def relative(self, path):
+
+        """Returns the "/"-separated path of a path relative to the tree, or None if it isn't in the tree"""
+
+        relative_path = os.path.relpath(os.path.abspath(path), self.local_path)
+
+        if relative_path == os.curdir:
+
+            return ""
+
+        if relative_path == os.pardir or relative_path.startswith(os.pardir + os.path.sep):
+
+            return None
+
+        return relative_path.replace(os.path.sep, "/")
+
+    def update_local(self, file, changed = False):
+
+        """
+        Brings a local file's index entry up to date
+
+        :param file: The "/"-separated path of the file relative to the tree
+        :param changed: Whether the file is known to have changed, even if its size and modification time haven't
+        :return: The entry, or None if the file is gone or ignored
+        """
+
+        try:
+
+            stat = os.stat(os.path.join(self.local_path, file))
+
+        except (FileNotFoundError, NotADirectoryError):
+
+            stat = None
+
+        # An indexed tree's own _index.json files would be overwritten by the indexes it publishes
+        ignored = self.sync_ignore.is_ignored(file) or (self.index and is_index_file(file))
+
+        if stat is None or not os.path.isfile(os.path.join(self.local_path, file)) or ignored:
+
+            self.local.pop(file, None)
+            return None
+
+        entry = self.local.get(file)
+
+        if changed or entry is None or (entry.size, entry.mtime) != (stat.st_size, stat.st_mtime_ns):
+
+            entry = Struct(size = stat.st_size, mtime = stat.st_mtime_ns, hash = None)
+            self.local[file] = entry
+
+        return entry
+
+    def local_hash(self, file):
+
+        """Returns the hash of an indexed local file, hashing it on first use"""
+
+        entry = self.local[file]
+
+        if entry.hash is None:
+
+            entry.hash = self.hash_file_func(os.path.join(self.local_path, file))
+
+        return entry.hash
+
+    def list_local(self, directory = ""):
+
+        """
+        Lists the files in a directory of the tree, leaving out ignored paths
+
+        :param directory: The "/"-separated directory relative to the tree, or "" for the whole tree
+        :return: The set of "/"-separated file paths relative to the tree
+        """
+
+        top = os.path.join(self.local_path, directory)
+
+        if directory == "":
+
+            walked = ignore_walk_template(walk)(self.sync_ignore)(self.local_path)
+
+        elif os.path.isdir(top) and not self.sync_ignore.is_dir_ignored(directory):
+
+            walked = os.walk(top)
+
+        else:
+
+            return set()
+
+        files = set \
+        (
+            self.relative(os.path.join(root, file_name))
+            for root, dir_names, file_names in walked
+            for file_name in file_names
+        )
+
+        return files if directory == "" else set(file for file in files if not self.sync_ignore.is_ignored(file))
+
+    def affected_files(self, paths):
+
+        """
+        Expands changed paths into the files to reconcile: changed files, and every local file and S3 object below a
+        changed directory (e.g. one that was moved in or out)
+
+        :param paths: The changed "/"-separated paths relative to the tree ("" for the whole tree)
+        :return: The set of files to reconcile
+        """
+
+        files = set()
+
+        for path in paths:
+
+            prefix = "" if path == "" else path + "/"
+
+            files.update(self.list_local(path))
+            files.update(file for file in self.remote if file.startswith(prefix) or file == path)
+
+            if os.path.isfile(os.path.join(self.local_path, path)) or path in self.local:
+
+                files.add(path)
+
+        return files
+
+    def plan(self, files, changed = False):
+
+        """
+        Compares files with the remote index
+
+        :param files: The files to compare
+        :param changed: Whether the files are known to have changed locally (so their hashes are recomputed)
+        :return: A (files to upload, files to delete) tuple
+        """
+
+        uploads = []
+        deletes = []
+
+        for file in sorted(files):
+
+            entry = self.update_local(file, changed)
+            remote = self.remote.get(file)
+
+            if entry is None:
+
+                if remote is not None:
+
+                    deletes.append(file)
+
+            elif remote is None or remote.file_size != entry.size or remote.file_hash != self.local_hash(file):
+
+                uploads.append(file)
+
+        return uploads, deletes
+
+    def build_indexes(self, directories):
+
+        """
+        Builds the indexes of directories from the local stack files in them
+
+        :param directories: The "<account>/<region>" directories to index
+        :return: A dictionary of the bytes of the index of each directory that has any stack files
+        """
+
+        indexes = {}
+
+        for directory in directories:
+
+            files = sorted \
+            (
+                file
+                for file in self.list_local(directory)
+                if file.lower().endswith(STACK_EXTENSIONS) and not is_index_file(file)
+            )
+
+            if len(files) > 0:
+
+                indexes[directory] = build_index(self.local_path, files)
+
+        return indexes
+
+
+class SyncDaemon:
+
+    """
+    Keeps local trees synced to a bucket for as long as it runs. Both sides are indexed in memory once; after that,
+    each burst of local changes only touches the paths that changed, and the bucket is listed again at an interval to
+    pick up changes made by anything else. Each burst is pushed tree by tree in the order the trees were given (e.g.
+    templates before stacks). Like a sync, each push journals the prefixes it changes (see s3_inventory.open_journal)
+    before changing them, so that syncs listing the bucket from an S3 Inventory see them, validates a validated tree's
+    uploads before changing anything, and rewrites an indexed tree's stale indexes once its files are in place.
+    """
+
+    def __init__ \
+    (
+        self,
+        s3_bucket,
+        trees,
+        watcher,
+        debounce = 0.5,
+        max_delay = 5.0,
+        refresh_interval = 300.0,
+        list_func = lambda s3_bucket, s3_path: enumerate_s3_files(s3_bucket)(s3_path),
+        upload_func = S3Updater.upload_files,
+        delete_func = S3Updater.delete_files,
+        clock = time.monotonic,
+        open_journal_func = open_journal,
+        validate_func = validate_template_file,
+        publish_indexes_func = publish_indexes
+    ):
+
+        self.s3_bucket = s3_bucket
+        self.trees = trees
+        self.watcher = watcher
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.refresh_interval = refresh_interval
+        self.list_func = list_func
+        self.upload_func = upload_func
+        self.delete_func = delete_func
+        self.clock = clock
+        self.open_journal_func = open_journal_func
+        self.validate_func = validate_func
+        self.publish_indexes_func = publish_indexes_func
+        self.journals = {}
+        self.validations = {}
+        self.pending = { tree.local_path: set() for tree in trees }
+        self.next_refresh = None
+
+    def refresh(self):
+
+        """Lists the bucket again and reconciles every tree with it"""
+
+        for tree in self.trees:
+
+            with metrics.span("daemon.refresh", s3_path = tree.s3_path):
+
+                items = self.list_func(self.s3_bucket, tree.s3_path)
+
+                tree.remote = \
+                {
+                    item.file.replace(os.path.sep, "/"): item
+                    for item in items
+                    if not tree.sync_ignore.is_ignored(item.file) and not is_index_file(item.file)
+                }
+                tree.indexes = \
+                    { index_directory(item.file): item.file_hash for item in items if is_index_file(item.file) }
+
+            self.pending[tree.local_path].add("")
+
+        self.next_refresh = self.clock() + self.refresh_interval
+        self.push(False)
+
+    def queue(self, paths):
+
+        """
+        Queues changed local paths to be pushed
+
+        :param paths: The changed absolute paths
+        :return: Nothing
+        """
+
+        for path in paths:
+
+            for tree in self.trees:
+
+                file = tree.relative(path)
+
+                if file is None:
+
+                    continue
+
+                if file == SYNC_IGNORE_FILE:
+
+                    tree.sync_ignore = load_sync_ignore(tree.local_path)
+                    file = ""
+
+                self.pending[tree.local_path].add(file)
+
+    def find_invalid(self, tree, uploads):
+
+        """
+        Validates the files a tree is about to upload. Each content of a file is only validated once, so a burst that
+        stays queued behind an invalid template doesn't validate it again until it changes.
+
+        :param tree: The SyncTree the files are in
+        :param uploads: The files to upload
+        :return: The sorted list of invalid files
+        """
+
+        hashes = { file: tree.local_hash(file) for file in uploads }
+        unknown = \
+        [
+            file
+            for file in uploads
+            if self.validations.get((tree.local_path, file), (None, None))[0] != hashes[file]
+        ]
+
+        results = shared_pool.map(self.validate_func, [os.path.join(tree.local_path, file) for file in unknown])
+
+        for file, valid in zip(unknown, results):
+
+            self.validations[(tree.local_path, file)] = (hashes[file], valid)
+
+        invalid = sorted(file for file in uploads if not self.validations[(tree.local_path, file)][1])
+
+        if len(invalid) > 0 and len(unknown) > 0:
+
+            print(f"Templates failed validation, so s3://{self.s3_bucket}/{tree.s3_path} and the paths after it " +
+                  f"weren't pushed => {', '.join(invalid)}")
+
+        return invalid
+
+    def plan_indexes(self, tree, paths, files):
+
+        """
+        Builds and plans the indexes of the directories a push touches (every directory on a refresh)
+
+        :param tree: The SyncTree being pushed
+        :param paths: The queued paths of the push
+        :param files: The files the push reconciles
+        :return: A dictionary of the bytes of each index to write, or None for each index to delete
+        """
+
+        directories = set(index_directory(file) for file in files).difference([None])
+
+        if "" in paths:
+
+            directories.update(tree.indexes)
+
+        indexes = tree.build_indexes(directories)
+        existing = { directory: tree.indexes[directory] for directory in directories if directory in tree.indexes }
+        plan = plan_indexes(indexes, existing)
+
+        return dict \
+        (
+            [(directory, indexes[directory]) for directory in plan.write] +
+            [(directory, None) for directory in plan.delete]
+        )
+
+    def push(self, changed = True):
+
+        """
+        Pushes the queued paths of every tree. Paths stay queued until their tree has been pushed, so a failed push is
+        retried with the next burst, and so does each file that failed to be deleted. When a validated tree has an
+        invalid file to upload, neither it nor the trees after it are pushed until the file changes.
+
+        :param changed: Whether the queued paths are known to have changed locally
+        :return: Nothing
+        """
+
+        for tree in self.trees:
+
+            paths = self.pending[tree.local_path]
+
+            if len(paths) == 0:
+
+                continue
+
+            start = self.clock()
+            not_deleted = []
+            indexes = {}
+
+            with metrics.span("daemon.push", s3_path = tree.s3_path):
+
+                files = tree.affected_files(paths)
+                uploads, deletes = tree.plan(files, changed)
+
+                if tree.validate and len(uploads) > 0 and len(self.find_invalid(tree, uploads)) > 0:
+
+                    return
+
+                if tree.index:
+
+                    indexes = self.plan_indexes(tree, paths, files)
+
+                if len(uploads) > 0 or len(deletes) > 0 or len(indexes) > 0:
+
+                    if tree.s3_path not in self.journals:
+
+                        self.journals[tree.s3_path] = self.open_journal_func(self.s3_bucket, tree.s3_path, "daemon")
+
+                    self.journals[tree.s3_path].record \
+                    (
+                        set(touched_prefix(tree.s3_path, file) for file in uploads + deletes).union
+                        (
+                            touched_prefix(tree.s3_path, directory + "/" + INDEX_FILE) for directory in indexes
+                        )
+                    )
+
+                if len(deletes) > 0:
+
+                    result = self.delete_func([tree.s3_path + "/" + file for file in deletes], self.s3_bucket)
+                    deleted_keys = set(deleted["Key"] for deleted in result.deleted)
+
+                    if len(result.errors) > 0:
+
+                        print(f"Deleting from s3://{self.s3_bucket}/{tree.s3_path} failed => {result.errors}")
+
+                    for file in deletes:
+
+                        if tree.s3_path + "/" + file in deleted_keys:
+
+                            tree.remote.pop(file, None)
+
+                        else:
+
+                            not_deleted.append(file)
+
+                if len(uploads) > 0:
+
+                    self.upload_func(uploads, tree.local_path, self.s3_bucket, tree.s3_path)
+
+                    for file in uploads:
+
+                        entry = tree.local[file]
+                        tree.remote[file] = Item("", file, tree.local_hash(file), entry.size)
+
+                # Indexes go last, once the stack files they list are in place
+                if len(indexes) > 0:
+
+                    self.publish_indexes_func(self.s3_bucket, tree.s3_path, indexes)
+
+                    for directory, data_bytes in indexes.items():
+
+                        if data_bytes is None:
+
+                            tree.indexes.pop(directory, None)
+
+                        else:
+
+                            tree.indexes[directory] = hashlib.md5(data_bytes).hexdigest()
+
+            paths.clear()
+            paths.update(not_deleted)
+
+            metrics.count("daemon_uploads", len(uploads))
+            metrics.count("daemon_deletes", len(deletes) - len(not_deleted))
+
+            if len(uploads) > 0 or len(deletes) > 0 or len(indexes) > 0:
+
+                print(f"Pushed s3://{self.s3_bucket}/{tree.s3_path}: {len(uploads)} uploaded, " +
+                      f"{len(deletes) - len(not_deleted)} deleted, {len(indexes)} indexes published in " +
+                      f"{self.clock() - start:.2f}s")
+
+    def run_once(self):
+
+        """
+        Waits a short while for the next burst of changes (refreshing first if it is due) and pushes it
+
+        :return: Nothing
+        """
+
+        if self.next_refresh is None or self.clock() >= self.next_refresh:
+
+            try:
+
+                self.refresh()
+
+            except Exception as error:
+
+                print(f"Refreshing from s3://{self.s3_bucket} failed, retrying soon => {error}")
+                self.next_refresh = self.clock() + min(self.refresh_interval, REFRESH_RETRY_INTERVAL)
+
+        changed = wait_for_changes \
+        (
+            self.watcher,
+            min(self.next_refresh - self.clock(), STOP_CHECK_INTERVAL),
+            self.debounce,
+            self.max_delay,
+            self.clock
+        )
+
+        self.queue(changed)
+
+        try:
+
+            self.push()
+
+        except Exception as error:
+
+            print(f"Pushing changes failed, retrying with the next change => {error}")
+
+    def run(self, stop_func = lambda: False):
+
+        """
+        Syncs until stop_func returns True
+
+        :param stop_func: A function called between bursts that returns whether to stop
+        :return: Nothing
+        """
+
+        try:
+
+            while not stop_func():
+
+                self.run_once()
+
+        finally:
+
+            self.watcher.close()
+
+
+class PyTests:
+
+    @staticmethod
+    def make_daemon(tmp_path, watcher = None, validate = False, index = False):
+
+        """Builds a daemon over a templates and a stacks tree, with an in-memory bucket"""
+
+        bucket = {}
+        calls = []
+        undeletable = set()
+        journaled = []
+        validated = []
+
+        def my_list(s3_bucket, s3_path):
+            return \
+            [
+                Item("", key[len(s3_path) + 1:], value[0], value[1])
+                for key, value in bucket.items()
+                if key.startswith(s3_path + "/")
+            ]
+
+        def my_upload(files, local_path, s3_bucket, s3_path):
+            calls.append(("upload", s3_path, sorted(files)))
+            for file in files:
+                data = open(os.path.join(local_path, file), "rb").read()
+                bucket[s3_path + "/" + file] = (hash_file(os.path.join(local_path, file)), len(data))
+
+        def my_delete(keys, s3_bucket):
+            calls.append(("delete", sorted(keys)))
+            failed = [key for key in keys if key in undeletable]
+            for key in keys:
+                if key not in failed:
+                    del bucket[key]
+            return Struct \
+            (
+                deleted = [{ "Key": key } for key in keys if key not in failed],
+                errors = [{ "Key": key, "Code": "AccessDenied" } for key in failed]
+            )
+
+        def my_validate(file):
+            validated.append(os.path.basename(file))
+            return b"invalid" not in open(file, "rb").read()
+
+        def my_publish_indexes(s3_bucket, s3_path, indexes):
+            calls.append(("index", s3_path, sorted(indexes)))
+            for directory, data_bytes in indexes.items():
+                key = f"{s3_path}/{directory}/{INDEX_FILE}"
+                if data_bytes is None:
+                    del bucket[key]
+                else:
+                    bucket[key] = (hashlib.md5(data_bytes).hexdigest(), len(data_bytes))
+
+        trees = \
+        [
+            SyncTree(str(tmp_path / "templates"), "templates", validate = validate),
+            SyncTree(str(tmp_path / "stacks"), "stacks", index = index)
+        ]
+        daemon = SyncDaemon \
+        (
+            "bkt",
+            trees,
+            watcher or Struct(read = lambda timeout: set(), close = lambda: None),
+            list_func = my_list,
+            upload_func = my_upload,
+            delete_func = my_delete,
+            open_journal_func = lambda s3_bucket, s3_path, writer: \
+                Struct(record = lambda prefixes: journaled.append((writer, sorted(prefixes)))),
+            validate_func = my_validate,
+            publish_indexes_func = my_publish_indexes
+        )
+
+        daemon.undeletable = undeletable
+        daemon.journaled = journaled
+        daemon.validated = validated
+
+        return daemon, bucket, calls
+
+    @staticmethod
+    def test_daemon_pushes_only_the_changed_paths(tmp_path):
+
+        (tmp_path / "templates").mkdir()
+        (tmp_path / "stacks" / "a" / "r").mkdir(parents = True)
+        (tmp_path / "templates" / "t.yaml").write_text("Resources: {}")
+        (tmp_path / "stacks" / "a" / "r" / "s.yaml").write_text("Template: t.yaml")
+        (tmp_path / "stacks" / "a" / "r" / "old.yaml").write_text("Template: t.yaml")
+
+        daemon, bucket, calls = PyTests.make_daemon(tmp_path)
+        bucket["stacks/gone.yaml"] = ("x", 1)
+
+        # The first refresh syncs everything, templates first
+        daemon.refresh()
+
+        assert calls == \
+        [
+            ("upload", "templates", ["t.yaml"]),
+            ("delete", ["stacks/gone.yaml"]),
+            ("upload", "stacks", ["a/r/old.yaml", "a/r/s.yaml"])
+        ]
+
+        # Unchanged files aren't pushed again, even when a refresh compares everything
+        calls.clear()
+        daemon.refresh()
+
+        assert calls == []
+
+        (tmp_path / "stacks" / "a" / "r" / "s.yaml").write_text("Template: t2.yaml")
+        (tmp_path / "stacks" / "a" / "r" / "old.yaml").unlink()
+
+        daemon.queue([str(tmp_path / "stacks" / "a" / "r" / name) for name in ("s.yaml", "old.yaml")])
+        daemon.push()
+
+        assert calls == [("delete", ["stacks/a/r/old.yaml"]), ("upload", "stacks", ["a/r/s.yaml"])]
+
+        # Each push journals the prefixes it changes, for syncs that list the bucket from an S3 Inventory
+        assert daemon.journaled[-1] == ("daemon", ["stacks/a/r/"])
+        assert sorted(bucket) == ["stacks/a/r/s.yaml", "templates/t.yaml"]
+
+        # A directory that was moved away has everything below it deleted
+        calls.clear()
+        os.rename(tmp_path / "stacks" / "a", tmp_path / "moved")
+        daemon.queue([str(tmp_path / "stacks" / "a")])
+        daemon.push()
+
+        assert calls == [("delete", ["stacks/a/r/s.yaml"])]
+
+    @staticmethod
+    def test_daemon_retries_failed_deletes_and_refreshes(tmp_path):
+
+        (tmp_path / "templates").mkdir()
+        (tmp_path / "stacks").mkdir()
+        (tmp_path / "templates" / "t.yaml").write_text("Resources: {}")
+
+        daemon, bucket, calls = PyTests.make_daemon(tmp_path)
+        bucket["stacks/gone.yaml"] = ("x", 1)
+        daemon.undeletable.add("stacks/gone.yaml")
+        daemon.refresh()
+
+        # The failed delete stays queued, and is pushed again with the next burst
+        assert daemon.pending[daemon.trees[1].local_path] == { "gone.yaml" }
+
+        calls.clear()
+        daemon.undeletable.clear()
+        daemon.push()
+
+        assert calls == [("delete", ["stacks/gone.yaml"])]
+        assert daemon.pending[daemon.trees[1].local_path] == set()
+
+        # A refresh that fails (e.g. listing the bucket) is retried later instead of stopping the daemon
+        def failing_list(s3_bucket, s3_path):
+            raise RuntimeError("listing failed")
+
+        daemon.list_func = failing_list
+        daemon.next_refresh = None
+        daemon.run_once()
+
+        assert daemon.next_refresh is not None
+
+    @staticmethod
+    def test_daemon_retries_a_failed_delete_without_waiting_for_a_new_change(tmp_path):
+
+        (tmp_path / "templates").mkdir()
+        (tmp_path / "stacks").mkdir()
+
+        daemon, bucket, calls = PyTests.make_daemon(tmp_path)
+        bucket["stacks/a/r/gone.yaml"] = ("x", 1)
+        bucket["stacks/a/r/also-gone.yaml"] = ("y", 1)
+        daemon.undeletable.add("stacks/a/r/gone.yaml")
+
+        metrics.reset()
+        daemon.run_once()
+
+        # Only the key that was deleted leaves the bucket's index and counts as deleted
+        assert sorted(bucket) == ["stacks/a/r/gone.yaml"]
+        assert sorted(daemon.trees[1].remote) == ["a/r/gone.yaml"]
+        assert metrics.summary()["counters"]["daemon_deletes"] == 1
+
+        # The next run retries it even though the watcher reports nothing, and it isn't retried once it is gone
+        calls.clear()
+        daemon.undeletable.clear()
+        daemon.run_once()
+        daemon.run_once()
+
+        assert calls == [("delete", ["stacks/a/r/gone.yaml"])]
+        assert bucket == {}
+        assert metrics.summary()["counters"]["daemon_deletes"] == 2
+
+    @staticmethod
+    def test_daemon_validates_uploads_before_pushing_anything(tmp_path):
+
+        (tmp_path / "templates").mkdir()
+        (tmp_path / "stacks" / "a" / "r").mkdir(parents = True)
+        (tmp_path / "templates" / "t.yaml").write_text("Resources: invalid")
+        (tmp_path / "stacks" / "a" / "r" / "s.yaml").write_text("Template: t.yaml")
+
+        daemon, bucket, calls = PyTests.make_daemon(tmp_path, validate = True)
+        bucket["templates/old.yaml"] = ("x", 1)
+
+        # Neither the invalid tree nor the trees after it are pushed, and nothing is deleted
+        daemon.refresh()
+        daemon.push()
+
+        assert calls == []
+        assert daemon.journaled == []
+        assert daemon.validated == ["t.yaml"]
+
+        # The same content isn't validated again, but a fix is validated and unblocks everything
+        (tmp_path / "templates" / "t.yaml").write_text("Resources: {}")
+        daemon.queue([str(tmp_path / "templates" / "t.yaml")])
+        daemon.push()
+
+        assert daemon.validated == ["t.yaml", "t.yaml"]
+        assert calls == \
+        [
+            ("delete", ["templates/old.yaml"]),
+            ("upload", "templates", ["t.yaml"]),
+            ("upload", "stacks", ["a/r/s.yaml"])
+        ]
+
+    @staticmethod
+    def test_daemon_keeps_the_indexes_of_touched_directories_up_to_date(tmp_path):
+
+        stacks = tmp_path / "stacks" / "123456789012" / "us-east-1"
+        (tmp_path / "templates").mkdir()
+        stacks.mkdir(parents = True)
+        (stacks / "a.yaml").write_text("Template: t.yaml")
+        (stacks / INDEX_FILE).write_text("{}")
+
+        daemon, bucket, calls = PyTests.make_daemon(tmp_path, index = True)
+        bucket["stacks/210987654321/us-west-2/" + INDEX_FILE] = ("stale", 2)
+
+        # A refresh writes every missing index and deletes the index of a directory without stack files; a local
+        # _index.json is never uploaded over the published one
+        daemon.refresh()
+
+        assert calls == \
+        [
+            ("upload", "stacks", ["123456789012/us-east-1/a.yaml"]),
+            ("index", "stacks", ["123456789012/us-east-1", "210987654321/us-west-2"])
+        ]
+        assert daemon.journaled[-1] == \
+            ("daemon", ["stacks/123456789012/us-east-1/", "stacks/210987654321/us-west-2/"])
+
+        # Current indexes aren't rewritten
+        calls.clear()
+        daemon.refresh()
+
+        assert calls == []
+
+        (stacks / "b.yaml").write_text("Template: t.yaml")
+        daemon.queue([str(stacks / "b.yaml")])
+        daemon.push()
+
+        assert calls == \
+        [
+            ("upload", "stacks", ["123456789012/us-east-1/b.yaml"]),
+            ("index", "stacks", ["123456789012/us-east-1"])
+        ]
+
+        files = ["123456789012/us-east-1/a.yaml", "123456789012/us-east-1/b.yaml"]
+        index = build_index(str(tmp_path / "stacks"), files)
+
+        assert bucket["stacks/123456789012/us-east-1/" + INDEX_FILE][0] == hashlib.md5(index).hexdigest()
+
+        # Emptying a directory deletes its index
+        calls.clear()
+        (stacks / "a.yaml").unlink()
+        (stacks / "b.yaml").unlink()
+        daemon.queue([str(stacks / "a.yaml"), str(stacks / "b.yaml")])
+        daemon.push()
+
+        assert calls == \
+        [
+            ("delete", ["stacks/123456789012/us-east-1/a.yaml", "stacks/123456789012/us-east-1/b.yaml"]),
+            ("index", "stacks", ["123456789012/us-east-1"])
+        ]
+        assert bucket == {}
+
+    @staticmethod
+    def test_wait_for_changes_gathers_a_burst():
+
+        now = [0.0]
+        reads = [{ "a" }, { "b" }, { "c" }, set(), { "d" }, set()]
+
+        def my_read(timeout):
+            now[0] += timeout
+            return reads.pop(0)
+
+        watcher = Struct(read = my_read)
+
+        assert wait_for_changes(watcher, 10, 0.5, 5, lambda: now[0]) == { "a", "b", "c" }
+        assert wait_for_changes(watcher, 10, 0.5, 5, lambda: now[0]) == { "d" }
+
+    @staticmethod
+    def test_wait_for_changes_stops_a_continuous_stream_at_max_delay():
+
+        now = [0.0]
+        timeouts = []
+
+        def my_read(timeout):
+            timeouts.append(timeout)
+            now[0] += 0.25
+            return { f"file{len(timeouts)}" }
+
+        watcher = Struct(read = my_read)
+        changed = wait_for_changes(watcher, 10, 0.5, 1, lambda: now[0])
+
+        # Changes keep arriving within the debounce period, so the burst only ends at max_delay, and no read waits
+        # past it
+        assert changed == { "file1", "file2", "file3", "file4", "file5" }
+        assert timeouts == [10, 0.5, 0.5, 0.5, 0.25]
+
+        # Without a first change it returns as soon as the timeout is up
+        watcher = Struct(read = lambda timeout: timeouts.append(timeout) or set())
+
+        assert wait_for_changes(watcher, 2, 0.5, 1, lambda: now[0]) == set()
+        assert timeouts[-1] == 2
+
+    @staticmethod
+    def test_inotify_watcher_follows_new_directories_and_removals(tmp_path):
+
+        libc = load_libc()
+
+        if libc is None:
+
+            return
+
+        watcher = InotifyWatcher([str(tmp_path)], libc)
+
+        def read_until(expected):
+            changed = set()
+            for _ in range(20):
+                changed.update(watcher.read(0.1))
+                if expected.issubset(changed):
+                    break
+            return changed
+
+        try:
+
+            # A new directory is reported, and watched, so a file created in it later is reported too
+            (tmp_path / "new").mkdir()
+            assert str(tmp_path / "new") in read_until({ str(tmp_path / "new") })
+
+            (tmp_path / "new" / "s.yaml").write_text("Template: t.yaml")
+            assert str(tmp_path / "new" / "s.yaml") in read_until({ str(tmp_path / "new" / "s.yaml") })
+
+            # Removing the directory reports the removal, and stops its watch
+            (tmp_path / "new" / "s.yaml").unlink()
+            (tmp_path / "new").rmdir()
+            changed = read_until({ str(tmp_path / "new" / "s.yaml"), str(tmp_path / "new") })
+
+            assert { str(tmp_path / "new" / "s.yaml"), str(tmp_path / "new") }.issubset(changed)
+            assert list(watcher.directories.values()) == [str(tmp_path)]
+
+        finally:
+
+            watcher.close()
+
+    @staticmethod
+    def test_watchers_report_changed_files(tmp_path):
+
+        (tmp_path / "stacks").mkdir()
+
+        libc = load_libc()
+        watchers = [PollingWatcher([str(tmp_path)], 0.01)]
+
+        if libc is not None:
+
+            watchers.append(InotifyWatcher([str(tmp_path)], libc))
+
+        (tmp_path / "stacks" / "new").mkdir()
+        (tmp_path / "stacks" / "new" / "s.yaml").write_text("Template: t.yaml")
+
+        expected = { str(tmp_path / "stacks" / "new"), str(tmp_path / "stacks" / "new" / "s.yaml") }
+
+        for watcher in watchers:
+
+            changed = set()
+
+            for _ in range(10):
+
+                changed.update(watcher.read(0.1))
+
+                if len(changed.intersection(expected)) > 0:
+
+                    break
+
+            watcher.close()
+
+            # inotify reports the new directory (to be walked), polling reports the new file
+            assert len(changed.intersection(expected)) > 0
@@ -0,0 +1,348 @@
+import os
+import re
+import threading
+from common import Struct
+from curried import curried
+from instrumentation import metrics
+
+
+# The name of the file, at the top of a synced directory, that holds its ignore patterns
+SYNC_IGNORE_FILE = ".syncignore"
+
+
+def translate_glob(pattern):
+
+    """
+    Translates a gitignore-style glob into a regular expression over "/"-separated paths
+
+    :param pattern: The glob, without any leading "!" or trailing "/"
+    :return: The regular expression source
+    """
+
+    regex = []
+    index = 0
+
+    while index < len(pattern):
+
+        char = pattern[index]
+
+        if pattern.startswith("**/", index):
+
+            # Zero or more directories
+            regex.append("(?:.*/)?")
+            index += 3
+            continue
+
+        if pattern.startswith("**", index):
+
+            # Anything, including "/"
+            regex.append(".*")
+            index += 2
+            continue
+
+        if char == "*":
+
+            regex.append("[^/]*")
+
+        elif char == "?":
+
+            regex.append("[^/]")
+
+        elif char == "\\" and index + 1 < len(pattern):
+
+            index += 1
+            regex.append(re.escape(pattern[index]))
+
+        elif char == "[" and "]" in pattern[index + 2:]:
+
+            end = pattern.index("]", index + 2)
+            members = pattern[index + 1:end].replace("\\", "\\\\")
+
+            if members.startswith("!"):
+
+                members = "^" + members[1:]
+
+            regex.append(f"[{members}]")
+            index = end
+
+        else:
+
+            regex.append(re.escape(char))
+
+        index += 1
+
+    return "".join(regex)
+
+
+def compile_rule(line):
+
+    """
+    Compiles one line of a .syncignore file
+
+    :param line: The line to compile
+    :return: A Struct with the rule's regular expression source and whether it is negated and directory-only, or None
+             for blank lines and comments
+    """
+
+    line = line.rstrip("\n").rstrip()
+
+    if line == "" or line.startswith("#"):
+
+        return None
+
+    negated = line.startswith("!")
+
+    if negated:
+
+        line = line[1:]
+
+    elif line.startswith("\\!") or line.startswith("\\#"):
+
+        line = line[1:]
+
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+
+    # Patterns with a "/" before their end are relative to the top of the synced directory; others match at any depth
+    anchored = "/" in line
+    line = line.lstrip("/")
+
+    return Struct \
+    (
+        regex = ("" if anchored else "(?:.*/)?") + translate_glob(line),
+        negated = negated,
+        dir_only = dir_only
+    )
+
+
+class SyncIgnore:
+
+    """
+    A matcher for gitignore-style patterns, compiled once. When no pattern is negated (the usual case), every pattern
+    is combined into a single regular expression; otherwise the last matching pattern wins, as in gitignore. A path is
+    ignored when it, or any directory above it, matches.
+    """
+
+    def __init__(self, lines):
+
+        # The ignore file itself is never synced
+        rules = [compile_rule("/" + SYNC_IGNORE_FILE)] + [rule for rule in map(compile_rule, lines) if rule is not None]
+
+        self.lock = threading.Lock()
+        self.ignored_dirs = {}
+        self.rules = [(re.compile(rule.regex + r"\Z"), rule.negated, rule.dir_only) for rule in rules]
+        self.has_negations = any(rule.negated for rule in rules)
+
+        if not self.has_negations:
+
+            self.dir_regex = re.compile("(?:" + "|".join(rule.regex for rule in rules) + r")\Z")
+            self.file_regex = re.compile("(?:" + "|".join(rule.regex for rule in rules if not rule.dir_only) + r")\Z")
+
+    def matches(self, path, is_dir):
+
+        """
+        Determines if the patterns match a path itself, without considering the directories above it
+
+        :param path: The "/"-separated path relative to the top of the synced directory
+        :param is_dir: Whether the path is a directory
+        :return: Whether the path matches
+        """
+
+        if not self.has_negations:
+
+            return (self.dir_regex if is_dir else self.file_regex).match(path) is not None
+
+        ignored = False
+
+        for regex, negated, dir_only in self.rules:
+
+            if (is_dir or not dir_only) and regex.match(path):
+
+                ignored = not negated
+
+        return ignored
+
+    def is_dir_ignored(self, path):
+
+        """
+        Determines if a directory, or any directory above it, is ignored
+
+        :param path: The "/"-separated path of the directory relative to the top of the synced directory
+        :return: Whether the directory is ignored
+        """
+
+        with self.lock:
+
+            if path in self.ignored_dirs:
+
+                return self.ignored_dirs[path]
+
+        parent = path.rpartition("/")[0]
+        ignored = (parent != "" and self.is_dir_ignored(parent)) or self.matches(path, True)
+
+        with self.lock:
+
+            self.ignored_dirs[path] = ignored
+
+        return ignored
+
+    def is_ignored(self, path):
+
+        """
+        Determines if a file is ignored, either by itself or because a directory above it is
+
+        :param path: The path of the file relative to the top of the synced directory
+        :return: Whether the file is ignored
+        """
+
+        path = path.replace(os.path.sep, "/")
+        parent = path.rpartition("/")[0]
+
+        return (parent != "" and self.is_dir_ignored(parent)) or self.matches(path, False)
+
+
+def load_sync_ignore(local_path):
+
+    """
+    Loads the .syncignore file at the top of a local directory
+
+    :param local_path: The local directory being synced
+    :return: A SyncIgnore matcher (which only ignores the .syncignore file itself if there is none)
+    """
+
+    try:
+
+        with open(os.path.join(local_path, SYNC_IGNORE_FILE), "r") as ignore_data:
+
+            return SyncIgnore(ignore_data.readlines())
+
+    except FileNotFoundError:
+
+        return SyncIgnore([])
+
+
+@curried
+def ignore_walk_template(list_files_func, sync_ignore, local_path):
+
+    """
+    Curried template function for walking a local directory while leaving out ignored paths. Ignored directories are
+    pruned before they are descended into, so nothing below them is listed.
+
+    :param list_files_func: A function that walks a local directory top-down like os.walk
+    :param sync_ignore: The SyncIgnore matcher to apply
+    :param local_path: The local directory to walk
+    :return: A generator that yields (root, dir_names, file_names) tuples like os.walk
+    """
+
+    for root, dir_names, file_names in list_files_func(local_path):
+
+        relative_root = os.path.relpath(root, local_path).replace(os.path.sep, "/")
+        prefix = "" if relative_root == "." else relative_root + "/"
+
+        kept_dir_names = [name for name in dir_names if not sync_ignore.matches(prefix + name, True)]
+        kept_file_names = [name for name in file_names if not sync_ignore.matches(prefix + name, False)]
+
+        metrics.count("dirs_pruned", len(dir_names) - len(kept_dir_names))
+        metrics.count("files_ignored", len(file_names) - len(kept_file_names))
+
+        dir_names[:] = kept_dir_names
+
+        yield root, dir_names, kept_file_names
+
+
+class PyTests:
+
+    @staticmethod
+    def test_patterns_without_a_slash_match_at_any_depth():
+
+        sync_ignore = SyncIgnore(["*.swp", ".DS_Store"])
+
+        assert sync_ignore.is_ignored("a.swp")
+        assert sync_ignore.is_ignored("account/us-east-1/.stack.yaml.swp")
+        assert sync_ignore.is_ignored("account/.DS_Store")
+        assert not sync_ignore.is_ignored("account/us-east-1/stack.yaml")
+
+    @staticmethod
+    def test_patterns_with_a_slash_are_anchored_to_the_top():
+
+        sync_ignore = SyncIgnore(["/README.md", "docs/*.md"])
+
+        assert sync_ignore.is_ignored("README.md")
+        assert not sync_ignore.is_ignored("account/README.md")
+        assert sync_ignore.is_ignored("docs/notes.md")
+        assert not sync_ignore.is_ignored("docs/deeper/notes.md")
+
+    @staticmethod
+    def test_directory_patterns_ignore_everything_below_them():
+
+        sync_ignore = SyncIgnore(["scratch/"])
+
+        assert sync_ignore.is_ignored("scratch/file.yaml")
+        assert sync_ignore.is_ignored("account/scratch/deep/file.yaml")
+        assert not sync_ignore.is_ignored("scratch")
+
+    @staticmethod
+    def test_double_star_matches_any_number_of_directories():
+
+        sync_ignore = SyncIgnore(["**/tmp/**", "logs/**/*.log"])
+
+        assert sync_ignore.is_ignored("tmp/a")
+        assert sync_ignore.is_ignored("a/b/tmp/c/d")
+        assert sync_ignore.is_ignored("logs/a.log")
+        assert sync_ignore.is_ignored("logs/x/y/a.log")
+        assert not sync_ignore.is_ignored("logs/a.txt")
+
+    @staticmethod
+    def test_negated_patterns_re_include_files_with_the_last_match_winning():
+
+        sync_ignore = SyncIgnore(["*.md", "!KEEP.md", "# a comment", "", "\\#literal"])
+
+        assert sync_ignore.is_ignored("README.md")
+        assert not sync_ignore.is_ignored("KEEP.md")
+        assert sync_ignore.is_ignored("#literal")
+        assert not sync_ignore.is_ignored("a comment")
+
+    @staticmethod
+    def test_character_classes_and_question_marks():
+
+        sync_ignore = SyncIgnore(["file[0-9].yaml", "?.tmp", "[!a]x"])
+
+        assert sync_ignore.is_ignored("file1.yaml")
+        assert not sync_ignore.is_ignored("fileA.yaml")
+        assert sync_ignore.is_ignored("a.tmp")
+        assert not sync_ignore.is_ignored("ab.tmp")
+        assert sync_ignore.is_ignored("bx")
+        assert not sync_ignore.is_ignored("ax")
+
+    @staticmethod
+    def test_the_ignore_file_itself_is_always_ignored():
+
+        sync_ignore = SyncIgnore([])
+
+        assert sync_ignore.is_ignored(SYNC_IGNORE_FILE)
+        assert not sync_ignore.is_ignored(f"account/{SYNC_IGNORE_FILE}")
+        assert not sync_ignore.is_ignored("stack.yaml")
+
+    @staticmethod
+    def test_ignore_walk_template_prunes_ignored_directories_before_descending(tmp_path):
+
+        root = str(tmp_path)
+
+        for path in ("account/us-east-1/stack.yaml", "account/us-east-1/.stack.yaml.swp", "scratch/deep/file.yaml"):
+            os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok = True)
+            with open(os.path.join(root, path), "w") as file_data:
+                file_data.write("data")
+
+        with open(os.path.join(root, SYNC_IGNORE_FILE), "w") as file_data:
+            file_data.write("*.swp\nscratch/\n")
+
+        walked = list(ignore_walk_template(os.walk)(load_sync_ignore(root))(root))
+
+        assert [os.path.relpath(path, root) for path, dir_names, file_names in walked] == \
+               [".", "account", os.path.join("account", "us-east-1")]
+        assert [file_names for path, dir_names, file_names in walked] == [[], [], ["stack.yaml"]]
+
+    @staticmethod
+    def test_load_sync_ignore_works_without_an_ignore_file(tmp_path):
+
+        assert not load_sync_ignore(str(tmp_path)).is_ignored("stack.yaml")
@@ -0,0 +1,319 @@
+import os
+import re
+from urllib.parse import unquote
+from common import Struct
+from instrumentation import metrics
+from file_set_loader import read_bytes
+
+
+# The resource type of a nested stack, whose TemplateURL names its child template
+NESTED_STACK_TYPE = "AWS::CloudFormation::Stack"
+
+# The extensions of the templates that are searched for nested stacks
+TEMPLATE_EXTENSIONS = (".yaml", ".yml", ".json", ".template")
+
+# A label of an S3 host name: literal, or a variable of an Fn::Sub (e.g. ${AWS::Region}), which could be any label
+S3_HOST_LABEL = r"(?:[a-z0-9-]+|\$\{[^}]+\})"
+
+# The end of an S3 host name after "s3": any region or dualstack labels, then the domain (or ${AWS::URLSuffix})
+S3_HOST_SUFFIX = rf"s3(?:[.-]{S3_HOST_LABEL})*?\.(?:amazonaws\.com(?:\.cn)?|\$\{{AWS::URLSuffix\}})"
+
+# The forms of an S3 object URL: virtual-hosted (https://bucket.s3.region.amazonaws.com/key), path-style
+# (https://s3.region.amazonaws.com/bucket/key) and s3://bucket/key
+S3_URL_PATTERNS = \
+[
+    re.compile(rf"^https://(?P<bucket>[^/]+?)\.{S3_HOST_SUFFIX}/(?P<key>[^?#]+)$"),
+    re.compile(rf"^https://{S3_HOST_SUFFIX}/(?P<bucket>[^/]+)/(?P<key>[^?#]+)$"),
+    re.compile(r"^s3://(?P<bucket>[^/]+)/(?P<key>.+)$")
+]
+
+
+def join_template_url(template_url):
+
+    """
+    Reads a TemplateURL written with Fn::Sub or Fn::Join as a string, with each part that isn't known until the stack
+    is deployed as a variable (a Ref as ${Name}, like in an Fn::Sub)
+
+    :param template_url: The TemplateURL
+    :return: The TemplateURL as a string with ${...} variables, or None if it can't be read as one
+    """
+
+    if isinstance(template_url, dict) and list(template_url) == ["Fn::Sub"]:
+
+        template_url = template_url["Fn::Sub"]
+
+        if isinstance(template_url, list) and len(template_url) > 0:
+
+            template_url = template_url[0]
+
+    elif isinstance(template_url, dict) and list(template_url) == ["Fn::Join"]:
+
+        join = template_url["Fn::Join"]
+
+        if not (isinstance(join, list) and len(join) == 2 and isinstance(join[0], str) and isinstance(join[1], list)):
+
+            return None
+
+        template_url = join[0].join \
+        (
+            part if isinstance(part, str) else
+            "${" + part["Ref"] + "}" if isinstance(part, dict) and isinstance(part.get("Ref"), str) else
+            "${Join}"
+            for part in join[1]
+        )
+
+    return template_url if isinstance(template_url, str) else None
+
+
+def template_url_child(template_url, s3_buckets, s3_path):
+
+    """
+    Finds the synced template a nested stack's TemplateURL points at
+
+    :param template_url: The TemplateURL: a string, or an Fn::Sub or Fn::Join whose bucket, region and domain may be
+                         variables (e.g. ${Bucket} or ${AWS::Region})
+    :param s3_buckets: The names of the buckets being synced
+    :param s3_path: The path into the buckets that the templates are synced to
+    :return: The path of the child template relative to s3_path, or None if the URL points elsewhere
+    """
+
+    template_url = join_template_url(template_url)
+
+    if template_url is None:
+
+        return None
+
+    for pattern in S3_URL_PATTERNS:
+
+        match = pattern.match(template_url.strip())
+
+        if match is None:
+
+            continue
+
+        bucket, key = match.group("bucket"), unquote(match.group("key"))
+
+        # A bucket that is a variable could be any of ours, but a key that is a variable can't be resolved
+        if ("${" not in bucket and bucket not in s3_buckets) or "${" in key or not key.startswith(s3_path + "/"):
+
+            return None
+
+        return key[len(s3_path) + 1:]
+
+    return None
+
+
+def find_nested_templates(data_bytes, s3_buckets, s3_path):
+
+    """
+    Finds the synced templates a template embeds as nested stacks
+
+    :param data_bytes: The contents of the template
+    :param s3_buckets: The names of the buckets being synced
+    :param s3_path: The path into the buckets that the templates are synced to
+    :return: The set of child template paths relative to s3_path
+    """
+
+    import cfn_yaml
+
+    template = cfn_yaml.load(data_bytes)
+    resources = template.get("Resources") if isinstance(template, dict) else None
+    children = set()
+
+    for resource in resources.values() if isinstance(resources, dict) else []:
+
+        if isinstance(resource, dict) and resource.get("Type") == NESTED_STACK_TYPE:
+
+            properties = resource.get("Properties")
+            child = template_url_child \
+            (
+                properties.get("TemplateURL") if isinstance(properties, dict) else None,
+                s3_buckets,
+                s3_path
+            )
+
+            if child is not None:
+
+                children.add(child)
+
+    return children
+
+
+def build_template_graph(local_path, files, s3_buckets, s3_path):
+
+    """
+    Builds the graph of nested stacks between the templates in a directory
+
+    :param local_path: The local templates directory
+    :param files: The paths of every local file, relative to local_path
+    :param s3_buckets: The names of the buckets being synced
+    :param s3_path: The path into the buckets that the templates are synced to
+    :return: A dictionary of the set of child templates of each template that embeds any
+    """
+
+    children = {}
+
+    with metrics.span("template_graph.build"):
+
+        for file in files:
+
+            if not file.lower().endswith(TEMPLATE_EXTENSIONS):
+
+                continue
+
+            data_bytes = read_bytes(os.path.join(local_path, file))
+
+            # Only templates that mention nested stacks need parsing
+            if NESTED_STACK_TYPE.encode("utf-8") not in data_bytes:
+
+                continue
+
+            try:
+
+                file_children = find_nested_templates(data_bytes, s3_buckets, s3_path)
+
+            except Exception as error:
+
+                # Reporting broken templates is the validator's job
+                print(f"Looking for nested stacks in {file} failed => {error}")
+                continue
+
+            if len(file_children) > 0:
+
+                children[file.replace(os.sep, "/")] = file_children
+
+    metrics.count("nested_stack_parents", len(children))
+
+    return children
+
+
+def plan_template_levels(children, files):
+
+    """
+    Orders templates into levels, children before parents: level 0 holds every template without nested stacks, and
+    each later level holds the templates whose children are all in earlier levels. Publishing level by level means a
+    parent never lands before a child it points at.
+
+    :param children: The set of child templates of each template that embeds any (see build_template_graph)
+    :param files: The paths of every local file, relative to the top of the templates directory
+    :return: A Struct with the level of each file, and the list of errors (missing children and cycles) if any
+    """
+
+    files = set(file.replace(os.sep, "/") for file in files)
+    errors = \
+    [
+        f"{parent} => nested stack template {child} doesn't exist"
+        for parent in sorted(children)
+        for child in sorted(children[parent])
+        if child not in files
+    ]
+
+    levels = {}
+    remaining = set(children)
+    level = 1
+
+    for file in files.difference(children):
+
+        levels[file] = 0
+
+    while len(remaining) > 0:
+
+        # Missing children were reported above, so they don't hold their parents back
+        ready = set \
+        (
+            parent
+            for parent in remaining
+            if all(child in levels or child not in files for child in children[parent])
+        )
+
+        if len(ready) == 0:
+
+            errors.extend(f"{parent} => is in, or nests, a cycle of nested stacks" for parent in sorted(remaining))
+            break
+
+        for parent in ready:
+
+            levels[parent] = level
+
+        remaining.difference_update(ready)
+        level += 1
+
+    return Struct(levels = levels, errors = errors)
+
+
+class PyTests:
+
+    @staticmethod
+    def test_template_url_child_only_follows_urls_into_the_synced_path():
+
+        buckets, path = ["my-bucket"], "templates"
+
+        assert template_url_child("https://my-bucket.s3.amazonaws.com/templates/a/b.yaml", buckets, path) == "a/b.yaml"
+        assert template_url_child("https://my-bucket.s3.us-west-2.amazonaws.com/templates/c.yaml", buckets, path) == \
+               "c.yaml"
+        assert template_url_child("https://s3.amazonaws.com/my-bucket/templates/a%20b.yaml", buckets, path) == \
+               "a b.yaml"
+        assert template_url_child({ "Fn::Sub": "https://${Bucket}.s3.amazonaws.com/templates/d.yaml" }, buckets, path) \
+               == "d.yaml"
+        assert template_url_child("https://other.s3.amazonaws.com/templates/a.yaml", buckets, path) is None
+        assert template_url_child("https://my-bucket.s3.amazonaws.com/stacks/a.yaml", buckets, path) is None
+
+        # The usual ways of writing a TemplateURL that works in any region
+        for url in \
+        [
+            "https://${Bucket}.s3.${AWS::Region}.amazonaws.com/templates/e.yaml",
+            "https://s3.${AWS::Region}.amazonaws.com/my-bucket/templates/e.yaml",
+            "https://s3-${AWS::Region}.amazonaws.com/${Bucket}/templates/e.yaml",
+            "https://${Bucket}.s3.${AWS::URLSuffix}/templates/e.yaml",
+            "https://my-bucket.s3.dualstack.${AWS::Region}.${AWS::URLSuffix}/templates/e.yaml"
+        ]:
+
+            assert template_url_child({ "Fn::Sub": url }, buckets, path) == "e.yaml", url
+
+        join = { "Fn::Join": ["", ["https://", { "Ref": "Bucket" }, ".s3.", { "Ref": "AWS::Region" }, ".", \
+                                   { "Ref": "AWS::URLSuffix" }, "/templates/f.yaml"]] }
+
+        assert template_url_child(join, buckets, path) == "f.yaml"
+        assert template_url_child({ "Fn::Sub": "https://other.s3.${AWS::Region}.amazonaws.com/templates/e.yaml" }, \
+                                  buckets, path) is None
+
+        variable_key = { "Fn::Sub": "https://my-bucket.s3.amazonaws.com/templates/${Name}" }
+
+        assert template_url_child(variable_key, buckets, path) is None
+        assert template_url_child({ "Ref": "Url" }, buckets, path) is None
+
+    @staticmethod
+    def test_plan_template_levels_orders_children_first_and_reports_errors(tmp_path):
+
+        def nested(*urls):
+
+            return "Resources:\n" + "".join \
+            (
+                f"  S{index}:\n    Type: AWS::CloudFormation::Stack\n    Properties:\n      TemplateURL: {url}\n"
+                for index, url in enumerate(urls)
+            )
+
+        url = "https://b.s3.amazonaws.com/templates/"
+        (tmp_path / "leaf.yaml").write_text("Resources: {}\n")
+        (tmp_path / "mid.yaml").write_text(nested(url + "leaf.yaml"))
+        (tmp_path / "top.yaml").write_text(nested(url + "mid.yaml", url + "leaf.yaml") + "Outputs: {}\n")
+        (tmp_path / "notes.txt").write_text("AWS::CloudFormation::Stack")
+
+        files = ["leaf.yaml", "mid.yaml", "top.yaml", "notes.txt"]
+        children = build_template_graph(str(tmp_path), files, ["b"], "templates")
+        plan = plan_template_levels(children, files)
+
+        assert children == { "mid.yaml": { "leaf.yaml" }, "top.yaml": { "mid.yaml", "leaf.yaml" } }
+        assert plan.levels == { "leaf.yaml": 0, "notes.txt": 0, "mid.yaml": 1, "top.yaml": 2 }
+        assert plan.errors == []
+
+        (tmp_path / "leaf.yaml").write_text(nested(url + "top.yaml", url + "gone.yaml"))
+        plan = plan_template_levels(build_template_graph(str(tmp_path), files, ["b"], "templates"), files)
+
+        assert plan.errors == \
+        [
+            "leaf.yaml => nested stack template gone.yaml doesn't exist",
+            "leaf.yaml => is in, or nests, a cycle of nested stacks",
+            "mid.yaml => is in, or nests, a cycle of nested stacks",
+            "top.yaml => is in, or nests, a cycle of nested stacks"
+        ]
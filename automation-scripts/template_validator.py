@@ -0,0 +1,158 @@
+import threading
+from curried import curried
+from instrumentation import metrics
+from rate_controller import controller
+from aws_clients import registry
+from worker_pool import shared_pool
+
+
+def get_cloudformation_client():
+
+    """Returns the shared CloudFormation client for use by other functions"""
+
+    return registry.get_client("cloudformation")
+
+
+@curried
+def validate_template_file_template(get_cloudformation_client_func, file):
+
+    """
+    Curried template function for validating a file as an AWS CloudFormation template
+
+    :param get_cloudformation_client_func: A function that returns a CloudFormation client
+    :param file: The file to validate
+    :return: Whether the file is a valid template
+    """
+
+    client = get_cloudformation_client_func()
+
+    from botocore.exceptions import ClientError
+
+    with open(file, "r") as file_data, metrics.span("cloudformation.validate_template", file = file):
+
+        try:
+
+            controller.call("ValidateTemplate", client.validate_template, TemplateBody = file_data.read())
+            print(f"{file} => Valid")
+            return True
+
+        except ClientError as error:
+
+            print(f"{file} => {error}")
+            return False
+
+
+# Curry the get_cloudformation_client function into the validate_template_file_template function
+validate_template_file = validate_template_file_template(get_cloudformation_client)
+
+
+def validate_templates(file_list):
+
+    """
+    Validates the files in file_list as AWS CloudFormation templates, concurrently on the shared worker pool
+
+    :param file_list: The list of files to validate
+    :return: Whether all files are valid templates or not
+    """
+
+    with metrics.span("validate_templates"):
+
+        return all(shared_pool.map(validate_template_file, file_list))
+
+
+class ValidationGate:
+
+    """
+    Decides whether each file may be published, validating it first. Once any file has failed, no more files are let
+    through, but the rest are still validated so that every error is reported. Each file is only validated once, so
+    one gate can be shared by every destination in a run.
+    """
+
+    def __init__(self, validate_func = validate_template_file):
+
+        self.lock = threading.Lock()
+        self.validate_func = validate_func
+        self.results = {}
+        self.invalid = []
+
+    def __call__(self, file):
+
+        """
+        Validates a file (or looks up its earlier result)
+
+        :param file: The file to validate
+        :return: Whether the file may be published: it is valid and no file has failed so far
+        """
+
+        with self.lock:
+
+            valid = self.results.get(file)
+
+        if valid is None:
+
+            valid = self.validate_func(file)
+
+            with self.lock:
+
+                self.results[file] = valid
+
+                if not valid:
+
+                    self.invalid.append(file)
+
+        with self.lock:
+
+            return valid and len(self.invalid) == 0
+
+    def passed(self):
+
+        """Returns whether every file validated so far is valid"""
+
+        with self.lock:
+
+            return len(self.invalid) == 0
+
+
+class PyTests:
+
+    @staticmethod
+    def test_validate_template_file_template_reports_invalid_templates(tmp_path):
+
+        from botocore.exceptions import ClientError
+        from common import Struct
+
+        template = tmp_path / "template.yaml"
+        template.write_text("Resources: {}")
+
+        def my_validate_template(TemplateBody):
+            if TemplateBody != "Resources: {}":
+                raise ClientError({ "Error": { "Code": "ValidationError", "Message": "bad" } }, "ValidateTemplate")
+
+        client = Struct(validate_template = my_validate_template)
+
+        assert validate_template_file_template(lambda: client)(str(template))
+
+        template.write_text("Resources: []")
+
+        assert not validate_template_file_template(lambda: client)(str(template))
+
+    @staticmethod
+    def test_validation_gate_stops_letting_files_through_after_a_failure():
+
+        validated = []
+
+        def my_validate(file):
+            validated.append(file)
+            return file != "bad.yaml"
+
+        gate = ValidationGate(my_validate)
+
+        assert gate("a.yaml")
+        assert not gate("bad.yaml")
+        assert not gate("b.yaml")
+        assert not gate("a.yaml")
+        assert not gate.passed()
+        assert gate.invalid == ["bad.yaml"]
+
+        # Every file is validated, but only once
+        assert validated == ["a.yaml", "bad.yaml", "b.yaml"]
@@ -0,0 +1,146 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from rate_controller import controller
+from aws_clients import registry
+
+
+class WorkerPool:
+
+    """
+    A pool of worker threads shared by every stage that makes AWS calls concurrently. The number of calls actually in
+    flight is governed by the shared rate controller; the pool only needs enough threads to reach its maximum.
+
+    Tasks running on the pool must not wait on other tasks submitted to the same pool, as that can exhaust the threads.
+    """
+
+    def __init__(self, max_workers = 16):
+
+        self.lock = threading.Lock()
+        self.max_workers = max_workers
+        self.executor = None
+
+    def configure(self, max_workers):
+
+        """
+        Sets the number of worker threads, replacing any existing threads once their work is done
+
+        :param max_workers: The number of worker threads
+        :return: Nothing
+        """
+
+        with self.lock:
+
+            executor = self.executor
+            self.executor = None
+            self.max_workers = max(1, max_workers)
+
+        if executor is not None:
+
+            executor.shutdown(wait = True)
+
+    def get_executor(self):
+
+        """Returns the underlying executor, creating it on first use"""
+
+        with self.lock:
+
+            if self.executor is None:
+
+                self.executor = ThreadPoolExecutor(max_workers = self.max_workers)
+
+            return self.executor
+
+    def submit(self, func, *args):
+
+        """
+        Runs a function on the pool
+
+        :param func: The function to run
+        :param args: The arguments to pass to the function
+        :return: A concurrent.futures.Future for the result of the function
+        """
+
+        return self.get_executor().submit(func, *args)
+
+    def map(self, func, items):
+
+        """
+        Runs a function over every item on the pool and waits for all of them to finish
+
+        :param func: The function to run for each item
+        :param items: The items to pass to the function; a generator is consumed on the calling thread as the items
+                      are submitted, so it can pace them (see publish_scheduler.PublishPacer.paced)
+        :return: The results of the function, in the same order as the items
+        """
+
+        futures = [self.submit(func, item) for item in items]
+
+        wait(futures)
+
+        # Every task has finished, so report the first failure (if any) without abandoning work in flight
+        for future in futures:
+
+            if future.exception() is not None:
+
+                raise future.exception()
+
+        return [future.result() for future in futures]
+
+
+# The worker pool shared by every stage during a run
+shared_pool = WorkerPool()
+
+
+def configure_concurrency(concurrency, max_rate = None):
+
+    """
+    Sizes the shared worker pool, the shared rate controller and the clients' connection pools for the configured
+    concurrency
+
+    :param concurrency: The maximum number of AWS calls in flight at once
+    :param max_rate: The maximum number of AWS calls started per second, or None to keep the controller's default
+    :return: Nothing
+    """
+
+    controller.configure(max_concurrency = concurrency, max_rate = max_rate)
+    shared_pool.configure(concurrency)
+    registry.configure(concurrency)
+
+
+class PyTests:
+
+    @staticmethod
+    def test_map_returns_results_in_item_order():
+
+        pool = WorkerPool(4)
+
+        assert pool.map(lambda item: item * 2, [3, 1, 2]) == [6, 2, 4]
+
+    @staticmethod
+    def test_map_runs_every_item_before_raising_the_first_error():
+
+        pool = WorkerPool(2)
+        done = []
+
+        def work(item):
+            if item == 1:
+                raise ValueError(item)
+            done.append(item)
+
+        try:
+            pool.map(work, [0, 1, 2, 3])
+            assert False
+        except ValueError:
+            pass
+
+        assert sorted(done) == [0, 2, 3]
+
+    @staticmethod
+    def test_configure_resizes_the_pool():
+
+        pool = WorkerPool(2)
+        pool.map(lambda item: item, [1])
+        pool.configure(5)
+
+        assert pool.executor is None
+        assert pool.get_executor()._max_workers == 5